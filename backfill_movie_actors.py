@@ -0,0 +1,62 @@
+import sys
+import time
+
+from config import SessionLocal
+from result_cache import bump_catalog_version
+
+# Backfill job for movies.movie_actors: fills the junction table from top_5_actors of the movies inserted before it
+# existed (the ingest scripts write it for every new movie). Works through movies.movies in id ranges and commits
+# after every range, so it can be stopped and re-run at any time: movies that already have actor rows are skipped.
+#
+#   python backfill_movie_actors.py [batch_size]
+
+# the movies that get actor rows get a new revision too: their cast counts in their neighbors (build_neighbors.py)
+BACKFILL_BATCH = """
+    WITH inserted AS (
+        INSERT INTO movies.movie_actors (movie_id, actor_name_normalized, billing_order)
+        SELECT m.id, lower(regexp_replace(btrim(actor.name), '\\s+', ' ', 'g')), actor.billing_order
+        FROM movies.movies m
+        CROSS JOIN LATERAL unnest(m.top_5_actors) WITH ORDINALITY AS actor(name, billing_order)
+        WHERE m.id >= %(first_id)s AND m.id < %(next_id)s
+          AND actor.name IS NOT NULL AND btrim(actor.name) <> ''
+          AND NOT EXISTS (SELECT 1 FROM movies.movie_actors a WHERE a.movie_id = m.id)
+        ON CONFLICT (movie_id, billing_order) DO NOTHING
+        RETURNING movie_id
+    ), revised AS (
+        UPDATE movies.movies m SET revision = m.revision + 1 WHERE m.id IN (SELECT movie_id FROM inserted)
+    )
+    SELECT count(*) FROM inserted
+"""
+
+
+def backfill(session, batch_size=10000):
+    connection = session.connection()
+    max_id = connection.exec_driver_sql("SELECT COALESCE(MAX(id), 0) FROM movies.movies").scalar()
+    inserted = 0
+    started = time.perf_counter()
+    for first_id in range(1, max_id + 1, batch_size):
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute(BACKFILL_BATCH, {'first_id': first_id, 'next_id': first_id + batch_size})
+            batch_inserted = cursor.fetchone()[0]
+            inserted += batch_inserted
+            if batch_inserted:
+                bump_catalog_version(cursor)  # actor searches answered from the cache must see the new rows
+        finally:
+            cursor.close()
+        session.commit()
+        print(f"movies {first_id}-{min(first_id + batch_size - 1, max_id)}: {inserted} actor rows so far")
+    print(f"Backfilled {inserted} movie_actors rows in {time.perf_counter() - started:.1f}s")
+    return inserted
+
+
+if __name__ == "__main__":
+    session = SessionLocal()
+    try:
+        backfill(session, int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
+    except Exception as e:
+        session.rollback()
+        print(f"ERROR in backfilling movie_actors: {e}")
+        sys.exit(1)
+    finally:
+        session.close()
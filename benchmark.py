@@ -0,0 +1,344 @@
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import types
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+import config
+from genres import GENRES
+
+# Reproducible benchmark of the searches of main.py.
+#   build:   a synthetic catalog (movies.movies, movies.movie_overviews, movies.movie_actors) of N movies, generated from
+#            a seed, in a database of its own (BENCH_DATABASE_URL, never the one of config.py): the base tables, then the
+#            migrations, then the rows through COPY ; 10k to 1M movies
+#   run:     routes and answers sample queries of every intent of main() against it, with the OpenAI client replaced
+#            by FakeOpenAI (a fixed latency per completion, no network), and reports per intent the p50/p95/p99 latency,
+#            the throughput and the rows per query as JSON (with the commit it ran on)
+#   compare: two run reports side by side ; exit code 1 when an intent's p95 got slower than the threshold
+# The correction and result caches are off unless --cache: every query pays for its corrections and statements.
+# With TRACING=1 (tracing.py) every query of run also writes its trace, for a breakdown of the latency by stage.
+#
+#   BENCH_DATABASE_URL=postgresql+psycopg2://postgres@localhost/movies_bench python benchmark.py build --movies 100000
+#   BENCH_DATABASE_URL=... python benchmark.py run [--queries 50] [--llm-latency 0.3] [--concurrency 1] [--output bench.json]
+#   python benchmark.py compare before.json after.json [--threshold 1.1]
+
+SEED = 7
+COPY_BATCH = 50000  # movies per COPY
+TITLE_WORDS = (
+    'Silent', 'Broken', 'Last', 'Hidden', 'Golden', 'Dark', 'Lost', 'Crimson', 'Frozen', 'Electric', 'Midnight', 'Wild',
+    'Harbor', 'Empire', 'Garden', 'River', 'Signal', 'Horizon', 'Machine', 'Kingdom', 'Shadow', 'Voyage', 'Letter', 'Storm',
+)
+FIRST_NAMES = (
+    'Anna', 'Ben', 'Carla', 'David', 'Elena', 'Frank', 'Grace', 'Hugo', 'Iris', 'Jonas', 'Kate', 'Luis', 'Maya', 'Noah',
+    'Olga', 'Paul', 'Rosa', 'Sam', 'Tara', 'Victor', 'Wendy', 'Yuri', 'Zoe', 'Omar',
+)
+LAST_NAMES = (
+    'Adler', 'Brooks', 'Castillo', 'Dumont', 'Eriksen', 'Fischer', 'Garner', 'Hayes', 'Ivanova', 'Jensen', 'Keller',
+    'Lindqvist', 'Moreau', 'Novak', 'Okafor', 'Petrov', 'Quinn', 'Rossi', 'Santos', 'Tanaka', 'Ueda', 'Vargas', 'Walsh',
+)
+OVERVIEW_WORDS = (
+    'a', 'the', 'young', 'detective', 'family', 'secret', 'war', 'heist', 'island', 'city', 'love', 'journey', 'ship',
+    'submarine', 'dream', 'murder', 'team', 'escape', 'robot', 'village', 'king', 'storm', 'friendship', 'revenge',
+)
+QUERY_TEMPLATES = {
+    # intent -> query text of main() (see query_router.py) ; fields from sample_values()
+    'overview': "overview of {title}",
+    'top_year': "top 5 movies from year {year}",
+    'similar': "movies like {title}",
+    'plot': "movies about a {word} and a {word2}",
+    'actor_range': "movies of actor {actor} from {from_year} to {to_year}",
+    'actor': "movies of actor {actor}",
+    'director_rating': "movies of director {director} with ratings above {rating}",
+    'director_range': "movies of director {director} from {from_year} to {to_year}",
+    'genre_rating': "genres like {genre} and {genre2} with rating below {rating}",
+    'genres': "genres like {genre} and {genre2}",
+    'director': "movies of director {director}",
+    'title': "{title_words}",
+}
+
+
+def person_name(number):
+    # a deterministic person name per number (the pools below are sized from the catalog size)
+    return f"{FIRST_NAMES[number % len(FIRST_NAMES)]} {LAST_NAMES[(number // len(FIRST_NAMES)) % len(LAST_NAMES)]} {number}"
+
+
+def synthetic_movies(movies, seed=SEED):
+    # yields (id, tmdb_id, movie_name, tmdb_rating, genre, release_year, director_name, top_5_actors, genre_ids, overview)
+    rng = random.Random(seed)
+    genre_ids = sorted(GENRES)
+    directors = max(10, movies // 20)
+    actors = max(50, movies // 4)
+    for movie_id in range(1, movies + 1):
+        title = f"{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {movie_id}"
+        rating = None if rng.random() < 0.01 else round(rng.uniform(1, 9.9), 2)  # a few unrated movies, like TMDB
+        ids = sorted(rng.sample(genre_ids, rng.randint(1, 3)))
+        cast = [person_name(rng.randrange(actors)) for _ in range(5)]
+        overview = ' '.join(rng.choice(OVERVIEW_WORDS) for _ in range(rng.randint(12, 40)))
+        yield (movie_id, movie_id, title, rating, ', '.join(GENRES[genre_id] for genre_id in ids), rng.randint(1950, 2024),
+               person_name(rng.randrange(directors)), cast, ids, overview)
+
+
+def copy_value(value):
+    # one field in COPY's text format (the generated names and words hold no quotes, tabs or backslashes)
+    if value is None:
+        return '\\N'
+    if isinstance(value, list):
+        return '{' + ','.join(f'"{item}"' if isinstance(item, str) else str(item) for item in value) + '}'
+    return str(value)
+
+
+def copy_rows(cursor, table, columns, rows):
+    data = io.StringIO(''.join('\t'.join(copy_value(value) for value in row) + '\n' for row in rows))
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", data)
+
+
+def bench_database_url(url=None):
+    # the benchmark's own database ; refusing config.py's, whose movies the build would drop
+    url = url or os.getenv('BENCH_DATABASE_URL')
+    if not url:
+        raise SystemExit("Set BENCH_DATABASE_URL (or --database-url) to the database the benchmark may overwrite")
+    bench_url = create_engine(url).url
+    if bench_url.render_as_string(hide_password=False) == config.SessionLocal.kw['bind'].url.render_as_string(hide_password=False):
+        raise SystemExit("BENCH_DATABASE_URL is the database of config.py ; the benchmark needs a database of its own")
+    return url
+
+
+def use_database(url):
+    # points config.SessionLocal at url ; before db.py / main.py are imported, so their pool is built on it
+    config.SessionLocal.configure(bind=create_engine(url))
+
+
+def build(movies, seed=SEED):
+    import migrations
+    from backfill_movie_actors import backfill
+    from result_cache import bump_catalog_version
+    base_tables = ['movies_table.sql', 'movie_overviews_ table.sql']
+    directory = os.path.dirname(os.path.abspath(__file__))
+    session = config.SessionLocal()
+    try:
+        started = time.perf_counter()
+        cursor = session.connection().connection.cursor()
+        cursor.execute("DROP SCHEMA IF EXISTS movies CASCADE ; CREATE SCHEMA movies")
+        for file_name in base_tables:
+            with open(os.path.join(directory, file_name), encoding='utf-8') as sql_file:
+                cursor.execute(sql_file.read())
+        session.commit()
+        migrations.apply(session)
+
+        cursor = session.connection().connection.cursor()
+        generated = synthetic_movies(movies, seed)
+        for batch_start in range(0, movies, COPY_BATCH):
+            batch = [next(generated) for _ in range(min(COPY_BATCH, movies - batch_start))]
+            copy_rows(cursor, 'movies.movies', ('id', 'tmdb_id', 'movie_name', 'tmdb_rating', 'genre', 'release_year', 'director_name', 'top_5_actors', 'genre_ids'),
+                      (row[:9] for row in batch))
+            copy_rows(cursor, 'movies.movie_overviews', ('movie_id', 'movie_name', 'overview'), ((row[0], row[2], row[9]) for row in batch))
+            session.commit()
+            print(f"{batch_start + len(batch)}/{movies} movies copied")
+        cursor = session.connection().connection.cursor()
+        cursor.execute("SELECT setval(pg_get_serial_sequence('movies.movies', 'id'), %s)", (movies,))
+        session.commit()
+        backfill(session, batch_size=COPY_BATCH)
+        cursor = session.connection().connection.cursor()
+        bump_catalog_version(cursor)
+        session.commit()
+        session.connection().connection.cursor().execute("ANALYZE movies.movies, movies.movie_overviews, movies.movie_actors")
+        session.commit()
+        print(f"Built a catalog of {movies} movies in {time.perf_counter() - started:.1f}s")
+    finally:
+        session.close()
+
+
+class FakeOpenAI:
+    # stands in for openai.OpenAI: completions.create() sleeps `latency` seconds (plus up to `jitter`) and answers like
+    # the model would for main.py's prompts, without any network: the quoted name for a correction, the query itself for
+    # a keyword, a JSON array of genres for a batch
+    def __init__(self, latency=0.3, jitter=0.0, seed=SEED):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self.completions = types.SimpleNamespace(create=self.create)
+
+    def create(self, model, prompt, max_tokens, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency + self._rng.uniform(0, self.jitter))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(text=self.answer(prompt))])
+
+    @staticmethod
+    def answer(prompt):
+        batch = re.search(r'Input: (\[.*\])', prompt)
+        if batch:
+            return json.dumps(['Drama'] * len(json.loads(batch.group(1))))
+        query = re.search(r'User Query: "(.*)"', prompt)
+        if query:
+            return query.group(1)
+        quoted = re.findall(r"'([^']*)'", prompt)
+        return quoted[-1] if quoted else 'Drama'
+
+
+def sample_values(session, count, seed=SEED):
+    # `count` dicts of real values of the catalog for QUERY_TEMPLATES
+    rng = random.Random(seed)
+    rows = session.execute(text(
+        "SELECT movie_name, release_year, director_name, top_5_actors FROM movies.movies "
+        "WHERE top_5_actors <> '{}' ORDER BY md5(id::text) LIMIT :count"), {'count': count}).fetchall()
+    genre_names = list(GENRES.values())
+    values = []
+    for movie_name, release_year, director_name, top_5_actors in rows:
+        from_year = rng.randint(1950, 2010)
+        values.append({
+            'title': movie_name, 'title_words': ' '.join(movie_name.split()[:2]).lower(), 'year': release_year,
+            'director': director_name, 'actor': rng.choice(top_5_actors), 'from_year': from_year, 'to_year': from_year + 15,
+            'rating': rng.choice((5, 6.5, 8)), 'genre': rng.choice(genre_names), 'genre2': rng.choice(genre_names),
+            'word': rng.choice(OVERVIEW_WORDS[3:]), 'word2': rng.choice(OVERVIEW_WORDS[3:]),
+        })
+    return values
+
+
+def percentiles(times):
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1e3
+    return round(float(p50), 3), round(float(p95), 3), round(float(p99), 3)
+
+
+def run(queries=50, llm_latency=0.3, llm_jitter=0.0, concurrency=1, cache=False, intents=None, seed=SEED):
+    if not cache:
+        os.environ['CORRECTION_CACHE_DISABLED'] = '1'
+        os.environ['RESULT_CACHE_DISABLED'] = '1'
+    import main  # imported here: after use_database() and the cache switches above
+    from queries import Page
+    from query_router import route_query
+    from tracing import tracer
+    fake = FakeOpenAI(llm_latency, llm_jitter, seed)
+    main.llm.client = fake
+    with contextlib.redirect_stdout(sys.stderr):  # stdout is for the JSON report
+        main.warm_up()
+
+    session = config.SessionLocal()
+    try:
+        movies = session.execute(text("SELECT COUNT(*) FROM movies.movies")).scalar()
+        values = sample_values(session, queries, seed)
+    finally:
+        session.close()
+    if not values:
+        raise SystemExit("The benchmark catalog is empty: run `python benchmark.py build` first")
+
+    def answer(query):
+        # traced like a query of main() when TRACING=1 (tracing.py): the JSON lines break every query down by stage
+        started = time.perf_counter()
+        with tracer.query(query) as trace:
+            with tracer.span('route'):
+                route = route_query(query)
+            trace.set(intent=route.intent)
+            page = Page()
+            for _ in main.stream_answer(route, page):
+                pass
+        return route.intent, time.perf_counter() - started, page.count
+
+    report = {
+        'commit': git_commit(), 'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'config': {'movies': movies, 'queries': len(values), 'llm_latency': llm_latency, 'llm_jitter': llm_jitter,
+                   'concurrency': concurrency, 'cache': cache, 'seed': seed},
+        'intents': {},
+    }
+    with contextlib.redirect_stdout(io.StringIO()) as output, concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        for intent, template in QUERY_TEMPLATES.items():
+            if intents and intent not in intents:
+                continue
+            samples = [template.format(**value) for value in values]
+            answer(samples[0])  # warm-up: the local indexes of the intent are loaded outside the measurement
+            output.seek(0)
+            output.truncate()  # the searches' own diagnostics are dropped
+            calls = fake.calls
+            started = time.perf_counter()
+            results = list(pool.map(answer, samples))
+            elapsed = time.perf_counter() - started
+            times = [seconds for _, seconds, _ in results]
+            p50, p95, p99 = percentiles(times)
+            report['intents'][intent] = {
+                'queries': len(results), 'routed': sum(routed == intent for routed, _, _ in results),
+                'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'mean_ms': round(float(np.mean(times)) * 1e3, 3),
+                'throughput_qps': round(len(results) / elapsed, 2), 'rows_mean': round(float(np.mean([rows for _, _, rows in results])), 2),
+                'llm_calls': fake.calls - calls,
+            }
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, threshold=1.1):
+    # prints p50 / p95 / throughput of both reports per intent ; returns the intents whose p95 grew beyond threshold
+    print(f"{'intent':<16} {'p50 ms':>17} {'p95 ms':>17} {'qps':>15}   ({before['commit']} -> {after['commit']})")
+    regressions = []
+    for intent, new in after['intents'].items():
+        old = before['intents'].get(intent)
+        if old is None:
+            continue
+        ratio = new['p95_ms'] / old['p95_ms'] if old['p95_ms'] else 1.0
+        if ratio > threshold:
+            regressions.append(intent)
+        print(f"{intent:<16} {old['p50_ms']:>8.2f} {new['p50_ms']:>8.2f} {old['p95_ms']:>8.2f} {new['p95_ms']:>8.2f} "
+              f"{old['throughput_qps']:>7.1f} {new['throughput_qps']:>7.1f}   p95 x{ratio:.2f}{'  <- slower' if ratio > threshold else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the searches on a synthetic catalog')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='generate the synthetic catalog')
+    build_parser.add_argument('--movies', type=int, default=10000)
+    run_parser = commands.add_parser('run', help='measure every intent')
+    run_parser.add_argument('--queries', type=int, default=50, help='queries per intent')
+    run_parser.add_argument('--llm-latency', type=float, default=0.3, help='seconds per fake completion')
+    run_parser.add_argument('--llm-jitter', type=float, default=0.0, help='up to this many seconds more, at random')
+    run_parser.add_argument('--concurrency', type=int, default=1, help='queries in flight')
+    run_parser.add_argument('--cache', action='store_true', help='keep the correction and result caches on')
+    run_parser.add_argument('--intent', action='append', help='only this intent (repeatable)')
+    run_parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    for command_parser in (build_parser, run_parser):
+        command_parser.add_argument('--database-url', help='default: BENCH_DATABASE_URL')
+        command_parser.add_argument('--seed', type=int, default=SEED)
+    compare_parser = commands.add_parser('compare', help='compare two run reports')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=1.1, help='p95 ratio counted as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.before, encoding='utf-8') as before, open(args.after, encoding='utf-8') as after:
+            regressions = compare(json.load(before), json.load(after), args.threshold)
+        return 1 if regressions else 0
+
+    use_database(bench_database_url(args.database_url))
+    if args.command == 'build':
+        build(args.movies, args.seed)
+        return 0
+    report = run(args.queries, args.llm_latency, args.llm_jitter, args.concurrency, args.cache, args.intent, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
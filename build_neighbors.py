@@ -0,0 +1,272 @@
+import sys
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+from sqlalchemy.sql import text
+
+from config import SessionLocal
+from result_cache import bump_catalog_version
+from semantic_index import EMBED_BATCH, HashingEmbedder
+
+# Offline job for movies.movie_neighbors (see migrations/0004_movie_neighbors.sql): the NEIGHBORS most similar movies
+# of every movie, so "movies like X" is one indexed lookup instead of a genre scan per request.
+# Similarity of two movies, between 0 and 1:
+#   GENRE_WEIGHT    * Jaccard overlap of their genre ids
+#   DIRECTOR_WEIGHT * same director
+#   CAST_WEIGHT     * share of the billed actors they have in common
+#   OVERVIEW_WEIGHT * cosine similarity of their overviews (hashing embedder of semantic_index.py)
+# Movies are scored in blocks of BLOCK_SIZE against the catalog, COLUMN_CHUNK movies at a time (matrix products +
+# argpartition top-k, merged with the best of the chunks before), so the score matrices stay BLOCK_SIZE x COLUMN_CHUNK
+# (32 MB each) however large the catalog ; every block is committed on its own, so the table stays usable (and the job
+# restartable) while it runs.
+#
+#   python build_neighbors.py                 -> recompute every movie
+#   python build_neighbors.py --incremental   -> the stale lists, and the existing lists a new or changed movie now
+#                                                belongs to
+# Every list records the revision of its movie it was computed from (movies.neighbors_revision, migrations/0009): the
+# writers of a movie move its revision, so a list is stale when the revisions differ, when it was never computed, when
+# it holds a movie that changed since (its score there is the old one) or when a deleted neighbor left a gap in it.
+
+NEIGHBORS = 20
+BLOCK_SIZE = 256
+COLUMN_CHUNK = 32768
+GENRE_WEIGHT = 0.5
+DIRECTOR_WEIGHT = 0.15
+CAST_WEIGHT = 0.2
+OVERVIEW_WEIGHT = 0.15
+
+MOVIES_QUERY = """
+    SELECT m.id, m.genre_ids, m.director_name, o.overview, m.revision, m.neighbors_revision FROM movies.movies m
+    LEFT JOIN movies.movie_overviews o ON o.movie_id = m.id ORDER BY m.id
+"""
+ACTORS_QUERY = "SELECT movie_id, actor_name_normalized FROM movies.movie_actors"
+LISTS_QUERY = "SELECT movie_id, rank, neighbor_id, score FROM movies.movie_neighbors ORDER BY movie_id, rank"
+
+
+class MovieFeatures:
+    # every signal of every movie, position i = i-th movie id of movie_ids
+    def __init__(self, session):
+        started = time.perf_counter()
+        rows = session.execute(text(MOVIES_QUERY)).fetchall()
+        self.movie_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.position = {movie_id: i for i, movie_id in enumerate(self.movie_ids.tolist())}
+        # revision of every movie as read here, and the one its list was computed from (-1: never)
+        self.revisions = np.array([row[4] for row in rows], dtype=np.int64)
+        self.neighbors_revisions = np.array([-1 if row[5] is None else row[5] for row in rows], dtype=np.int64)
+        count = len(rows)
+
+        genre_columns = {genre_id: column for column, genre_id in enumerate(sorted({g for row in rows for g in row[1] or ()}))}
+        self.genres = np.zeros((count, max(1, len(genre_columns))), dtype=np.float32)
+        for i, row in enumerate(rows):
+            for genre_id in row[1] or ():
+                self.genres[i, genre_columns[genre_id]] = 1
+        self.genre_counts = self.genres.sum(axis=1)
+
+        director_codes = {}
+        self.directors = np.array([
+            -1 if not row[2] or row[2] == 'Unknown' else director_codes.setdefault(row[2], len(director_codes))
+            for row in rows
+        ], dtype=np.int32)
+
+        # actor -> positions of its movies, and the actors of every movie
+        self.actor_movies = {}
+        self.movie_actors = [[] for _ in range(count)]
+        for movie_id, actor_name in session.execute(text(ACTORS_QUERY)).fetchall():
+            if movie_id in self.position:
+                self.actor_movies.setdefault(actor_name, []).append(self.position[movie_id])
+                self.movie_actors[self.position[movie_id]].append(actor_name)
+        self.actor_movies = {actor: np.array(positions, dtype=np.int64) for actor, positions in self.actor_movies.items()}
+
+        overviews = [row[3] or '' for row in rows]
+        embedder = HashingEmbedder()
+        embedder.fit(overviews)
+        self.overviews = np.vstack([embedder.embed(overviews[start:start + EMBED_BATCH]) for start in range(0, count, EMBED_BATCH)]) \
+            if count else np.zeros((0, embedder.dimension), dtype=np.float32)
+        print(f"Loaded the features of {count} movies in {time.perf_counter() - started:.1f}s")
+
+    def scores(self, sources, targets=None):
+        # (len(sources) x len(targets)) similarities ; sources are positions, targets positions or a slice of them
+        # (None = every movie)
+        target_genres = self.genres if targets is None else self.genres[targets]
+        target_counts = self.genre_counts if targets is None else self.genre_counts[targets]
+        shared_genres = self.genres[sources] @ target_genres.T
+        union = self.genre_counts[sources][:, None] + target_counts[None, :] - shared_genres
+        scores = GENRE_WEIGHT * np.divide(shared_genres, union, out=np.zeros_like(shared_genres), where=union > 0)
+
+        target_directors = self.directors if targets is None else self.directors[targets]
+        source_directors = self.directors[sources][:, None]
+        scores += DIRECTOR_WEIGHT * ((source_directors == target_directors[None, :]) & (source_directors >= 0))
+
+        target_overviews = self.overviews if targets is None else self.overviews[targets]
+        scores += OVERVIEW_WEIGHT * (self.overviews[sources] @ target_overviews.T)
+
+        # shared cast through the actor postings (a handful of movies per actor) rather than a dense actor matrix
+        column = None
+        if isinstance(targets, slice):
+            first, stop = targets.start, targets.stop
+        elif targets is not None:
+            column = np.full(len(self.movie_ids), -1, dtype=np.int64)
+            column[targets] = np.arange(len(targets))
+        for row, source in enumerate(sources):
+            actors = self.movie_actors[source]
+            for actor in actors:
+                shared = self.actor_movies[actor]
+                if isinstance(targets, slice):
+                    shared = shared[(shared >= first) & (shared < stop)] - first
+                elif column is not None:
+                    shared = column[shared]
+                    shared = shared[shared >= 0]
+                scores[row, shared] += CAST_WEIGHT / max(len(actors), 1)
+        return scores
+
+
+def top_k(scores, positions, k):
+    # the k best of every row: (scores, positions), both (rows x min(k, columns)), in no particular order
+    if scores.shape[1] <= k:
+        return scores, positions
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(positions, top, axis=1)
+
+
+def top_neighbors(features, sources, k=NEIGHBORS):
+    # [(movie_id, rank, neighbor_id, score)] of every source, scored against the catalog COLUMN_CHUNK movies at a time
+    count = len(features.movie_ids)
+    k = min(k, count - 1)
+    if k <= 0:
+        return []
+    best_scores = np.empty((len(sources), 0), dtype=np.float32)
+    best_positions = np.empty((len(sources), 0), dtype=np.int64)
+    for first in range(0, count, COLUMN_CHUNK):
+        stop = min(first + COLUMN_CHUNK, count)
+        scores = features.scores(sources, slice(first, stop))
+        own = np.flatnonzero((sources >= first) & (sources < stop))
+        scores[own, sources[own] - first] = -1  # a movie is not its own neighbor
+        positions = np.broadcast_to(np.arange(first, stop, dtype=np.int64), scores.shape)
+        chunk_scores, chunk_positions = top_k(scores, positions, k)
+        best_scores, best_positions = top_k(np.concatenate([best_scores, chunk_scores], axis=1),
+                                            np.concatenate([best_positions, chunk_positions], axis=1), k)
+    rows = []
+    for row, source in enumerate(sources):
+        order = np.lexsort((features.movie_ids[best_positions[row]], -best_scores[row]))
+        rows.extend(
+            (int(features.movie_ids[source]), rank, int(features.movie_ids[best_positions[row, i]]), float(best_scores[row, i]))
+            for rank, i in enumerate(order, 1) if best_scores[row, i] > 0
+        )
+    return rows
+
+
+def write_neighbors(session, movie_ids, rows, revisions=None):
+    # replaces the neighbor lists of movie_ids by rows, in one transaction ; revisions: the movie revisions the lists
+    # were computed from (recorded as their neighbors_revision)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute("DELETE FROM movies.movie_neighbors WHERE movie_id = ANY(%s)", (list(movie_ids),))
+        execute_values(cursor, "INSERT INTO movies.movie_neighbors (movie_id, rank, neighbor_id, score) VALUES %s", rows, page_size=1000)
+        if revisions is not None:
+            execute_values(cursor, """
+                UPDATE movies.movies m SET neighbors_revision = computed.revision
+                FROM (VALUES %s) AS computed (movie_id, revision) WHERE m.id = computed.movie_id
+            """, list(zip(movie_ids, revisions)), page_size=1000)
+        bump_catalog_version(cursor)  # "movies like X" answered from the cache must see the new lists
+    finally:
+        cursor.close()
+    session.commit()
+
+
+def build(session, features, positions):
+    started = time.perf_counter()
+    written = 0
+    for start in range(0, len(positions), BLOCK_SIZE):
+        sources = positions[start:start + BLOCK_SIZE]
+        rows = top_neighbors(features, sources)
+        write_neighbors(session, features.movie_ids[sources].tolist(), rows, features.revisions[sources].tolist())
+        written += len(rows)
+        print(f"{min(start + BLOCK_SIZE, len(positions))}/{len(positions)} movies, {written} neighbor rows")
+    print(f"Computed the neighbors of {len(positions)} movies in {time.perf_counter() - started:.1f}s")
+
+
+def stored_lists(session):
+    # {movie_id: [(neighbor_id, score)] best first}, and the movies whose list has a gap (a neighbor was deleted)
+    lists, gaps = {}, set()
+    for movie_id, rank, neighbor_id, score in session.execute(text(LISTS_QUERY)).fetchall():
+        current = lists.setdefault(movie_id, [])
+        current.append((neighbor_id, score))
+        if rank != len(current):
+            gaps.add(movie_id)
+    return lists, gaps
+
+
+def stale_positions(features, lists, gaps):
+    # positions of the lists to compute again, and of the new or changed movies among them
+    changed = np.flatnonzero(features.revisions != features.neighbors_revisions)
+    changed_ids = set(features.movie_ids[changed].tolist())
+    stale = set(changed.tolist())
+    stale.update(
+        features.position[movie_id] for movie_id, current in lists.items()
+        if movie_id in features.position and (movie_id in gaps or any(neighbor_id in changed_ids for neighbor_id, _ in current))
+    )
+    return np.array(sorted(stale), dtype=np.int64), changed
+
+
+def update_existing(session, features, lists, new_positions):
+    # the existing lists a new or changed movie now belongs to: its score beats the list's last entry (or the list
+    # isn't full) ; lists: the ones that are otherwise current
+    existing = np.array([features.position[movie_id] for movie_id in lists if movie_id in features.position], dtype=np.int64)
+    changed = 0
+    for start in range(0, len(existing), BLOCK_SIZE):
+        sources = existing[start:start + BLOCK_SIZE]
+        floors = [lists[movie_id][-1][1] if len(lists[movie_id]) >= NEIGHBORS else 0 for movie_id in features.movie_ids[sources].tolist()]
+        entering = [{} for _ in sources]  # neighbor id -> score, of the new movies that beat the floor of the list
+        for first in range(0, len(new_positions), COLUMN_CHUNK):
+            chunk = new_positions[first:first + COLUMN_CHUNK]
+            scores = features.scores(sources, chunk)
+            scores[sources[:, None] == chunk[None, :]] = -1  # a movie is not its own neighbor
+            chunk_scores, chunk_positions = top_k(scores, np.broadcast_to(chunk, scores.shape), NEIGHBORS)
+            for row, floor in enumerate(floors):
+                better = np.flatnonzero(chunk_scores[row] > floor)
+                entering[row].update((int(features.movie_ids[chunk_positions[row, i]]), float(chunk_scores[row, i])) for i in better)
+        rows = []
+        for row, source in enumerate(sources):
+            if not entering[row]:
+                continue
+            movie_id = int(features.movie_ids[source])
+            merged = dict(lists[movie_id])
+            merged.update(entering[row])
+            merged = sorted(merged.items(), key=lambda neighbor: (-neighbor[1], neighbor[0]))
+            rows.extend((movie_id, rank, neighbor_id, score) for rank, (neighbor_id, score) in enumerate(merged[:NEIGHBORS], 1))
+        if rows:
+            changed_ids = sorted({row[0] for row in rows})
+            write_neighbors(session, changed_ids, rows)
+            changed += len(changed_ids)
+    print(f"Updated the neighbor lists of {changed} existing movies")
+
+
+def main(argv):
+    session = SessionLocal()
+    try:
+        features = MovieFeatures(session)
+        if '--incremental' in argv:
+            lists, gaps = stored_lists(session)
+            stale, changed = stale_positions(features, lists, gaps)
+            print(f"{len(changed)} new or changed movie(s), {len(stale)} stale neighbor list(s)")
+            if len(stale) == 0:
+                return 0
+            stale_ids = set(features.movie_ids[stale].tolist())
+            current = {movie_id: neighbors for movie_id, neighbors in lists.items() if movie_id not in stale_ids}
+            if current and len(changed):
+                update_existing(session, features, current, changed)
+            build(session, features, stale)
+        else:
+            build(session, features, np.arange(len(features.movie_ids)))
+        return 0
+    except Exception as e:
+        session.rollback()
+        print(f"ERROR in computing movie neighbors: {e}")
+        return 1
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,175 @@
+import time
+from collections import namedtuple
+
+from psycopg2.extras import execute_values
+
+from movie_actors import replace_movie_actors
+from result_cache import bump_catalog_version
+
+# Bulk writer of the ingest: a batch of movies is stored with a handful of statements instead of an INSERT ... RETURNING,
+# a second INSERT (and, in the date range script, an existence SELECT) per movie:
+#   1. old rows without tmdb_id that match a staged movie by (movie_name, release_year) get its tmdb_id (one UPDATE)
+#   2. movies.movies: one multi-row INSERT ... ON CONFLICT (tmdb_id) DO UPDATE ... RETURNING id, tmdb_id ; a row only
+#      changes when one of its values does (the ids of the unchanged movies are looked up afterwards), and gets a new
+#      revision when its genres, director or cast do, so build_neighbors.py --incremental recomputes its list
+#      (migrations/0009) but not for a new rating
+#   3. movies.movie_overviews: one multi-row upsert on movie_id ; a changed overview moves the movie's revision too
+#   4. movies.movie_actors: replaced for the new, changed and claimed movies (movie_actors.replace_movie_actors)
+#   5. movies.catalog_version + 1 when any of that changed something, so the searches drop their cached results
+#      (result_cache.py) ; re-crawling a page TMDB didn't change leaves the cache alone
+# Writing the same movie twice updates it (see migrations/0005_tmdb_id.sql), so a page can always be re-run.
+# delete() removes movies TMDB no longer has (sync.py): their overviews, then the movies themselves (movie_actors and
+# movie_neighbors follow through ON DELETE CASCADE), and moves the catalog version too.
+# execute_values rather than COPY: COPY can neither upsert nor return the generated ids without a staging table.
+
+PAGE_SIZE = 1000  # rows per multi-row statement
+
+# one movie as the ingest stores it ; built from a TMDB discover result by movie_record()
+MovieRecord = namedtuple('MovieRecord', [
+    'tmdb_id', 'movie_name', 'tmdb_rating', 'genre', 'release_year', 'director_name', 'top_5_actors', 'genre_ids', 'overview',
+])
+
+CLAIM_LEGACY_ROWS = """
+    UPDATE movies.movies m SET tmdb_id = staged.tmdb_id
+    FROM (VALUES %s) AS staged (tmdb_id, movie_name, release_year)
+    WHERE m.id = (
+        SELECT MIN(legacy.id) FROM movies.movies legacy
+        WHERE legacy.tmdb_id IS NULL AND legacy.movie_name = staged.movie_name
+          AND legacy.release_year IS NOT DISTINCT FROM staged.release_year
+    )
+    AND NOT EXISTS (SELECT 1 FROM movies.movies known WHERE known.tmdb_id = staged.tmdb_id)
+    RETURNING m.id
+"""
+
+UPSERT_MOVIES = """
+    INSERT INTO movies.movies (tmdb_id, movie_name, tmdb_rating, genre, release_year, director_name, top_5_actors, genre_ids)
+    VALUES %s
+    ON CONFLICT (tmdb_id) DO UPDATE SET
+        movie_name = EXCLUDED.movie_name, tmdb_rating = EXCLUDED.tmdb_rating, genre = EXCLUDED.genre,
+        release_year = EXCLUDED.release_year, director_name = EXCLUDED.director_name,
+        top_5_actors = EXCLUDED.top_5_actors, genre_ids = EXCLUDED.genre_ids,
+        revision = movies.revision + CASE WHEN (movies.genre_ids, movies.director_name, movies.top_5_actors)
+            IS DISTINCT FROM (EXCLUDED.genre_ids, EXCLUDED.director_name, EXCLUDED.top_5_actors) THEN 1 ELSE 0 END
+    WHERE (movies.movie_name, movies.tmdb_rating, movies.genre, movies.release_year, movies.director_name,
+           movies.top_5_actors, movies.genre_ids)
+        IS DISTINCT FROM (EXCLUDED.movie_name, EXCLUDED.tmdb_rating, EXCLUDED.genre, EXCLUDED.release_year,
+                          EXCLUDED.director_name, EXCLUDED.top_5_actors, EXCLUDED.genre_ids)
+    RETURNING id, tmdb_id
+"""
+
+UPSERT_OVERVIEWS = """
+    INSERT INTO movies.movie_overviews (movie_id, movie_name, overview)
+    VALUES %s
+    ON CONFLICT (movie_id) DO UPDATE SET movie_name = EXCLUDED.movie_name, overview = EXCLUDED.overview
+    WHERE (movie_overviews.movie_name, movie_overviews.overview) IS DISTINCT FROM (EXCLUDED.movie_name, EXCLUDED.overview)
+    RETURNING movie_id
+"""
+
+STORED_MOVIE_IDS = "SELECT id, tmdb_id FROM movies.movies WHERE tmdb_id = ANY(%s)"
+
+REVISE_MOVIES = "UPDATE movies.movies SET revision = revision + 1 WHERE id = ANY(%s)"
+
+
+DELETE_OVERVIEWS = """
+    DELETE FROM movies.movie_overviews WHERE movie_id IN (SELECT id FROM movies.movies WHERE tmdb_id = ANY(%s))
+"""
+
+DELETE_MOVIES = "DELETE FROM movies.movies WHERE tmdb_id = ANY(%s)"
+
+
+def movie_record(movie, genre_names, director_name, top_actors):
+    # movie: one result of /discover/movie ; genre_names / director_name / top_actors: from the genre list and the credits
+    tmdb_rating = movie.get('vote_average')
+    if tmdb_rating is not None and tmdb_rating > 9.99:
+        tmdb_rating = 9.99  # the column is DECIMAL(3, 2): a 10 would raise NumericValueOutOfRange
+    release_date = movie.get('release_date')
+    return MovieRecord(
+        tmdb_id=movie['id'],
+        movie_name=movie['title'],
+        tmdb_rating=tmdb_rating,
+        genre=', '.join(genre_names),
+        release_year=int(release_date.split('-')[0]) if release_date else None,
+        director_name=director_name,
+        top_5_actors=top_actors,
+        genre_ids=sorted(movie.get('genre_ids', [])),
+        overview=movie.get('overview', ''),
+    )
+
+
+class BulkWriter:
+    def __init__(self, conn):
+        self.conn = conn  # psycopg2 connection
+        self.stats = {'batches': 0, 'movies': 0, 'unchanged': 0, 'claimed': 0, 'deleted': 0, 'seconds': 0.0}
+
+    def write(self, records, commit=True):
+        # upserts records (MovieRecord) with their overviews and actors ; returns {tmdb_id: movie id}
+        # commit=False leaves the transaction open, for callers that commit more than the movies with them
+        started = time.perf_counter()
+        # a movie can show up twice in a batch (discover pages shift while they are crawled) ; ON CONFLICT can't touch
+        # the same row twice in one statement, so the last copy wins
+        records = list({record.tmdb_id: record for record in records}.values())
+        if not records:
+            return {}
+        try:
+            with self.conn.cursor() as cur:
+                claimed = execute_values(cur, CLAIM_LEGACY_ROWS, [(r.tmdb_id, r.movie_name, r.release_year) for r in records],
+                                         template='(%s::int, %s, %s::int)', page_size=PAGE_SIZE, fetch=True)
+                returned = execute_values(cur, UPSERT_MOVIES, [
+                    (r.tmdb_id, r.movie_name, r.tmdb_rating, r.genre, r.release_year, r.director_name, r.top_5_actors, r.genre_ids)
+                    for r in records
+                ], template='(%s, %s, %s, %s, %s, %s, %s::text[], %s::smallint[])', page_size=PAGE_SIZE, fetch=True)
+                movie_ids = {tmdb_id: movie_id for movie_id, tmdb_id in returned}
+                changed = set(movie_ids.values())  # inserted or updated
+                unchanged = [r.tmdb_id for r in records if r.tmdb_id not in movie_ids]
+                if unchanged:
+                    cur.execute(STORED_MOVIE_IDS, (unchanged,))
+                    movie_ids.update((tmdb_id, movie_id) for movie_id, tmdb_id in cur.fetchall())
+                overviews = execute_values(cur, UPSERT_OVERVIEWS, [(movie_ids[r.tmdb_id], r.movie_name, r.overview) for r in records],
+                                           page_size=PAGE_SIZE, fetch=True)
+                revised = {movie_id for movie_id, in overviews} - changed
+                if revised:
+                    cur.execute(REVISE_MOVIES, (list(revised),))
+                actors = changed | {movie_id for movie_id, in claimed}  # a claimed legacy row may have no actor rows yet
+                replace_movie_actors(cur, {movie_ids[r.tmdb_id]: r.top_5_actors for r in records if movie_ids[r.tmdb_id] in actors},
+                                     page_size=PAGE_SIZE)
+                if changed or revised or claimed:
+                    bump_catalog_version(cur)  # last: the version row stays locked until the commit
+            if commit:
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.stats['batches'] += 1
+        self.stats['movies'] += len(records)
+        self.stats['unchanged'] += len(records) - len(changed | revised)
+        self.stats['claimed'] += len(claimed)
+        self.stats['seconds'] += time.perf_counter() - started
+        return movie_ids
+
+    def delete(self, tmdb_ids, commit=True):
+        # deletes the movies of tmdb_ids (and what hangs off them) ; returns the number of movies deleted
+        tmdb_ids = list(tmdb_ids)
+        if not tmdb_ids:
+            return 0
+        started = time.perf_counter()
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(DELETE_OVERVIEWS, (tmdb_ids,))
+                cur.execute(DELETE_MOVIES, (tmdb_ids,))
+                deleted = cur.rowcount
+                if deleted:
+                    bump_catalog_version(cur)
+            if commit:
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.stats['deleted'] += deleted
+        self.stats['seconds'] += time.perf_counter() - started
+        return deleted
+
+    def report(self):
+        seconds = self.stats['seconds']
+        rate = self.stats['movies'] / seconds if seconds else 0.0
+        return (f"wrote {self.stats['movies']} movies in {self.stats['batches']} batches, {seconds:.2f}s in the database "
+                f"({rate:.0f} rows/s), {self.stats['unchanged']} unchanged ; {self.stats['claimed']} existing rows matched to their TMDB id, {self.stats['deleted']} deleted")
@@ -0,0 +1,300 @@
+import os
+import re
+import threading
+import time
+
+from sqlalchemy.sql import text
+
+from genres import GENRE_BITS
+from queries import BY_RATING, KEYSET_STATEMENTS, MOVIE_COLUMNS, STATEMENTS, MovieRow
+from result_cache import read_catalog_version
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency: without NumPy every search simply stays on the SQL path
+    np = None
+
+# In-memory columnar catalog engine.
+# Every search intent is a filter on year / rating / genres / director / actor followed by ORDER BY tmdb_rating DESC
+# LIMIT k. On a read-mostly catalog of a few hundred thousand rows, answering that from NumPy arrays in the process is much
+# cheaper than a round trip to Postgres. The engine loads movies.movies (and movies.movie_actors) once, keeps one array
+# per filtered column and runs the statements of queries.py as vectorized boolean masks:
+#   - rating: int16 hundredths of a point (DECIMAL(3, 2) exactly, so "above 8.37" draws the same line as Postgres ; -1 = NULL) ;
+#     the float8 ratings of the rows are rounded back to their hundredths
+#   - year: int16 (-1 = NULL)
+#   - director: dictionary encoded ; the ILIKE runs over the few thousand distinct names, then np.isin over the codes
+#   - genres: one bitmask per movie, genre_ids @> ARRAY[...] becomes (bits & wanted) == wanted
+#   - actors: dictionary encoded (n_movies x billing positions) id matrix built from movies.movie_actors
+# The arrays are stored in BY_RATING order, so for the rating-ordered statements the first k positions of the mask
+# ARE the top k ; the title statements (ordered by pg_trgm similarity) use an argpartition top-k instead.
+# Pages after the first (queries.Page) work the same way: the keyset (rating, id) of the last row shown is one more
+# mask, and a title page at an offset is the top offset + k with the first offset rows cut off.
+# The engine returns the very rows the SQL path returns (MovieRows: same columns, float ratings, actor lists), only faster.
+#
+# Selected per deployment with SEARCH_ENGINE=memory (default: sql). Intents the engine can't answer (overview needs the
+# overviews table) and any failure to load fall back to the prepared SQL statements. The catalog is a snapshot taken
+# on first use, along with the catalog version it was taken at (result_cache.py) ; when the version moves,
+# main.refresh_snapshots() swaps in reloaded(), a new engine with a new snapshot.
+
+SEARCH_ENGINE = os.getenv('SEARCH_ENGINE', 'sql').lower()
+SUPPORTED_INTENTS = {
+    'title', 'top_year', 'actor', 'actor_range', 'director', 'director_range', 'director_rating',
+    'genres', 'genre_rating', 'similar_source', 'similar',
+}
+NULL_VALUE = -1  # stands for a NULL rating / year / director in the int arrays ; never matches a filter
+MAX_GENRE_BITS = 63  # genre bitmasks are int64
+
+CATALOG_QUERY = f"SELECT {MOVIE_COLUMNS}, genre_ids FROM movies.movies {BY_RATING}"
+ACTORS_QUERY = "SELECT movie_id, actor_name_normalized, billing_order FROM movies.movie_actors"
+LIMIT = re.compile(r'LIMIT (\d+)')
+
+
+def pg_trgm_similarity_trigrams(value):
+    # trigrams the way pg_trgm extracts them: lowercased alphanumeric words, each padded with two spaces in front and
+    # one behind ("cat" -> "  c", " ca", "cat", "at "), duplicates removed
+    found = set()
+    for word in re.findall(r'[^\W_]+', value.lower()):
+        padded = f'  {word} '
+        found.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return found
+
+
+def contained_term(pattern):
+    # inverse of queries.contains_pattern(): '%nolan\_x%' -> 'nolan_x'
+    return re.sub(r'\\(.)', r'\1', pattern[1:-1])
+
+
+class CatalogEngine:
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.loaded = False
+        self.failed = False
+        self.version = None  # catalog version of the snapshot (None: unknown, e.g. no movies.catalog_version table)
+        self._lock = threading.Lock()
+        self._title_postings = None  # trigram index of the titles, built the first time a title is ranked
+
+    def supports(self, intent):
+        return np is not None and intent in SUPPORTED_INTENTS and not self.failed
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return True
+        with self._lock:
+            if not self.loaded and not self.failed:
+                session = self.session_factory()
+                try:
+                    self.version = read_catalog_version(session)  # read first: a write after it makes the snapshot newer, never older
+                    self.load(session.execute(text(CATALOG_QUERY)).fetchall(), session.execute(text(ACTORS_QUERY)).fetchall())
+                except Exception as e:
+                    self.failed = True  # from now on every search takes the SQL path
+                    print(f"ERROR in loading the in-memory catalog, falling back to SQL: {e}")
+                finally:
+                    session.close()
+        return self.loaded
+
+    def reloaded(self):
+        # a new engine with a snapshot of the current catalog ; this one keeps answering until the caller swaps them
+        fresh = CatalogEngine(self.session_factory)
+        fresh.ensure_loaded()
+        return fresh
+
+    def load(self, catalog_rows, actor_rows):
+        # catalog_rows: (MOVIE_COLUMNS..., genre_ids) in BY_RATING order ; actor_rows: (movie_id, normalized name, billing_order)
+        started = time.perf_counter()
+        self.rows = [MovieRow._make(row[:7]) for row in catalog_rows]  # exactly what the SQL statements return
+        self.genre_ids = [row[7] or [] for row in catalog_rows]
+        count = len(self.rows)
+
+        self.ids = np.fromiter((row[0] for row in self.rows), dtype=np.int64, count=count)
+        self.names = np.array([row[1] or '' for row in self.rows], dtype=str)
+        self.names_lower = np.char.lower(self.names)
+        self.ratings = np.fromiter((NULL_VALUE if row[2] is None else round(row[2] * 100) for row in self.rows), dtype=np.int16, count=count)
+        self.years = np.fromiter((NULL_VALUE if row[4] is None else row[4] for row in self.rows), dtype=np.int16, count=count)
+
+        directors = sorted({row[5] for row in self.rows if row[5] is not None})
+        director_codes = {director: code for code, director in enumerate(directors)}
+        self.directors_lower = np.char.lower(np.array(directors, dtype=str))
+        self.directors = np.fromiter((director_codes.get(row[5], NULL_VALUE) for row in self.rows), dtype=np.int32, count=count)
+
+        # genre bits: the 19 TMDB genres of genres.py first, then whatever other ids the catalog holds
+        self.genre_bits = dict(GENRE_BITS)
+        for genre_ids in self.genre_ids:
+            for genre_id in genre_ids:
+                if genre_id not in self.genre_bits and len(self.genre_bits) < MAX_GENRE_BITS:
+                    self.genre_bits[genre_id] = len(self.genre_bits)
+        self.genres_complete = all(genre_id in self.genre_bits for genre_ids in self.genre_ids for genre_id in genre_ids)
+        self.genres = np.fromiter((self._genre_mask(genre_ids) for genre_ids in self.genre_ids), dtype=np.int64, count=count)
+
+        position = {movie_id: i for i, movie_id in enumerate(self.ids.tolist())}
+        width = max((billing_order for _, _, billing_order in actor_rows), default=1)
+        self.actor_codes = {}
+        self.actors = np.full((count, width), NULL_VALUE, dtype=np.int32)
+        for movie_id, actor_name, billing_order in actor_rows:
+            if movie_id in position:
+                code = self.actor_codes.setdefault(actor_name, len(self.actor_codes))
+                self.actors[position[movie_id], billing_order - 1] = code
+
+        self._title_postings = None
+        self.loaded = True
+        print(f"Loaded {count} movies into the in-memory catalog in {time.perf_counter() - started:.2f}s")
+
+    def _genre_mask(self, genre_ids):
+        mask = 0
+        for genre_id in genre_ids:
+            if genre_id in self.genre_bits:
+                mask |= 1 << self.genre_bits[genre_id]
+        return mask
+
+    def execute(self, intent, params):
+        # rows of the intent's statement for these params, or None when the SQL path has to answer instead
+        if not self.supports(intent) or not self.ensure_loaded():
+            return None
+        statement = STATEMENTS[intent]
+        limit = params['limit'] if 'limit' in statement.args else int(LIMIT.search(statement.sql).group(1))
+        offset = params.get('offset', 0) if 'offset' in statement.args else 0
+
+        if intent in ('title', 'similar_source'):
+            positions = self._by_similarity(self._title_mask(params['pattern']), params['term'], offset + limit)[offset:]
+            if intent == 'similar_source':
+                return [(self.genre_ids[i],) for i in positions]
+            return [self.rows[i] for i in positions]
+
+        if intent in ('genres', 'genre_rating', 'similar'):
+            if not self.genres_complete or any(genre_id not in self.genre_bits for genre_id in params['genre_ids'] or ()):
+                return None  # ids outside the bitmask: only Postgres can answer exactly
+            wanted = self._genre_mask(params['genre_ids'] or ())
+            mask = (self.genres & wanted) == wanted
+            if intent == 'similar':
+                mask &= self.names != params['movie_name']
+        elif intent in ('actor', 'actor_range'):
+            code = self.actor_codes.get(params['actor_name'])
+            if code is None:
+                return []
+            mask = (self.actors == code).any(axis=1)
+        elif intent in ('director', 'director_range', 'director_rating'):
+            matching = np.flatnonzero(np.char.find(self.directors_lower, contained_term(params['pattern']).lower()) >= 0)
+            mask = np.isin(self.directors, matching)
+        else:  # top_year
+            mask = self.years == params['year']
+
+        if 'from_year' in params and intent.endswith('_range'):
+            mask &= (self.years >= params['from_year']) & (self.years <= params['to_year'])
+        if 'rating_min' in params and intent.endswith('_rating'):
+            mask &= (self.ratings > float(params['rating_min'] * 100)) & (self.ratings < float(params['rating_max'] * 100))
+            mask &= self.ratings != NULL_VALUE
+        if intent in KEYSET_STATEMENTS:
+            # after the last row shown: COALESCE(tmdb_rating, -1) < rating OR (= rating AND id > after_id)
+            after_rating = params['after_rating']
+            key = NULL_VALUE if after_rating < 0 else int(round(after_rating * 100))
+            mask &= (self.ratings < key) | ((self.ratings == key) & (self.ids > params['after_id']))
+        # positions are in BY_RATING order already: the first `limit` matches are the answer
+        return [self.rows[i] for i in np.flatnonzero(mask)[:limit]]
+
+    def _title_mask(self, pattern):
+        # movie_name ILIKE '%term%'
+        return np.char.find(self.names_lower, contained_term(pattern).lower()) >= 0
+
+    def _by_similarity(self, mask, term, limit):
+        # ORDER BY similarity(movie_name, term) DESC, id LIMIT limit over the positions of mask
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return []
+        similarity = self._similarities(term)[candidates]
+        if len(candidates) > limit:
+            # argpartition finds the limit-th best similarity ; every candidate at least that similar (ties included)
+            # goes on to the exact sort, so the id tie-break stays the same as in Postgres
+            kth = -np.partition(-similarity, limit - 1)[limit - 1]
+            keep = similarity >= kth
+            candidates, similarity = candidates[keep], similarity[keep]
+        order = np.lexsort((self.ids[candidates], -similarity))
+        return candidates[order[:limit]].tolist()
+
+    def _similarities(self, term):
+        # pg_trgm similarity of every title to term: shared trigrams / (trigrams of title + trigrams of term - shared),
+        # in float4 like Postgres ; the shared counts come from a trigram -> positions index of the titles
+        if self._title_postings is None:
+            with self._lock:
+                if self._title_postings is None:
+                    postings = {}
+                    sizes = np.zeros(len(self.rows), dtype=np.int32)
+                    for i, row in enumerate(self.rows):
+                        title_trigrams = pg_trgm_similarity_trigrams(row[1] or '')
+                        sizes[i] = len(title_trigrams)
+                        for trigram in title_trigrams:
+                            postings.setdefault(trigram, []).append(i)
+                    self._title_sizes = sizes
+                    self._title_postings = {trigram: np.array(positions, dtype=np.int32) for trigram, positions in postings.items()}
+        term_trigrams = pg_trgm_similarity_trigrams(term)
+        hits = [self._title_postings[trigram] for trigram in term_trigrams if trigram in self._title_postings]
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.rows)) if hits else np.zeros(len(self.rows), dtype=np.int64)
+        union = self._title_sizes + len(term_trigrams) - shared
+        similarity = np.zeros(len(self.rows), dtype=np.float32)
+        np.divide(shared.astype(np.float32), union.astype(np.float32), out=similarity, where=union > 0)
+        return similarity
+
+
+def catalog_from_env(session_factory):
+    # the engine selected by SEARCH_ENGINE, or None for the plain SQL path
+    if SEARCH_ENGINE != 'memory':
+        return None
+    if np is None:
+        print("SEARCH_ENGINE=memory needs NumPy (pip install numpy) ; searching through SQL instead")
+        return None
+    return CatalogEngine(session_factory)
+
+
+if __name__ == "__main__":
+    # python catalog_engine.py [rounds]  -> loads the catalog, checks every supported statement against Postgres and times both
+    import sys
+    from config import SessionLocal
+    from queries import Page, contains_pattern, execute_statement
+
+    engine = CatalogEngine(SessionLocal)
+    if not engine.ensure_loaded():
+        raise SystemExit(1)
+    sample = engine.rows[len(engine.rows) // 2]
+    title_word = (sample[1] or 'the').split()[0]
+    director = sample[5] or 'Unknown'
+    actor = next(iter(engine.actor_codes), '')
+    genre_ids = sorted(engine.genre_ids[0])[:2]
+    checks = [
+        ('title', {'pattern': contains_pattern(title_word), 'term': title_word}),
+        ('similar_source', {'pattern': contains_pattern(title_word), 'term': title_word}),
+        ('top_year', {'year': sample[4] or 2010, 'limit': 5}),
+        ('actor', {'actor_name': actor}),
+        ('actor_range', {'actor_name': actor, 'from_year': 1990, 'to_year': 2020}),
+        ('director', {'pattern': contains_pattern(director)}),
+        ('director_range', {'pattern': contains_pattern(director), 'from_year': 1990, 'to_year': 2020}),
+        ('director_rating', {'pattern': contains_pattern(director), 'rating_min': -1, 'rating_max': sample[2] or 5}),
+        ('genres', {'genre_ids': genre_ids}),
+        ('genre_rating', {'genre_ids': genre_ids, 'rating_min': sample[2] or 5, 'rating_max': 11}),
+        ('similar', {'genre_ids': genre_ids, 'movie_name': sample[1]}),
+    ]
+    # the first page of each statement, then (for the rating-ordered ones) the page after its first 3 rows
+    checks = [(intent, dict(params, **Page().params(intent))) if intent != 'similar_source' else (intent, params) for intent, params in checks]
+    for intent, params in list(checks):
+        if intent in KEYSET_STATEMENTS:
+            first = engine.execute(intent, dict(params, limit=3))
+            if len(first) == 3:
+                page = Page(3, intent)
+                list(page.rows(first))
+                following = page.next().params(intent)
+                checks.append((intent, dict(params, after_rating=following['after_rating'], after_id=following['after_id'])))
+        elif intent == 'title':
+            checks.append((intent, dict(params, offset=3)))
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    session = SessionLocal()
+    try:
+        for intent, params in checks:
+            started = time.perf_counter()
+            for _ in range(rounds):
+                expected = execute_statement(session, intent, params).fetchall()
+            sql_time = (time.perf_counter() - started) / rounds
+            started = time.perf_counter()
+            for _ in range(rounds):
+                rows = engine.execute(intent, params)
+            memory_time = (time.perf_counter() - started) / rounds
+            state = 'same rows' if rows == [tuple(row) for row in expected] else 'DIFFERENT ROWS'
+            print(f"{intent:<16} sql {sql_time * 1e3:7.2f} ms   memory {memory_time * 1e3:7.2f} ms   {len(expected):3d} rows  {state}")
+    finally:
+        session.close()
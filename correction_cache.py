@@ -0,0 +1,188 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cache for the complete_correct* LLM calls of main.py.
+# The same handful of titles, actors and genres make up most queries, so instead of paying a network round trip
+# (and tokens) for every identical correction we remember the answer in two tiers:
+#   1. an in-process LRU (OrderedDict) for the hottest entries, and
+#   2. an on-disk SQLite table that survives restarts, with TTL and size based eviction.
+# Entries are keyed by (kind, normalized input, model, prompt version); bumping the prompt version in main.py
+# therefore silently invalidates every answer that was produced by an older prompt.
+#
+# Configuration through environment variables:
+#   CORRECTION_CACHE_DISABLED=1     -> bypass the cache completely (every lookup is a miss, nothing is stored)
+#   CORRECTION_CACHE_PATH           -> location of the SQLite file (default: .cache/corrections.sqlite3 next to this file)
+#   CORRECTION_CACHE_TTL            -> seconds an on-disk entry stays valid (default: 7 days)
+#   CORRECTION_CACHE_MEMORY_SIZE    -> max entries of the in-process LRU tier (default: 1024)
+#   CORRECTION_CACHE_DISK_SIZE      -> max entries of the on-disk tier (default: 50000)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'corrections.sqlite3')
+EVICTION_INTERVAL = 100  # run the (relatively expensive) disk eviction sweep only once every 100 writes
+
+
+def normalize_input(value):
+    # "  Christopher   NOLAN " , "'christopher nolan'" and "christopher nolan" must all share one cache entry
+    value = str(value).strip().strip('"\'').strip()
+    return re.sub(r'\s+', ' ', value).lower()
+
+
+class CorrectionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, memory_size=1024, disk_size=50000, ttl_seconds=7 * 24 * 3600, enabled=True):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (corrected_value, stored_at) ; most recently used entries at the end
+        self._lock = threading.Lock()  # the LLM client may fan corrections out over several threads
+        self._db = None
+        self._writes_since_eviction = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def _connection(self):
+        # opening the SQLite file lazily, so importing main.py never touches the disk when the cache is bypassed
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS corrections (
+                    kind TEXT NOT NULL,
+                    input TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    corrected TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (kind, input, model, prompt_version)
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS corrections_last_used ON corrections (last_used)")
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key, corrected, stored_at):
+        self._memory[key] = (corrected, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)  # dropping the least recently used entry
+            self.stats['evictions'] += 1
+
+    def get(self, kind, value, model, prompt_version):
+        if not self.enabled:
+            return None
+        key = (kind, normalize_input(value), model, str(prompt_version))
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                corrected, stored_at = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return corrected
+                del self._memory[key]  # expired in memory ; the disk copy is just as old, so it's expired as well
+
+            try:
+                db = self._connection()
+                row = db.execute(
+                    "SELECT corrected, stored_at FROM corrections WHERE kind = ? AND input = ? AND model = ? AND prompt_version = ?",
+                    key,
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    db.execute(
+                        "UPDATE corrections SET last_used = ? WHERE kind = ? AND input = ? AND model = ? AND prompt_version = ?",
+                        (now,) + key,
+                    )
+                    db.commit()
+                    self._remember(key, row[0], row[1])  # promoting the entry into the in-process tier
+                    self.stats['disk_hits'] += 1
+                    return row[0]
+            except sqlite3.Error as e:
+                print(f"ERROR in reading correction cache: {e}")  # a broken cache file must never break searching
+
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, kind, value, model, prompt_version, corrected):
+        if not self.enabled or not corrected:
+            return
+        key = (kind, normalize_input(value), model, str(prompt_version))
+        now = time.time()
+        with self._lock:
+            self._remember(key, corrected, now)
+            self.stats['stores'] += 1
+            try:
+                db = self._connection()
+                db.execute(
+                    "INSERT OR REPLACE INTO corrections (kind, input, model, prompt_version, corrected, stored_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    key + (corrected, now, now),
+                )
+                db.commit()
+                self._writes_since_eviction += 1
+                if self._writes_since_eviction >= EVICTION_INTERVAL:
+                    self._evict_disk(now)
+            except sqlite3.Error as e:
+                print(f"ERROR in writing correction cache: {e}")
+
+    def _evict_disk(self, now):
+        # first dropping everything older than the TTL, then trimming the least recently used rows down to disk_size
+        db = self._connection()
+        expired = db.execute("DELETE FROM corrections WHERE stored_at < ?", (now - self.ttl_seconds,)).rowcount
+        overflow = db.execute("SELECT COUNT(*) FROM corrections").fetchone()[0] - self.disk_size
+        if overflow > 0:
+            db.execute(
+                "DELETE FROM corrections WHERE rowid IN (SELECT rowid FROM corrections ORDER BY last_used LIMIT ?)",
+                (overflow,),
+            )
+        db.commit()
+        self.stats['evictions'] += expired + max(overflow, 0)
+        self._writes_since_eviction = 0
+
+    def flush(self):
+        # emptying both tiers (e.g. after the catalog or the prompts changed in a way the prompt version doesn't capture)
+        with self._lock:
+            self._memory.clear()
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM corrections")
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"ERROR in flushing correction cache: {e}")
+
+    def hit_ratio(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        lookups = hits + self.stats['misses']
+        return hits / lookups if lookups else 0.0
+
+
+def cache_from_env():
+    return CorrectionCache(
+        path=os.getenv('CORRECTION_CACHE_PATH', DEFAULT_CACHE_PATH),
+        memory_size=int(os.getenv('CORRECTION_CACHE_MEMORY_SIZE', 1024)),
+        disk_size=int(os.getenv('CORRECTION_CACHE_DISK_SIZE', 50000)),
+        ttl_seconds=float(os.getenv('CORRECTION_CACHE_TTL', 7 * 24 * 3600)),
+        enabled=os.getenv('CORRECTION_CACHE_DISABLED', '0').lower() not in ('1', 'true', 'yes'),
+    )
+
+
+# shared instance used by main.py
+correction_cache = cache_from_env()
+
+
+if __name__ == "__main__":
+    # python correction_cache.py --flush   -> empty the cache
+    # python correction_cache.py           -> show how many corrections are stored on disk
+    import sys
+    if '--flush' in sys.argv:
+        correction_cache.flush()
+        print(f"Correction cache flushed: {correction_cache.path}")
+    else:
+        count = correction_cache._connection().execute("SELECT COUNT(*) FROM corrections").fetchone()[0]
+        print(f"{count} corrections stored in {correction_cache.path}")
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from config import SessionLocal
+
+# Session / connection manager of the search paths.
+# config.SessionLocal is rebound here to an engine whose pool is sized and checked for a long running search process:
+#   DB_POOL_SIZE (5) connections kept open, DB_MAX_OVERFLOW (10) extra ones under bursts, DB_POOL_TIMEOUT (10 s) wait
+#   for a free connection before giving up, DB_POOL_RECYCLE (1800 s) max age of a connection, and a pre-ping on every
+#   checkout so a connection the server dropped is replaced instead of failing the search.
+# Every search runs inside session_scope(), which always hands the connection back to the pool (the search functions
+# used to open a session per call and never close it) and measures how long the checkout waited.
+# warm_up() opens the pool's connections (and prepares the search statements on them) before the first query.
+
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+
+# the same database as config.py, through a tuned pool ; every SessionLocal() of the project now checks out from it
+engine = create_engine(
+    SessionLocal.kw['bind'].url,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+SessionLocal.configure(bind=engine)
+
+# checkouts: connections handed out ; wait_seconds_*: time session_scope() waited for its connection ;
+# exhausted: checkouts that found every connection (pool + overflow) busy ; timeouts: checkouts that gave up waiting
+pool_stats = {
+    'checkouts': 0, 'checkins': 0, 'connects': 0, 'invalidated': 0,
+    'scopes': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0, 'exhausted': 0, 'timeouts': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        pool_stats[name] += amount
+
+
+@event.listens_for(engine, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    _count('connects')
+
+
+@event.listens_for(engine, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _count('checkouts')
+
+
+@event.listens_for(engine, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    _count('checkins')
+
+
+@event.listens_for(engine, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    _count('invalidated')
+
+
+@contextmanager
+def session_scope():
+    # with session_scope() as session: ...  -> the session's connection goes back to the pool when the block ends,
+    # whatever happens inside ; searches only read, so nothing is committed
+    if engine.pool.checkedout() >= POOL_SIZE + MAX_OVERFLOW:
+        _count('exhausted')
+    session = SessionLocal()
+    started = time.perf_counter()
+    try:
+        session.connection()  # check out now, so the wait for a free connection is measured here
+    except PoolTimeoutError:
+        _count('timeouts')
+        session.close()
+        raise
+    except Exception:
+        session.close()
+        raise
+    waited = time.perf_counter() - started
+    with _stats_lock:
+        pool_stats['scopes'] += 1
+        pool_stats['wait_seconds_total'] += waited
+        pool_stats['wait_seconds_max'] = max(pool_stats['wait_seconds_max'], waited)
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def warm_up(connections=POOL_SIZE, prepare=True):
+    # opens `connections` pooled connections at once (so the first queries don't pay the handshakes) and prepares the
+    # search statements on each of them ; returns how many connections were opened
+    from queries import STATEMENTS, _prepare
+    started = time.perf_counter()
+    opened = []
+    try:
+        for _ in range(connections):
+            connection = engine.connect()
+            opened.append(connection)
+            if prepare:
+                for statement in STATEMENTS.values():
+                    if statement.name in connection.info.get('prepared_statements', ()):
+                        continue
+                    try:
+                        _prepare(connection, statement)
+                    except Exception as e:  # e.g. a table of a migration not applied yet ; that search prepares on first use
+                        connection.rollback()
+                        print(f"Warm-up could not prepare {statement.name}: {str(e).splitlines()[0]}")
+                connection.commit()
+    except Exception as e:
+        print(f"ERROR in warming up the connection pool: {e}")
+    finally:
+        for connection in opened:
+            connection.close()
+    print(f"Warmed up {len(opened)} database connection(s) in {time.perf_counter() - started:.2f}s")
+    return len(opened)
+
+
+def pool_metrics():
+    # counters since startup plus the current state of the pool
+    with _stats_lock:
+        metrics = dict(pool_stats)
+    metrics['wait_seconds_avg'] = metrics['wait_seconds_total'] / metrics['scopes'] if metrics['scopes'] else 0.0
+    metrics['pool_size'] = engine.pool.size()
+    metrics['checked_out'] = engine.pool.checkedout()
+    metrics['idle'] = engine.pool.checkedin()
+    metrics['overflow'] = max(0, engine.pool.overflow())
+    return metrics
+
+
+def format_pool_metrics():
+    metrics = pool_metrics()
+    return (f"pool: {metrics['checkouts']} checkouts, {metrics['connects']} connects, "
+            f"wait avg {metrics['wait_seconds_avg'] * 1e3:.2f} ms / max {metrics['wait_seconds_max'] * 1e3:.2f} ms, "
+            f"{metrics['exhausted']} exhausted, {metrics['timeouts']} timeouts, "
+            f"{metrics['checked_out']} checked out / {metrics['idle']} idle / {metrics['overflow']} overflow")
+
+
+if __name__ == "__main__":
+    # python db.py [threads] [queries]  -> warms the pool up and runs concurrent scopes to show the metrics under load
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy.sql import text
+
+    warm_up()
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    def one_query(_):
+        with session_scope() as session:
+            session.execute(text("SELECT pg_sleep(0.002)"))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one_query, range(queries)))
+    print(f"{queries} queries over {threads} threads in {time.perf_counter() - started:.2f}s")
+    print(format_pool_metrics())
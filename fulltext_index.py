@@ -0,0 +1,219 @@
+import math
+import sys
+import threading
+import time
+
+from sqlalchemy.sql import text
+
+from result_cache import read_catalog_version
+from semantic_index import content_words  # same stop words and stemming as the plot search
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency: without NumPy keyword search over overviews is simply unavailable
+    np = None
+
+# In-process full-text index of titles and overviews with BM25 ranking.
+# Titles were the only text ever matched, so "heist" or "submarine" found nothing unless it was in a title. This index
+# maps every (stemmed) word of a movie's title and overview to the movies containing it:
+#   - postings are compact NumPy arrays: sorted uint32 movie positions + the BM25 score of the word in that movie,
+#     precomputed at build time and quantized to one byte ("impact"), so a query only adds small integers
+#   - top-k uses MaxScore: words are scored from the most to the least valuable one, and as soon as the words left can't
+#     lift an unseen movie above the current k-th score, the rest only updates the movies already in the running
+#     (binary searched in their postings) instead of walking whole posting lists
+# Title words count TITLE_WEIGHT times. The index is built from the database on first use (a snapshot, like the
+# in-memory catalog, along with the catalog version it was read at) ; when the version moves, main.refresh_snapshots()
+# swaps in reloaded(), a new index of the current titles and overviews.
+#
+#   python fulltext_index.py "submarine heist"
+#   python fulltext_index.py bench [max_documents]   -> build time, size and p50/p95/p99 query latency as the corpus grows
+
+K1 = 1.2
+B = 0.75
+TITLE_WEIGHT = 2
+IMPACT_LEVELS = 255  # impacts are quantized to uint8
+
+DOCUMENTS_QUERY = """
+    SELECT m.id, m.movie_name, o.overview FROM movies.movies m
+    LEFT JOIN movies.movie_overviews o ON o.movie_id = m.id ORDER BY m.id
+"""
+
+
+class FullTextIndex:
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self.loaded = False
+        self.failed = False
+        self.version = None  # catalog version of the snapshot
+        self._lock = threading.Lock()
+        self.stats = {'queries': 0, 'postings_scored': 0, 'postings_skipped': 0}
+
+    def ensure_loaded(self):
+        if self.loaded or self.session_factory is None:
+            return self.loaded
+        with self._lock:
+            if not self.loaded and not self.failed:
+                if np is None:
+                    self.failed = True
+                    print("Keyword search over overviews needs NumPy (pip install numpy)")
+                    return False
+                session = self.session_factory()
+                try:
+                    started = time.perf_counter()
+                    self.version = read_catalog_version(session)  # read first: a write after it makes the snapshot newer, never older
+                    self.build(session.execute(text(DOCUMENTS_QUERY)).fetchall())
+                    print(f"Indexed {len(self.movie_ids)} movies for keyword search in {time.perf_counter() - started:.2f}s")
+                except Exception as e:
+                    self.failed = True
+                    print(f"ERROR in building the keyword index: {e}")
+                finally:
+                    session.close()
+        return self.loaded
+
+    def build(self, documents):
+        # documents: (movie_id, title, overview) rows
+        term_frequencies = []
+        lengths = []
+        self.movie_ids = []
+        for movie_id, title, overview in documents:
+            frequencies = {}
+            for word in content_words(title or ''):
+                frequencies[word] = frequencies.get(word, 0) + TITLE_WEIGHT
+            for word in content_words(overview or ''):
+                frequencies[word] = frequencies.get(word, 0) + 1
+            self.movie_ids.append(movie_id)
+            term_frequencies.append(frequencies)
+            lengths.append(sum(frequencies.values()))
+        self._index(term_frequencies, lengths)
+
+    def _index(self, term_frequencies, lengths):
+        count = len(term_frequencies)
+        average_length = (sum(lengths) / count) if count else 1.0
+        postings = {}
+        for position, frequencies in enumerate(term_frequencies):
+            for word, frequency in frequencies.items():
+                postings.setdefault(word, []).append((position, frequency))
+
+        # BM25 of every (word, movie) pair, then one global scale so that the best pair of the corpus is IMPACT_LEVELS
+        scored = {}
+        best = 0.0
+        for word, entries in postings.items():
+            idf = math.log(1 + (count - len(entries) + 0.5) / (len(entries) + 0.5))
+            scores = [
+                idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * lengths[position] / average_length))
+                for position, frequency in entries
+            ]
+            scored[word] = ([position for position, _ in entries], scores)
+            best = max(best, max(scores))
+        self.scale = (best / IMPACT_LEVELS) if best else 1.0
+        self.postings = {}
+        self.upper_bounds = {}
+        for word, (positions, scores) in scored.items():
+            impacts = np.clip(np.rint(np.array(scores) / self.scale), 1, IMPACT_LEVELS).astype(np.uint8)
+            self.postings[word] = (np.array(positions, dtype=np.uint32), impacts)
+            self.upper_bounds[word] = int(impacts.max())
+        self.movie_id_array = np.array(self.movie_ids, dtype=np.int64)
+        self.loaded = True
+
+    def reloaded(self):
+        # a new index of the current catalog ; this one keeps answering until the caller swaps them
+        fresh = FullTextIndex(self.session_factory)
+        fresh.ensure_loaded()
+        return fresh
+
+    def memory_bytes(self):
+        return sum(positions.nbytes + impacts.nbytes for positions, impacts in self.postings.values())
+
+    def search(self, query, k=10, prune=True):
+        # [(movie_id, BM25 score)] of the k best movies for the words of query, best first (ties: lowest movie id)
+        if not self.ensure_loaded():
+            return []
+        words = sorted({word for word in content_words(query) if word in self.postings}, key=lambda word: (-self.upper_bounds[word], word))
+        if not words:
+            return []
+        self.stats['queries'] += 1
+        scores = np.zeros(len(self.movie_ids), dtype=np.int32)
+        remaining = sum(self.upper_bounds[word] for word in words)  # best score a movie could still gain
+        threshold = 0
+        candidates = None  # once set, only these movies can still make the top k
+        for word in words:
+            positions, impacts = self.postings[word]
+            if prune and candidates is None and remaining < threshold:
+                candidates = np.flatnonzero(scores)
+            if candidates is not None:
+                # MaxScore: an unseen movie can't reach the threshold any more ; drop the candidates that can't either
+                candidates = candidates[scores[candidates] + remaining >= threshold]
+                found = np.searchsorted(positions, candidates)
+                inside = found < len(positions)
+                hits = inside.copy()
+                hits[inside] = positions[found[inside]] == candidates[inside]
+                touched = candidates[hits]
+                scores[touched] += impacts[found[hits]]
+                self.stats['postings_scored'] += len(candidates)
+                self.stats['postings_skipped'] += len(positions) - len(touched)
+            else:
+                touched = positions
+                scores[positions] += impacts
+                self.stats['postings_scored'] += len(positions)
+            remaining -= self.upper_bounds[word]
+            if prune and len(touched) >= k:
+                # the k-th best score among the movies this word touched is a lower bound of the real k-th best score
+                # (scores only grow), and it costs the length of one posting list instead of the whole corpus
+                touched_scores = scores[touched]
+                threshold = max(threshold, int(np.partition(touched_scores, len(touched_scores) - k)[len(touched_scores) - k]))
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            kth = np.partition(scores[matched], len(matched) - k)[len(matched) - k]
+            matched = matched[scores[matched] >= kth]
+        movie_ids = self.movie_id_array[matched]
+        order = np.lexsort((movie_ids, -scores[matched]))[:k]
+        return [(int(movie_ids[i]), float(scores[matched[i]] * self.scale)) for i in order]
+
+
+def bench(documents, max_documents, queries=200, k=10, seed=0):
+    # grows the corpus by doubling (beyond the real movies: new documents mixing the words of random real overviews)
+    # and reports build time, posting size and query latency percentiles with and without MaxScore pruning
+    rng = np.random.default_rng(seed)
+    vocabulary = [content_words(overview or '') for _, _, overview in documents]
+    vocabulary = [words for words in vocabulary if words]
+    size = min(1000, max_documents)
+    while True:
+        corpus = list(documents[:size])
+        while len(corpus) < size:
+            words = vocabulary[rng.integers(len(vocabulary))] + vocabulary[rng.integers(len(vocabulary))]
+            corpus.append((len(corpus) + 1_000_000, '', ' '.join(rng.permutation(words)[:max(5, len(words) // 2)])))
+        index = FullTextIndex()
+        started = time.perf_counter()
+        index.build(corpus)
+        build_time = time.perf_counter() - started
+        samples = [' '.join(rng.choice(words, min(len(words), rng.integers(1, 4)), replace=False)) for words in
+                   (vocabulary[i] for i in rng.integers(len(vocabulary), size=queries))]
+        line = f"{size:>9} docs  build {build_time:6.2f}s  postings {index.memory_bytes() / 1e6:7.2f} MB"
+        for label, prune in (('exhaustive', False), ('maxscore', True)):
+            times = []
+            for sample in samples:
+                started = time.perf_counter()
+                index.search(sample, k, prune=prune)
+                times.append(time.perf_counter() - started)
+            p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1e3
+            line += f"  | {label} p50 {p50:6.3f} p95 {p95:6.3f} p99 {p99:6.3f} ms"
+        print(line)
+        if size >= max_documents:
+            break
+        size = min(size * 2, max_documents)
+
+
+if __name__ == "__main__":
+    from config import SessionLocal
+    session = SessionLocal()
+    try:
+        rows = session.execute(text(DOCUMENTS_QUERY)).fetchall()
+    finally:
+        session.close()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(rows, int(sys.argv[2]) if len(sys.argv) > 2 else 128000)
+    else:
+        index = FullTextIndex()
+        index.build(rows)
+        for movie_id, score in index.search(' '.join(sys.argv[1:]) or 'heist'):
+            print(f"{score:6.2f}  movie {movie_id}")
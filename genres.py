@@ -0,0 +1,98 @@
+import re
+
+from name_corrector import NameIndex, normalize_name
+
+# TMDB's movie genre list (https://api.themoviedb.org/3/genre/movie/list) is a closed vocabulary of 19 genres,
+# so there's no need to ask the LLM to correct a genre name: we resolve it locally against this table.
+# The ids are TMDB's own ids ; they are what populate_movies*.py stores in movies.movies.genre_ids (SMALLINT[])
+# so genre filters become an indexable array containment: genre_ids @> ARRAY[28, 35]
+GENRES = {
+    28: 'Action',
+    12: 'Adventure',
+    16: 'Animation',
+    35: 'Comedy',
+    80: 'Crime',
+    99: 'Documentary',
+    18: 'Drama',
+    10751: 'Family',
+    14: 'Fantasy',
+    36: 'History',
+    27: 'Horror',
+    10402: 'Music',
+    9648: 'Mystery',
+    10749: 'Romance',
+    878: 'Science Fiction',
+    10770: 'TV Movie',
+    53: 'Thriller',
+    10752: 'War',
+    37: 'Western',
+}
+GENRE_IDS = {name: genre_id for genre_id, name in GENRES.items()}
+
+# the ways users actually type genres that aren't just a spelling mistake of the TMDB name
+ALIASES = {
+    'sci fi': 878, 'scifi': 878, 'sf': 878, 'science fiction': 878,
+    'romantic': 10749, 'romcom': 10749, 'rom com': 10749,
+    'animated': 16, 'cartoon': 16, 'anime': 16,
+    'documentaries': 99, 'docu': 99,
+    'musical': 10402, 'musicals': 10402,
+    'historical': 36, 'period': 36,
+    'tv': 10770, 'tv movie': 10770, 'tv movies': 10770,
+    'comedies': 35, 'funny': 35,
+    'scary': 27,
+    'kids': 10751, 'family friendly': 10751,
+    'mysteries': 9648,
+}
+
+# bit position of every genre, for compact in-process genre sets (an int with one bit per genre)
+GENRE_BITS = {genre_id: bit for bit, genre_id in enumerate(sorted(GENRES))}
+
+MIN_GENRE_CONFIDENCE = 0.7  # genre names are short, one typo in "drma" is already 25% of the word
+
+_vocabulary = NameIndex([(name, 1) for name in GENRES.values()] + [(alias, 1) for alias in ALIASES])
+_lookup = {normalize_name(name): genre_id for genre_id, name in GENRES.items()}
+_lookup.update(ALIASES)
+
+
+def resolve_genre(token):
+    # returns the TMDB genre id for a user typed genre ("thriler", "sci-fi", "comedies") or None when it isn't a genre
+    key = normalize_name(token)
+    if not key:
+        return None
+    if key in _lookup:
+        return _lookup[key]
+    if key.endswith('s') and key[:-1] in _lookup:  # "thrillers", "westerns", "dramas"
+        return _lookup[key[:-1]]
+    corrected, confidence = _vocabulary.correct(key)
+    if corrected is not None and confidence >= MIN_GENRE_CONFIDENCE:
+        return _lookup[normalize_name(corrected)]
+    return None
+
+
+def split_genres(genre_string):
+    # "action, comedy and thriller" -> ['action', 'comedy', 'thriller']
+    return [genre.strip() for genre in re.split(r',\s*|\s+and\s+', genre_string) if genre.strip()]
+
+
+def resolve_genres(genre_list):
+    # resolves every token ; returns (sorted unique genre ids, tokens that aren't any known genre)
+    genre_ids, unknown = set(), []
+    for token in genre_list:
+        genre_id = resolve_genre(token)
+        if genre_id is None:
+            unknown.append(token)
+        else:
+            genre_ids.add(genre_id)
+    return sorted(genre_ids), unknown
+
+
+def genre_names(genre_ids):
+    return [GENRES[genre_id] for genre_id in genre_ids if genre_id in GENRES]
+
+
+def genre_mask(genre_ids):
+    mask = 0
+    for genre_id in genre_ids or ():
+        if genre_id in GENRE_BITS:
+            mask |= 1 << GENRE_BITS[genre_id]
+    return mask
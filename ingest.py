@@ -0,0 +1,210 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+
+import psycopg2
+
+from bulk_writer import BulkWriter, movie_record
+from ingest_checkpoints import IngestCheckpoints, date_range, ingest_page, now
+from tmdb_client import TMDBClient, cache_from_env, director_name, top_actors
+from tmdb_fetcher import TMDB_API_KEY, SharedTokenBucket, TMDBFetcher
+
+# One entry point for the TMDB crawl (populate_movies.py and populate_movies_DateRange.py are thin wrappers around it).
+# /discover/movie never returns more than MAX_PAGES pages, so a wide date range used to be truncated silently. Here:
+#   - a date range is split in two, recursively, until each shard fits under MAX_PAGES (its page count comes from its
+#     first discover page ; a single day that still doesn't fit is crawled as far as TMDB allows and flagged)
+#   - the shards are crawled by a pool of worker processes sharing ONE rate budget (a token bucket in shared memory,
+#     tmdb_fetcher.SharedTokenBucket) ; each worker fetches with its own threads and database connection
+#   - every page is written and checkpointed in one transaction (ingest_checkpoints.py), --resume skips stored pages
+#   - at the end: per shard coverage, the movies TMDB announced vs. the movies stored from the shard's pages
+#
+#   python ingest.py --start 2000-01-01 --end 2023-12-31 [--workers 4] [--resume]
+#   python ingest.py --popular 500 [--resume]        -> the first pages by popularity, no date range
+#   python ingest.py --start 2000-01-01 --plan       -> only print the shards
+
+DB_HOST = 'localhost'
+DB_NAME = 'movies_db'
+DB_USER = 'postgres'
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+
+MAX_PAGES = 500  # TMDB's cap on the pages of one discover query
+RESULTS_PER_PAGE = 20
+FIRST_RELEASE = '1874-01-01'  # default start of a full crawl
+WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+
+
+def connect():
+    return psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+
+def discover_params(start_date=None, end_date=None):
+    params = {'sort_by': 'popularity.desc'}
+    if start_date:
+        params['primary_release_date.gte'] = start_date
+    if end_date:
+        params['primary_release_date.lte'] = end_date
+    return params
+
+
+def range_size(client, start_date=None, end_date=None):
+    # (total_pages, total_results) of a discover query, from its first page (which the response cache keeps for the
+    # worker that crawls the range)
+    data = client.discover_page(1, discover_params(start_date, end_date))
+    return data.get('total_pages', 0), data.get('total_results', 0)
+
+
+def plan_shards(client, start_date, end_date):
+    # [(start_date, end_date, total_pages, total_results, truncated)] covering start_date..end_date, each under MAX_PAGES
+    total_pages, total_results = range_size(client, start_date, end_date)
+    start, end = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    if total_pages <= MAX_PAGES or start >= end:
+        return [(start_date, end_date, min(total_pages, MAX_PAGES), total_results, total_pages > MAX_PAGES)]
+    middle = start + (end - start) // 2
+    return (plan_shards(client, start_date, middle.isoformat())
+            + plan_shards(client, (middle + datetime.timedelta(days=1)).isoformat(), end_date))
+
+
+# per worker process state, set up by init_worker
+_worker = {}
+
+
+def init_worker(bucket, resume):
+    fetcher = TMDBFetcher(TMDB_API_KEY, bucket=bucket)
+    conn = connect()
+    _worker.update(
+        client=TMDBClient(fetcher, cache_from_env()),
+        conn=conn,
+        writer=BulkWriter(conn),
+        checkpoints=IngestCheckpoints(conn),
+        resume=resume,
+    )
+
+
+def movie_records(client, movies):
+    # MovieRecords of the movies of a page ; their details (with credits) are fetched concurrently
+    def credits(movie_id):
+        try:
+            return client.movie_details(movie_id).get('credits', {})
+        except Exception as e:
+            print(f"Failed to fetch credits of movie {movie_id}: {e}")
+            return {}
+    movie_credits = list(client.map(credits, [movie['id'] for movie in movies]))
+    return [
+        movie_record(movie, client.genre_names(movie.get('genre_ids', [])), director_name(movie_credit), top_actors(movie_credit))
+        for movie, movie_credit in zip(movies, movie_credits)
+    ]
+
+
+def crawl(client, conn, writer, checkpoints, start_date, end_date, pages, resume, batch_size=100):
+    # fetches and stores `pages` of a discover query ; returns (pages stored, pages failed)
+    key = date_range(start_date, end_date)
+    pages = list(pages)
+    if resume:
+        pages = checkpoints.pending_pages(key, pages)
+    stored = failed = 0
+    for batch_start in range(0, len(pages), batch_size):
+        batch = pages[batch_start:batch_start + batch_size]
+        started_at = now()
+        for page, movies in client.fetch_pages(batch, discover_params(start_date, end_date)):
+            if movies is None:
+                checkpoints.mark_failed(key, page, 'fetch failed', started_at)
+                failed += 1
+            elif ingest_page(conn, writer, checkpoints, key, page, movie_records(client, movies), started_at):
+                stored += 1
+            else:
+                failed += 1
+    return stored, failed
+
+
+def crawl_shard(shard):
+    # runs in a worker process: crawls every page of one shard
+    start_date, end_date, total_pages = shard[:3]
+    started = time.perf_counter()
+    try:
+        stored, failed = crawl(_worker['client'], _worker['conn'], _worker['writer'], _worker['checkpoints'],
+                               start_date, end_date, range(1, total_pages + 1), _worker['resume'])
+    except Exception as e:
+        print(f"ERROR in crawling {start_date} .. {end_date}: {e}")
+        stored, failed = 0, total_pages
+    print(f"{start_date} .. {end_date}: {stored} pages stored, {failed} failed in {time.perf_counter() - started:.0f}s "
+          f"({_worker['client'].fetcher.report()})")
+    return shard, stored, failed
+
+
+def coverage(conn, shards):
+    # [(shard, movies stored from its pages)] ; stored counts what the checkpoints say was written for the shard
+    stored = {}
+    with conn.cursor() as cur:
+        cur.execute("SELECT range_start::text, range_end::text, SUM(movies) FROM movies.ingest_checkpoints WHERE status = 'done' GROUP BY 1, 2")
+        for range_start, range_end, movies in cur.fetchall():
+            stored[(range_start, range_end)] = movies or 0
+    conn.commit()
+    return [(shard, stored.get(date_range(shard[0], shard[1]), 0)) for shard in shards]
+
+
+def print_coverage(rows):
+    expected_total = stored_total = 0
+    for (start_date, end_date, total_pages, total_results, truncated), stored in rows:
+        expected = min(total_results, total_pages * RESULTS_PER_PAGE)  # what the crawled pages can hold
+        expected_total += expected
+        stored_total += stored
+        share = stored / expected if expected else 1.0
+        note = f"  (over TMDB's page cap: {total_results - expected} movies unreachable)" if truncated else ''
+        print(f"{start_date or '-'} .. {end_date or '-'}: {stored}/{expected} movies ({share:.1%}), {total_pages} pages{note}")
+    if rows:
+        print(f"total: {stored_total}/{expected_total} movies ({stored_total / expected_total if expected_total else 1.0:.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crawl TMDB's discover endpoint into movies_db")
+    parser.add_argument('--start', help='first release date (YYYY-MM-DD) of a date range crawl')
+    parser.add_argument('--end', help='last release date (default: today)')
+    parser.add_argument('--popular', type=int, metavar='PAGES', help='crawl the first PAGES pages by popularity instead')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='worker processes (date range crawl)')
+    parser.add_argument('--resume', action='store_true', help='skip the pages already stored')
+    parser.add_argument('--plan', action='store_true', help='only print the shards of the date range')
+    args = parser.parse_args(argv)
+
+    bucket = SharedTokenBucket()
+    conn = connect()
+    try:
+        if args.popular:
+            # one unbounded query: a single process, its threads already use the whole rate budget
+            client = TMDBClient(TMDBFetcher(TMDB_API_KEY, bucket=bucket), cache_from_env())
+            total_pages, total_results = range_size(client)
+            pages = min(args.popular, total_pages, MAX_PAGES)
+            stored, failed = crawl(client, conn, BulkWriter(conn), IngestCheckpoints(conn), None, None, range(1, pages + 1), args.resume)
+            print(f"{stored} pages stored, {failed} failed ; {client.report()}")
+            print_coverage(coverage(conn, [(None, None, pages, total_results, False)]))
+            return 1 if failed else 0
+
+        start_date = args.start or FIRST_RELEASE
+        end_date = args.end or datetime.date.today().isoformat()
+        client = TMDBClient(TMDBFetcher(TMDB_API_KEY, bucket=bucket), cache_from_env())
+        shards = plan_shards(client, start_date, end_date)
+        print(f"{start_date} .. {end_date}: {len(shards)} shard(s), {sum(shard[2] for shard in shards)} pages, "
+              f"{sum(shard[3] for shard in shards)} movies")
+        if args.plan:
+            for shard in shards:
+                print(f"  {shard[0]} .. {shard[1]}: {shard[2]} pages, {shard[3]} movies{'  (truncated)' if shard[4] else ''}")
+            return 0
+
+        started = time.perf_counter()
+        failed = 0
+        # largest shards first, so the pool doesn't end waiting on one big shard
+        order = sorted(shards, key=lambda shard: -shard[2])
+        with multiprocessing.Pool(max(1, min(args.workers, len(shards))), initializer=init_worker, initargs=(bucket, args.resume)) as pool:
+            for _, _, shard_failed in pool.imap_unordered(crawl_shard, order):
+                failed += shard_failed
+        print(f"Crawled {len(shards)} shard(s) in {time.perf_counter() - started:.0f}s")
+        print_coverage(coverage(conn, shards))
+        return 1 if failed else 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
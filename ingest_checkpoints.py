@@ -0,0 +1,93 @@
+import datetime
+
+# Checkpoints of the TMDB crawl (movies.ingest_checkpoints, see migrations/0006_ingest_checkpoints.sql).
+# A page is the unit of work: its movies and its 'done' checkpoint are committed together, so after a crash or an
+# exhausted quota the database says exactly which pages are stored, and `--resume` fetches only the others.
+#
+#   python ingest_checkpoints.py    -> pages done / failed per date range
+
+UNBOUNDED = ('-infinity', 'infinity')  # bounds of a crawl without a date range
+
+MARK_PAGE = """
+    INSERT INTO movies.ingest_checkpoints (range_start, range_end, page, status, movies, error, started_at)
+    VALUES (%s::date, %s::date, %s, %s, %s, %s, %s)
+    ON CONFLICT (range_start, range_end, page) DO UPDATE SET
+        status = EXCLUDED.status, movies = EXCLUDED.movies, error = EXCLUDED.error,
+        attempts = movies.ingest_checkpoints.attempts + 1, started_at = EXCLUDED.started_at, finished_at = now()
+"""
+
+
+def date_range(start_date=None, end_date=None):
+    # the (range_start, range_end) key of a crawl ; None means unbounded
+    return (start_date or UNBOUNDED[0], end_date or UNBOUNDED[1])
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class IngestCheckpoints:
+    def __init__(self, conn):
+        self.conn = conn  # psycopg2 connection, the same one the movies are written with
+
+    def done_pages(self, key):
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT page FROM movies.ingest_checkpoints WHERE range_start = %s::date AND range_end = %s::date AND status = 'done'", key)
+            pages = {page for page, in cur.fetchall()}
+        self.conn.commit()  # don't leave the connection idle in a transaction while the pages are fetched
+        return pages
+
+    def pending_pages(self, key, pages):
+        # the pages of `pages` not stored yet (never attempted or failed), in order
+        done = self.done_pages(key)
+        return [page for page in pages if page not in done]
+
+    def mark_done(self, key, page, movies, started_at):
+        # part of the page's transaction: the caller commits it together with the page's movies
+        with self.conn.cursor() as cur:
+            cur.execute(MARK_PAGE, key + (page, 'done', movies, None, started_at))
+
+    def mark_failed(self, key, page, error, started_at):
+        # in its own transaction (the page's one was rolled back)
+        with self.conn.cursor() as cur:
+            cur.execute(MARK_PAGE, key + (page, 'failed', 0, str(error)[:1000], started_at))
+        self.conn.commit()
+
+    def summary(self):
+        # [(range_start, range_end, pages done, pages failed, movies, last page done, last update)]
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT range_start::text, range_end::text, COUNT(*) FILTER (WHERE status = 'done'), COUNT(*) FILTER (WHERE status = 'failed'),
+                       SUM(movies), MAX(page) FILTER (WHERE status = 'done'), MAX(finished_at)
+                FROM movies.ingest_checkpoints GROUP BY range_start, range_end ORDER BY range_start, range_end
+            """)
+            rows = cur.fetchall()
+        self.conn.commit()
+        return rows
+
+
+def ingest_page(conn, writer, checkpoints, key, page, records, started_at):
+    # writes the movies of one page and its checkpoint in one transaction ; returns whether the page is stored
+    try:
+        writer.write(records, commit=False)
+        checkpoints.mark_done(key, page, len(records), started_at)
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error inserting page {page}: {e}")
+        checkpoints.mark_failed(key, page, e, started_at)
+        return False
+
+
+if __name__ == "__main__":
+    from config import SessionLocal
+    session = SessionLocal()
+    try:
+        rows = IngestCheckpoints(session.connection().connection).summary()
+    finally:
+        session.close()
+    if not rows:
+        print("No ingest checkpoints yet")
+    for range_start, range_end, done, failed, movies, last_page, finished_at in rows:
+        print(f"{range_start} .. {range_end}: {done} pages done (last {last_page}), {failed} failed, {movies or 0} movies, updated {finished_at:%Y-%m-%d %H:%M}")
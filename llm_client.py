@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from correction_cache import correction_cache
+from tracing import tracer
+
+# Thread-pooled wrapper around the OpenAI completions client.
+# A query mentioning several entities ("genres like superhero, heist and space opera") used to pay one blocking HTTP
+# round trip per entity, one after the other. This wrapper offers two ways to bound that by a single round trip:
+#   - complete_many(): independent prompts fanned out concurrently (at most LLM_MAX_CONCURRENCY requests in flight)
+#   - correct_batch(): several items merged into ONE prompt whose answer is a JSON array (structured output)
+# Every answer goes through the correction cache (see correction_cache.py), so only unseen inputs reach the network.
+# AsyncLLMClient is the same client over openai.AsyncOpenAI, for the HTTP service (service.py).
+# The token usage of every response goes to the current span of tracing.py (the worker threads run in a copy of the
+# caller's context, so their tokens land on the caller's span).
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+BATCH_TOKENS_PER_ITEM = 10  # room for one short name plus the JSON quotes and comma
+
+
+class LLMClient:
+    def __init__(self, client, model, prompt_version, cache=correction_cache, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.client = client
+        self.model = model
+        self.prompt_version = prompt_version
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _pool(self):
+        # the worker threads are only started the first time something is fanned out
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+        return self._executor
+
+    def complete(self, kind, raw_value, prompt, max_tokens):
+        # one (cached) completion ; exceptions are left to the caller, so a failed call is never cached
+        cached = self.cache.get(kind, raw_value, self.model, self.prompt_version)
+        if cached is not None:
+            return cached
+        completion_text = self._create(prompt, max_tokens).strip()
+        self.cache.put(kind, raw_value, self.model, self.prompt_version, completion_text)
+        return completion_text
+
+    def _create(self, prompt, max_tokens):
+        completion = self.client.completions.create(
+            model=self.model,
+            prompt=prompt,
+            max_tokens=max_tokens,
+        )
+        tracer.tokens(getattr(completion, 'usage', None))
+        return completion.choices[0].text
+
+    def complete_many(self, calls):
+        # calls: list of (kind, raw_value, prompt, max_tokens) ; returns the answers in the same order,
+        # None for every call that failed (the caller then keeps the user's own text, like the single-call path does)
+        if len(calls) <= 1:
+            return [self._complete_or_none(call) for call in calls]
+        futures = [self._pool().submit(contextvars.copy_context().run, self._complete_or_none, call) for call in calls]
+        return [future.result() for future in futures]
+
+    def _complete_or_none(self, call):
+        kind, raw_value, prompt, max_tokens = call
+        try:
+            return self.complete(kind, raw_value, prompt, max_tokens)
+        except Exception as e:
+            print(f"ERROR in completing {kind} '{raw_value}': {e}")
+            return None
+
+    def correct_batch(self, kind, items, instruction):
+        # corrects several items with a single prompt ; returns the corrections in the same order as items,
+        # None for the items the model didn't answer properly
+        answers, missing = self._cached_answers(kind, items)
+        if not missing:
+            return answers
+        try:
+            corrected = parse_json_list(self._create(batch_prompt(instruction, missing), batch_max_tokens(missing)), len(missing))
+        except Exception as e:
+            print(f"ERROR in batch correcting {kind} names: {e}")
+            corrected = None
+        return self._merge_batch(kind, items, answers, missing, corrected)
+
+    def _cached_answers(self, kind, items):
+        # (cached answer or None for every item, items without a cached answer)
+        answers = [self.cache.get(kind, item, self.model, self.prompt_version) for item in items]
+        return answers, [item for item, answer in zip(items, answers) if answer is None]
+
+    def _merge_batch(self, kind, items, answers, missing, corrected):
+        # remembers the batch's corrections and fills them into answers
+        if corrected is None:
+            return answers
+        corrections = dict(zip(missing, corrected))
+        for item, correction in corrections.items():
+            self.cache.put(kind, item, self.model, self.prompt_version, correction)
+        return [answer if answer is not None else corrections.get(item) for item, answer in zip(items, answers)]
+
+
+class AsyncLLMClient(LLMClient):
+    # LLMClient over openai.AsyncOpenAI: the same cache, prompts and parsing, but complete / complete_many / correct_batch
+    # are coroutines. complete_many() gathers its calls on the event loop (no threads), and the semaphore keeps at most
+    # max_concurrency requests in flight for ALL the queries being served, which is the limit of the OpenAI upstream.
+    # The correction cache reads and commits a SQLite file under a lock: it's used from the loop's default executor
+    # (asyncio.to_thread), so a query waiting on the disk doesn't hold up the others.
+    def __init__(self, client, model, prompt_version, cache=correction_cache, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        super().__init__(client, model, prompt_version, cache, max_concurrency)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def complete(self, kind, raw_value, prompt, max_tokens):
+        cached = await asyncio.to_thread(self.cache.get, kind, raw_value, self.model, self.prompt_version)
+        if cached is not None:
+            return cached
+        completion_text = (await self._create(prompt, max_tokens)).strip()
+        await asyncio.to_thread(self.cache.put, kind, raw_value, self.model, self.prompt_version, completion_text)
+        return completion_text
+
+    async def _create(self, prompt, max_tokens):
+        async with self._semaphore:
+            completion = await self.client.completions.create(
+                model=self.model,
+                prompt=prompt,
+                max_tokens=max_tokens,
+            )
+        tracer.tokens(getattr(completion, 'usage', None))
+        return completion.choices[0].text
+
+    async def complete_many(self, calls):
+        return list(await asyncio.gather(*(self._complete_or_none(call) for call in calls)))
+
+    async def _complete_or_none(self, call):
+        kind, raw_value, prompt, max_tokens = call
+        try:
+            return await self.complete(kind, raw_value, prompt, max_tokens)
+        except Exception as e:
+            print(f"ERROR in completing {kind} '{raw_value}': {e}")
+            return None
+
+    async def correct_batch(self, kind, items, instruction):
+        answers, missing = await asyncio.to_thread(self._cached_answers, kind, items)
+        if not missing:
+            return answers
+        try:
+            corrected = parse_json_list(await self._create(batch_prompt(instruction, missing), batch_max_tokens(missing)), len(missing))
+        except Exception as e:
+            print(f"ERROR in batch correcting {kind} names: {e}")
+            corrected = None
+        return await asyncio.to_thread(self._merge_batch, kind, items, answers, missing, corrected)
+
+
+def batch_prompt(instruction, missing):
+    # one prompt for several items, answered as a JSON array (parse_json_list)
+    return (
+        f"{instruction}\n"
+        "Answer with a JSON array of strings only, one answer per input, in the same order.\n\n"
+        f"Input: {json.dumps(missing)}\n"
+        "Output:"
+    )
+
+
+def batch_max_tokens(missing):
+    return BATCH_TOKENS_PER_ITEM * len(missing) + 5
+
+
+def parse_json_list(completion_text, expected_length):
+    # the model sometimes wraps the array in extra words ; we take the outermost [...] and insist on the right length
+    start, end = completion_text.find('['), completion_text.rfind(']')
+    if start == -1 or end <= start:
+        return None
+    try:
+        values = json.loads(completion_text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != expected_length:
+        return None
+    return [str(value).strip() for value in values]
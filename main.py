@@ -1,11 +1,23 @@
+import argparse
+import json
+import threading
+from collections import namedtuple
+from contextlib import ExitStack
+from itertools import chain
 from config import SessionLocal
+from db import format_pool_metrics, session_scope, warm_up # tuned connection pool (rebinds SessionLocal), scoped sessions, pool metrics
 import os
-import re
-from sqlalchemy.sql import text #we should use SQLAlchemy's text construct to ensure the raw SQL string is interpreted correctly. 
-#probably for the potential ERROR like :
-#The error message we can potentially received indicates that SQLAlchemy is having trouble interpreting the raw-SQL-string in the session.execute command.
-# This can happen when SQLAlchemy needs a clear indication that you're passing a raw SQL string.
-from decimal import Decimal
+from llm_client import LLMClient # cached, thread-pooled / batched wrapper around the OpenAI client
+from name_corrector import NameCorrector, local_correction # local fuzzy correction against the names already stored in movies.movies
+from query_router import route_query # compiled single-pass intent router
+from queries import STATEMENTS, STREAM_MIN_ROWS, OverviewRow, Page, contains_pattern, execute_statement, rating_bounds, stream_statement, typed_rows # parameterized, prepared (and paged) statements of every search intent, typed rows
+from result_cache import cache_from_env as result_cache_from_env, canonical # in-memory result cache, dropped when the catalog version moves
+from catalog_engine import catalog_from_env # optional in-memory NumPy engine (SEARCH_ENGINE=memory)
+from semantic_index import default_index # local embedding index of the overviews, for plot descriptions
+from fulltext_index import FullTextIndex # BM25 keyword index of titles and overviews
+from movie_actors import normalize_actor_name # actor names are looked up in movies.movie_actors in normalized form
+from genres import GENRES, genre_names, resolve_genre, resolve_genres # closed vocabulary of TMDB genres, resolved without the LLM
+from tracing import tracer # per-stage spans of every query: one JSON line per query, Prometheus metrics
 
 #Initialization:
 from openai import OpenAI
@@ -33,735 +45,699 @@ we don’t typically need to purchase each model separately; instead, we can use
 with pricing varying depending on the model and amount of usage (in tokens including tokens of input & output as well).
 Always check OpenAI’s current pricing and model details for the most accurate information.
 '''
+LLM_MODEL = "gpt-3.5-turbo-instruct"
+PROMPT_VERSION = 2 # bump this whenever one of the prompts below changes ; cached corrections of older prompts are then ignored
+
+# Every LLM call goes through this wrapper: a cached answer (same kind, same normalized input, same model and prompt version)
+# is returned straight away (see correction_cache.py), otherwise we ask the model and remember its answer.
+# Several independent corrections can be fanned out concurrently (llm.complete_many) or merged into one prompt (llm.correct_batch).
+llm = LLMClient(client, LLM_MODEL, PROMPT_VERSION)
+
+# Local correction engine, built from movie_name / director_name / top_5_actors of movies.movies.
+# the complete_correct* functions below ask the LLM only when the local engine isn't confident enough.
+name_corrector = NameCorrector(SessionLocal)
+
+# Search engine of this deployment: None -> every search runs its prepared SQL statement ;
+# with SEARCH_ENGINE=memory the catalog is loaded into NumPy arrays once and the statements are answered in-process
+# (same rows as the SQL path, see catalog_engine.py). Intents the engine can't answer still go to Postgres.
+catalog = catalog_from_env(SessionLocal)
+
+# Result cache of this process (see result_cache.py): the corrected parameters of a route (process_query) and the rows
+# of a statement page (run_plan, service.py), until the ingest moves the catalog version.
+result_cache = result_cache_from_env(SessionLocal)
+
+# The in-memory catalog, the keyword index and the name dictionaries are snapshots of the catalog. Both drivers call refresh_snapshots() when the catalog version
+# they read moved (result_cache.refresh() / observe()): a snapshot of an older version is replaced by a new one, built
+# aside and swapped in, so the searches running meanwhile keep answering from the old one. Until the swap, their rows
+# aren't cached (cacheable_version()): the cache was just emptied and mustn't be refilled with the old rows.
+_snapshots_lock = threading.Lock()
+
+def refresh_snapshots(version):
+    global catalog, keyword_index, name_corrector
+    with _snapshots_lock: # one rebuild at a time ; a second caller finds it done
+        if catalog is not None and catalog.loaded and catalog.version != version:
+            catalog = catalog.reloaded()
+        if keyword_index.loaded and keyword_index.version != version:
+            keyword_index = keyword_index.reloaded()
+        if name_corrector.stale(version):
+            name_corrector = name_corrector.reloaded()
+
+# catalog version the rows of a search may be cached under: None (not cached) while a snapshot is behind the result cache
+def cacheable_version():
+    version = result_cache.version
+    if catalog is not None and catalog.loaded and catalog.version != version:
+        return None
+    return version
+
+# Every search below is written ONCE, as a plan, and run by two drivers: run_plan() here (the command line: the pooled
+# SQLAlchemy session, the thread-pooled llm, rows streamed) and service.py (the HTTP service: asyncpg, AsyncOpenAI).
+# A plan is a generator that yields what it needs from the outside and gets the answer sent back, or the exception
+# thrown back in, so its own try/except handles a failed statement or LLM call like before:
+#   Fetch(intent, params)      -> the rows of the intent's statement (queries.py), an iterator of MovieRow / OverviewRow
+#   LLMCall(method, args)      -> llm.<method>(*args): complete / complete_many / correct_batch (llm_client.py)
+# and returns the rows of the page (an iterable). Local work (name correction, genre vocabulary, the keyword and plot
+# indexes) runs inside the plan itself.
+# Both drivers time what they perform as spans of the current query (tracing.py): 'search' around the whole plan, one
+# 'sql' per Fetch (statement, bind variables, rows, cached) and one 'llm' per LLMCall (method, kind, tokens) ; the plan
+# adds its own ('process_query', the index lookups) and annotates them with what it decided (corrected names...).
+Fetch = namedtuple('Fetch', ['intent', 'params'])
+LLMCall = namedtuple('LLMCall', ['method', 'args'])
+
+# kind of the name(s) an LLMCall corrects, for its span: the first argument of complete / correct_batch, the kind of
+# the first call of complete_many
+def llm_kind(request):
+    if request.method == 'complete_many':
+        return request.args[0][0][0] if request.args[0] else None
+    return request.args[0]
+
+# rows of a statement (MovieRow / OverviewRow, see queries.py) as an iterator: a page larger than STREAM_MIN_ROWS comes from
+# a server-side cursor a batch at a time (constant memory, and the first rows are shown before the last ones are read) ;
+# smaller pages run the prepared statement
+def iter_search(session, intent, statement_params):
+    rows = catalog.execute(intent, statement_params) if catalog is not None else None
+    if rows is not None:
+        return iter(rows)
+    if statement_params.get('limit', 0) > STREAM_MIN_ROWS:
+        return stream_statement(session, intent, statement_params)
+    return typed_rows(intent, execute_statement(session, intent, statement_params))
+
+# result cache of the statement pages: (key, cached rows or None) of a Fetch ; a page read through a server-side cursor
+# (more than STREAM_MIN_ROWS rows) isn't cached, its key is None
+def cached_rows(request):
+    if request.params.get('limit', 0) > STREAM_MIN_ROWS:
+        return None, None
+    key = ('rows', request.intent) + tuple(canonical(request.params[arg]) for arg in STATEMENTS[request.intent].args)
+    rows = result_cache.get(key)
+    if rows is not None:
+        tracer.annotate(cached=True, rows=len(rows))
+    return key, rows
+
+# rows of a statement page as an iterator, stored in the result cache under key first (unless key is None)
+def remember_rows(key, rows, version):
+    if key is None:
+        return rows
+    rows = list(rows)
+    tracer.annotate(rows=len(rows)) # a streamed page (key None) is counted by the render span instead
+    result_cache.put(key, rows, version)
+    return iter(rows)
+
+# command line driver of a plan: performs its requests (the pooled session is checked out at the first Fetch, so it
+# isn't held during the LLM calls before it) and yields the rows of the page it returns, counted by page
+def run_plan(plan, page):
+    if result_cache.refresh(): # the catalog changed since the last check: the cached results were dropped
+        refresh_snapshots(result_cache.version)
+    with ExitStack() as resources:
+        session = None
+        version = cacheable_version() # read before any statement runs: rows read across an invalidation aren't stored
+        answer, error = None, None
+        with tracer.span('search'):
+            while True:
+                try:
+                    request = plan.send(answer) if error is None else plan.throw(error)
+                except StopIteration as stop:
+                    rows = stop.value or ()
+                    break
+                answer, error = None, None
+                try:
+                    if isinstance(request, Fetch):
+                        with tracer.span('sql', statement=request.intent, params=request.params):
+                            key, rows = cached_rows(request)
+                            if rows is not None:
+                                answer = iter(rows) # no connection needed
+                            else:
+                                if session is None:
+                                    session = resources.enter_context(session_scope()) # the connection goes back to the pool when the rows are read
+                                answer = remember_rows(key, iter_search(session, request.intent, request.params), version)
+                    else:
+                        with tracer.span('llm', method=request.method, kind=llm_kind(request)):
+                            answer = getattr(llm, request.method)(*request.args)
+                except Exception as e:
+                    if session is not None:
+                        session.rollback() # a failed statement aborts the transaction: the plan may run another one
+                    error = e
+        try:
+            yield from page.rows(rows)
+        except Exception as e: # e.g. the connection dropped while the rows were streamed
+            print(f"ERROR in reading the results: {e}")
+
+# Keyword index over titles AND overviews (BM25, built in-process on first use, see fulltext_index.py):
+# when no title contains the searched words, the title search and the overview search look for them in the overviews.
+keyword_index = FullTextIndex(SessionLocal)
+
+# fetches the rows of movie_ids with a *_by_ids statement and returns them in the order of movie_ids (best match first) ;
+# the statements select the movie id first, drop_id removes it again from (id, movie_name, overview) rows: OverviewRows
+def rows_in_order(intent, movie_ids, drop_id=False):
+    rows = {row[0]: row for row in (yield Fetch(intent, {'movie_ids': movie_ids}))}
+    return [OverviewRow._make(rows[movie_id][1:]) if drop_id else rows[movie_id] for movie_id in movie_ids if movie_id in rows]
+
+def keyword_matches(words, k):
+    with tracer.span('keyword_index', words=words) as span:
+        matches = [movie_id for movie_id, _ in keyword_index.search(words, k=k)]
+        span.set(matches=matches)
+    return matches
+
+# the rows of a statement, or the keyword fallback when the first page is empty: peeks at the first row only, so
+# streamed rows stay streamed
+def rows_or_fallback(rows, page):
+    first = next(rows, None)
+    if first is None and page.first:
+        return None
+    return rows if first is None else chain((first,), rows)
+
+# The complete_correct* functions return (name, corrected): corrected is False when the LLM call failed and the name is
+# the user's own text, which process_query must then not keep in the result cache.
 def complete_correct(movie_name):
+    corrected_movie_name = local_correction(name_corrector, 'movie', movie_name)
+    if corrected_movie_name:
+        return corrected_movie_name, True # found locally: no network round trip needed
     prompt = f"Correct the spelling or complete the movie name: '{movie_name}'"
     
     try:
-        completion = client.completions.create(
-            model= "gpt-3.5-turbo-instruct",
-            prompt=prompt,
-            max_tokens=8,  # Limiting the response to ensure it's concise   //by setting max tokens to 8 here we're ensuting it should gives us the comple/correct name of the movie only
-                                         # without any eleborated sentences or instructional sentences. like "correct movie title is 'Jack the Giant Slayer' "  
-        )
+        completion_text = yield LLMCall('complete', ('movie', movie_name, prompt,
+            8))  # Limiting the response to 8 tokens to ensure it's concise   //by setting max tokens to 8 here we're ensuting it should gives us the comple/correct name of the movie only
+                 # without any eleborated sentences or instructional sentences. like "correct movie title is 'Jack the Giant Slayer' "  
         # Extract the first line or word assuming it's the movie name
-        corrected_movie_name = completion.choices[0].text.strip().split('\n')[0]  # Get the first line of response
-        print(f"Corrected/Completed Movie Name: '{corrected_movie_name}'")  # Just for debugging
-        return corrected_movie_name
+        corrected_movie_name = completion_text.split('\n')[0]  # Get the first line of response
+        tracer.annotate(corrected_name=corrected_movie_name)
+        return corrected_movie_name, True
     except Exception as e:
         print(f"ERROR in correcting/completing movie name: {e}")
-        return movie_name  # If there's an error, return the original movie name ; the movie name which's entered by user while querying 
+        return movie_name, False  # If there's an error, return the original movie name ; the movie name which's entered by user while querying 
 # Function to correct and complete actor/actress names
 def complete_correct_actors(actor_name):
+    corrected_actor_name = local_correction(name_corrector, 'actor', actor_name)
+    if corrected_actor_name:
+        return corrected_actor_name, True
     prompt = f"Correct the spelling or complete the actor/actress name: '{actor_name}'" # auxilliary prompt for directing chat-gpt for completing and correct the spelling of actor/actress
     
     try:
-        completion = client.completions.create(
-            model="gpt-3.5-turbo-instruct",
-            prompt=prompt,
-            max_tokens=6  # Limiting the response to ensure it's concise
-        )
-        corrected_actor_name = completion.choices[0].text.strip().split('\n')[0] # Get the first line of response
-        print(f"Corrected/Completed Actor/Actress Name: '{corrected_actor_name}'")
-        return corrected_actor_name
+        completion_text = yield LLMCall('complete', ('actor', actor_name, prompt, 6))  # Limiting the response to ensure it's concise
+        corrected_actor_name = completion_text.split('\n')[0] # Get the first line of response
+        tracer.annotate(corrected_name=corrected_actor_name)
+        return corrected_actor_name, True
     except Exception as e:
         print(f"ERROR in correcting/completing actor/actress name: {e}")
-        return actor_name # if there is error in completing and correcting the actor/actress name then return original actor-name which was used by user while querying.
+        return actor_name, False # if there is error in completing and correcting the actor/actress name then return original actor-name which was used by user while querying.
 
 #This function will correct and complete the director’s name, similar to how you handle the actor/actress names.
 def complete_correct_director(director_name):
+    corrected_director_name = local_correction(name_corrector, 'director', director_name)
+    if corrected_director_name:
+        return corrected_director_name, True
     prompt = f"Correct the spelling or complete the director's name: '{director_name}'"
     try:
-        completion = client.completions.create(
-            model="gpt-3.5-turbo-instruct",
-            prompt=prompt,
-            max_tokens=6
-        )
-        corrected_director_name = completion.choices[0].text.strip().split('\n')[0]
-        print(f"Corrected/Completed Director Name: '{corrected_director_name}'")
-        return corrected_director_name
+        completion_text = yield LLMCall('complete', ('director', director_name, prompt, 6))
+        corrected_director_name = completion_text.split('\n')[0]
+        tracer.annotate(corrected_name=corrected_director_name)
+        return corrected_director_name, True
     except Exception as e:
         print(f"ERROR in correcting/completing director name: {e}")
-        return director_name #in the case of error:  return original director name as it's which is written by user while querying
-
-def complete_correct_genre(genre_name):
-    prompt = f"Correct the spelling or complete the genre name: '{genre_name}'"
-    
-    try:
-        completion = client.completions.create(
-            model="gpt-3.5-turbo-instruct",
-            prompt=prompt,
-            max_tokens=3  # limiting token to 3 as it will correct and complete the genre in the genre_list one by one  
-        )
-        genre_name1 = completion.choices[0].text.strip().split('\n')[0]
-        corrected_genre_name = genre_name1.title()# This will capitalize each word's first letter.
-        print(f"Corrected/Completed Genre Name: '{corrected_genre_name}'")
-        return corrected_genre_name
-    except Exception as e:
-        print(f"ERROR in correcting/completing genre name: {e}")
-        return genre_name #in the case of error:  return original genre  as it's, which is written by user while querying
-
-    
-def process_query(query): 
-    # this function is take raw user's query and extract text from it .
-    # Normalize the query
-    query = query.lower()#Normalize the query : converts the entire query string to lowercase. This is useful because it standardizes the input, 
-    #making it easier to process and compare, as SQL queries and text searches are often case-insensitive.
-
-    # Define special cases:
-    #This defines a list of regular expressions (regex) to identify specific patterns in the query. 
-    #Each regex pattern is a string that describes a search pattern.
-    special_cases = [
-        r'overview of (.+) movie', #capturing movie_name for retrieving its overviews
-        r'overview of (.+)',  #Alternate-query of overview of movies: capturing movie_name for retrieving its overviews
-        r'top 5 movies from year (\d{4})', # this will capture the release year for searching top 5 movies corresponds to it.
-        r'movies like (.+)',  # Added for similarity search
-        r'movies of (actor|actress) (.+) from (\d{4}) to (\d{4})',  # regex for actor/actress with date-range
-        # this will capture the actress'/actor's name for searching his top 7 movies
-        r'movies of (actor|actress) (.+)',  # Flexible match for both actor and actress
-        #r'movies of (.+)',  # Catch-all for other cases like actor/actress with misspelling  //fallback for other cases
-        r'movies of director (.+) from (\d{4}) to (\d{4})',  # regex for director with date-range
-        r'movies of director (.+) with ratings? (above|below) (\d+(\.\d+)?)',  #regex for director with rating filter  
-        r'movies of director (.+)',  #regex for director 
-        r'genres? like (.+) with ratings? (above|below) (\d+(\.\d+)?)',  # regex pattern for capturing genre and fassion of rating(above or below) and capturing decimal value(rating)
-        r'genres? like (.+)'  # regex pattern to capture genres //genres?: Matches "genre" or "genres" (the ? makes the "s" optional). 
-    ]
-  
-    #this loop iterates through each regex pattern in the special_cases list.
-    #re.search(case, query) attempts to match the regex pattern (case) to the query.
-    for case in special_cases:
-        match = re.search(case, query)
-        if match:  #If a match is found (if match), match.group(1) 
-            #extracts the relevant part of the query based on the capturing group defined in the regex pattern (the part within parentheses ()).
-            if case == r'top 5 movies from year (\d{4})':
-                # If the case is for capturing the year, return the year directly without correction
-                return match.group(1)
-            elif case == r'movies like (.+)': #<-for similarity search , capturing and correcting movie  
-                movie_name = match.group(1).strip()
-                corrected_movie_name = complete_correct(movie_name)  # Correct movie name if necessary
-                return corrected_movie_name
-            elif case == r'movies of (actor|actress) (.+) from (\d{4}) to (\d{4})':
-                actor_name = match.group(2) # capturing actor/actress' name 
-                from_date = match.group(3) # capturing from_date
-                to_date = match.group(4)  # capturing to_date
-                corrected_actor_name = complete_correct_actors(actor_name) # correcting and completing actor's name with the help of function 
-                return corrected_actor_name, from_date, to_date  # Return all three captured and corrected values.
-            elif case in [r'movies of (actor|actress) (.+)', r'movies of (.+)']:
-                actor_name = match.group(2) #if case == r'movies of (actor|actress) (.+)' else match.group(1)   # capture actor/actress name 
-                corrected_actor_name = complete_correct_actors(actor_name)# then comple and correct the actor/actress name by passing captured name to the function: complete_correct_actors.
-                return corrected_actor_name # retrun corrected name.
-            elif case == r'movies of director (.+)':  # <-- Handling director name
-                director_name = match.group(1)
-                corrected_director_name = complete_correct_director(director_name)
-                return corrected_director_name
-            elif case == r'movies of director (.+) from (\d{4}) to (\d{4})':  # <-- Handling director and date range
-                director_name = match.group(1) # capturing director's name 
-                from_date = match.group(2) # capeturing from_date
-                to_date = match.group(3) #capturing to_date
-                corrected_director_name = complete_correct_director(director_name)# correcting and completing director's name with the help of function 
-                return corrected_director_name, from_date, to_date# returning director's name , from_date and to_date 
-            elif case == r'movies of director (.+) with ratings? (above|below) (\d+(\.\d+)?)':
-                director_name = match.group(1)   # for director
-                rating_comparison = match.group(2)  # 'above' or 'below'
-                rating_value = Decimal(match.group(3))  # Rating number (e.g., 8 or 6.47 in decimal as well are allowed)
-                # Correct director_name using complete_correct_director
-                corrected_director_name = complete_correct_director(director_name)
-                return corrected_director_name, rating_comparison, rating_value
-            elif case == r'genres? like (.+) with ratings? (above|below) (\d+(\.\d+)?)':
-                genre_string = match.group(1)   # for genre
-                rating_comparison = match.group(2)  # 'above' or 'below'
-                rating_value = Decimal(match.group(3))  # Rating number (e.g., 8 or 6.47 in decimal as well are allowed)
-            
-                # Correct genres using complete_correct_genre
-                genre_list = re.split(r',\s*|\s+and\s+', genre_string) # Split by commas (",") or "and"
-                corrected_genres = [complete_correct_genre(genre) for genre in genre_list]
-                return corrected_genres, rating_comparison, rating_value
-            elif case == r'genres? like (.+)': # <-- Handling queries related to genre 
-                genre_string = match.group(1) # capturing strings regarding genre_name i.e. Adventure, crime, drama and war
-                genre_list = re.split(r',\s*|\s+and\s+', genre_string)  # Split by commas (",") or "and"
-                #uses a list comprehension to iterate through each genre in genre_list and applies the complete_correct_genre function to each one.
-                # This means each genre name will be individually corrected or completed, 
-                corrected_genres = [complete_correct_genre(genre) for genre in genre_list] # resulting in a new list called corrected_genres that contains the corrected versions of all the genres provided in the user's query.
-                return corrected_genres # finally return the list of corrected gnere. 
-            else:
-                # For movie names in context of retriving overviews, use the complete_correct function
-                processed_query = match.group(1)
-                corrected_query = complete_correct(processed_query) # for completing and correcting the movie , 
-                                                       #here we're passing the relevent text(captured with the help of regex pattern) to the complete_correct function 
-                return corrected_query  # then finally returning the corrected query
-
-            
-    # Fallback to default prompt processing if explicit actor/actress query check and regex cases based match won't satisfied by user query:-
+        return director_name, False #in the case of error:  return original director name as it's which is written by user while querying
+
+# resolves the genres typed by the user into TMDB genre ids.
+# Nearly every token is resolved locally (spelling, plurals, aliases) ; the few that aren't a known genre word at all
+# ("superhero", "space opera") are mapped onto the genre list by the LLM in ONE batched prompt, however many there are.
+# returns (genre_ids, resolved): resolved is False when a genre was left out (LLM failure or no genre matched)
+def resolve_genre_list(genre_list):
+    genre_ids, unknown = resolve_genres(genre_list)
+    still_unknown = []
+    if unknown:
+        instruction = f"Map each of these words to the closest movie genre from this list: {', '.join(GENRES.values())}."
+        answers = yield LLMCall('correct_batch', ('genre', unknown, instruction))
+        unanswered = [token for token, answer in zip(unknown, answers) if not answer]
+        if unanswered: # the batch answer couldn't be parsed: asking for the missing ones one by one, but concurrently
+            retried = dict(zip(unanswered, (yield LLMCall('complete_many', ([
+                ('genre', token, f"{instruction}\n\nWord: '{token}'\nGenre:", 4) for token in unanswered
+            ],)))))
+            answers = [answer or retried.get(token) for token, answer in zip(unknown, answers)]
+        for token, answer in zip(unknown, answers):
+            genre_id = resolve_genre(answer) if answer else None # the answer must itself be one of the known genres
+            if genre_id is None:
+                still_unknown.append(token)
+            elif genre_id not in genre_ids:
+                genre_ids.append(genre_id)
+        genre_ids.sort()
+        if still_unknown:
+            print(f"Unknown genre(s) ignored: {', '.join(still_unknown)}")
+    tracer.annotate(genres=genre_names(genre_ids))
+    return genre_ids, not still_unknown
+
+def process_query(route): 
+    # this function takes the Route of the user's query (see query_router.py: intent + typed parameters, parsed in one pass)
+    # and corrects/completes the names it carries ; it returns the corrected parameters (dict), or None when nothing is left to search for.
+    # a plan like the searches (see run_plan): the searches run it with `yield from`
+    if isinstance(route, str): # a raw query string is routed first
+        route = route_query(route)
+    with tracer.span('process_query', intent=route.intent) as span:
+        # the same route seen before: its corrected parameters come from the result cache, without any correction or LLM call
+        key = ('route', route.intent, canonical(route.params, fold=True))
+        cached = result_cache.get(key)
+        if cached is not None:
+            span.set(cached=True)
+            return dict(cached)
+        version = result_cache.version
+        params, complete = yield from correct_params(route)
+        if params and complete: # a correction that fell back on the user's text is retried next time, like a failed LLM call
+            result_cache.put(key, dict(params), version)
+        elif params:
+            span.set(fallback=True)
+        return params
+
+# returns (params, complete): complete is False when a correction fell back on what the user typed (see process_query)
+def correct_params(route):
+    params = dict(route.params)
+    intent = route.intent
+
+    if intent == 'top_year':
+        # the year (and N of "top N") are used directly without correction
+        return params, True
+    elif intent in ('overview', 'similar'): #<- for overviews and similarity search: capturing and correcting the movie name
+        params['title'], complete = yield from complete_correct(params['title'])  # Correct movie name if necessary
+        return params, complete
+    elif intent in ('actor', 'actor_range'):
+        # correcting and completing actor's/actress' name with the help of complete_correct_actors ; from_year/to_year are kept as they are
+        params['name'], complete = yield from complete_correct_actors(params['name'])
+        return params, complete
+    elif intent in ('director', 'director_range', 'director_rating'):
+        # correcting and completing director's name ; the date range or the rating filter (above|below, Decimal rating) is kept as it is
+        params['name'], complete = yield from complete_correct_director(params['name'])
+        return params, complete
+    elif intent == 'plot':
+        # a plot description is matched by meaning against the overviews: nothing to correct, the words are used as typed
+        return params, True
+    elif intent in ('genres', 'genre_rating'):
+        # each genre name is resolved (spelling, plurals, aliases like "sci-fi") against the fixed TMDB genre vocabulary,
+        params['genre_ids'], complete = yield from resolve_genre_list(params['genres']) # resulting in the list of TMDB genre ids the user asked for.
+        return params, complete
+
+    # Fallback to default prompt processing (intent 'title') if none of the intent patterns matched the user query:-
     #first of all structuring our prompt with the help of this auxilliary-prompt
+    query = params['text'].lower()
     prompt = f"Extract the main keyword or complete the movie name for database search from the following user query:\n\nUser Query: \"{query}\"\n\nKeyword:-"
-    print(f"Processing query with prompt: {prompt}")
     try:
-        completion = client.completions.create(
-            model= "gpt-3.5-turbo-instruct",  # Specifies the model to use (e.g., text-davinci-003 or "gpt-3.5-turbo-instruct")
-            prompt=prompt,              # The input text for the model to process
-            max_tokens=8              # The maximum number of tokens in the response // here Limit the response(by 8 tokens) to ensure it's concise
-        )
+        # the model(LLM_MODEL) processes the prompt and the response is limited to 8 tokens to ensure it's concise ;
+        # repeated raw queries are answered from the correction cache under the 'keyword' kind.
         # Extract the generated text from the 'completion' (from 'completion' which's generated while langchain interpreting the raw-user's query)
-        #where each reponses in the form of messages(variable where 'roles' and their corresponding 'query' used in from of disctionary) 
-        # we have to acess user's raw query through 'choices' and its zero index ; then throguh message var with 'content'. 
-        processed_query = completion.choices[0].text.strip()
-        print(f"Processed Query: '{processed_query}'")  # Debuging: Ensure this is what you expect
-        return processed_query
+        processed_query = yield LLMCall('complete', ('keyword', query, prompt, 8))
+        tracer.annotate(keyword=processed_query)
     except Exception as e:
         print(f"ERROR in processing query: {e}")
-        return ""  # return nothing in this case (if error occured)
+        return None, False  # return nothing in this case (if error occured)
+    if not processed_query:
+        return None, False
+    params['text'] = processed_query
+    return params, True
 
 #this function takes raw user's query ; then extract the crucial text from response generated by langchain while interpreting raw-user's query 
 # and then based on processed-query this function will then search against 'smart_search_db' through keyword functionality of postgre_sql
-def search_movies(query):
+# Every search below runs one fixed, parameterized statement of queries.py: the user's text travels as a bind variable
+# (no quote escaping, no SQL injection) and the statement is prepared once per pooled connection, so its plan is reused.
+# The searches are plans (see run_plan above) returning the rows of ONE page (queries.Page: first page by default,
+# page.next() for the following ones) ; page knows where the next page starts. A 'more' in main() runs the same route
+# again with the next page (its name corrections come from the correction cache).
+def search_movies(route, page):
     # Process the query using OpenAI
-    processed_query = process_query(query)
-    if not processed_query:
+    params = yield from process_query(route)
+    if not params:
         print("No processed query to search for.")
-        return []
-    # Strip extra quotes from the processed query
-    processed_query = processed_query.strip('"')
-    #In SQL, single quotes are used to enclose string literals, and if your string contains an apostrophe (like in "Ocean's Eleven" movie),
-    # we need to escape it by doubling the single quote (''), not by replacing it with double quotes(").
-    # Replace single quotes in the processed query with two single quotes
-    processed_query = processed_query.replace("'", "''")
-    # so here we handle the quotes(in processed query) using regular expression : Using re.findall: This method is better suited for handling complex cases 
-    # where you need to differentiate between single words and phrases enclosed in quotes. for getting suitable keywords
-    #The regular expression r'"(.*?)"|(\S+)' matches either:
-    #A quoted phrase: "(.*?)", where .*? is a non-greedy match for any character inside quotes.
-    #A non-whitespace sequence of characters: \S+.
-    #re.findall returns a list of tuples. Each tuple contains two elements:
-    #The first element is the quoted phrase (if it exists).
-    #The second element is the non-whitespace sequence (if it exists).
-    #For example, if processed_query is 'Godfather movie', the result of re.findall would be:[('', 'Godfather'), ('', 'movie')]
-    #If processed_query is 'my name is "Dr. DRE"', the result would be: [('', 'my'), ('', 'name'), ('', 'is'), ('Dr. DRE', '')]
-    #keywords = re.findall(r'"(.*?)"|(\S+)', processed_query)
-    #we have to Loop Over Tuples: for keyword in keywords; it iterates over each tuple in the keywords list.
-    #For each tuple keyword, it checks the first element (keyword[0]).; If keyword[0] is not an empty string, it selects keyword[0].
-    #If keyword[0] is an empty string, it selects the second element keyword[1].; Filter Non-Empty: if keyword[0] or keyword[1]
-    #The result is a list of non-empty strings extracted from the tuples. For the given examples:
-    #For processed_query as 'Godfather movie': The final keywords list will be ['Godfather', 'movie'].
-    #For processed_query as 'my name is "Dr. DRE"': The final keywords list will be ['my', 'name', 'is', 'Dr. DRE'].
-    #keywords = [keyword[0] if keyword[0] else keyword[1] for keyword in keywords if keyword[0] or keyword[1]]  # Filter out empty keywords //removing those empty elements from the keywords list
-    #if not keywords:  # if whole list of keywords is empty then return nothing
-        #print("No valid keywords found in the processed query.")
-        #return []
-    
-    #A list comprehension [f"content ILIKE '%{keyword}%'" for keyword in keywords] is used to create a list of conditions. 
-    # For each keyword in the keywords list, it creates a condition like content ILIKE '%keyword%'.
-    #The join(" OR ") method combines these conditions with the OR operator, making a single string.
-    #For example, if keywords is ["Master", "Of", "Puppets", "Metallica"], the resulting keyword_query will be "content ILIKE '%Master%' OR content ILIKE '%Of%' OR content ILIKE '%Puppets%' OR content ILIKE '%Metallica%'".
-    keyword_query = " OR ".join([f"movie_name ILIKE '%{keyword}%'" for keyword in [processed_query]])
-    final_query = f"SELECT * FROM movies.movies WHERE {keyword_query} LIMIT 10"
-    print(f"Executing SQL Query... : {final_query}")  # debugging purpose
+        return ()
+    # Strip extra quotes from the processed query ; an apostrophe (like in "Ocean's Eleven") needs no escaping as a bind variable
+    processed_query = params['text'].strip('"')
+    # movie_name ILIKE '%keyword%' where the keyword's own % and _ are matched literally
+    statement_params = {'pattern': contains_pattern(processed_query), 'term': processed_query} # matches are ranked by trigram similarity to the term
     
     # Generate and execute the SQL query
-    session = SessionLocal()  # calling SessionLocal's constructor for creating instance or object 
     #try and except the code here while excecuting queries to avoid the unwanted program termination due to postgre-sql side error.
     try:
-        # now executing final query with sql alchemy's session object and it's execute fn along with sql alchemy's text constructor
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")  # Debugging: Check number of results found
-        return results # returning results-var
+        if page.statement in (None, 'title'):
+            # now executing the prepared statement of this intent
+            rows = rows_or_fallback((yield Fetch('title', dict(statement_params, **page.params('title')))), page)
+            if rows is not None:
+                return rows
+        # no title contains the keyword: looking for it in the overviews (e.g. "heist", "submarine")
+        paging = page.params('keyword')
+        matches = keyword_matches(processed_query, paging['offset'] + paging['limit'])[paging['offset']:]
+        return (yield from rows_in_order('by_ids', matches))
     except Exception as e: # if above try-block not excecuted ; then except the corresponding error ; then print corresponding error
         print(f"ERROR in searching documents: {e}")
-        results = []  # no results will be saved in results variable 
+        return ()  # no results in this case
 
 # Function to search for movie overviews based on the processed query
 # similarly like above function:
-def search_overview(query):
-    processed_query = process_query(query)
-    if not processed_query:
+def search_overview(route, page):
+    params = yield from process_query(route)
+    if not params:
         print("No processed query to search for.")
-        return []
+        return ()
     # Strip extra quotes(if any) from the processed query
-    processed_query = processed_query.strip('"')
-    #In SQL, single quotes are used to enclose string literals, and if your string contains an apostrophe (like in "Ocean's Eleven" movie),
-    # we need to escape it by doubling the single quote (''), not by replacing it with double quotes(").
-    # Replace single quotes in the processed query with two single quotes
-    processed_query = processed_query.replace("'", "''")
-
-    #keywords = re.findall(r'"(.*?)"|(\S+)', processed_query)
-    #keywords = [keyword[0] if keyword[0] else keyword[1] for keyword in keywords if keyword[0] or keyword[1]]
-    #if not keywords:
-        #print("No valid keywords found in the processed query.")
-        #return []
-
-    keyword_query = " OR ".join([f"m.movie_name ILIKE '%{keyword}%'" for keyword in [processed_query]])
-    #Foreign Key Join: In the search_overview function here, joined the movies and movie_overviews tables using the movie_id foreign key.
+    processed_query = params['title'].strip('"')
+    #Foreign Key Join: the statement joins the movies and movie_overviews tables using the movie_id foreign key.
     # retriving movie_name and overview only
-    final_query = f"""
-        SELECT m.movie_name, o.overview
-        FROM movies.movies m
-        JOIN movies.movie_overviews o ON m.id = o.movie_id
-        WHERE {keyword_query}
-        LIMIT 7
-    """
-    print(f"Executing SQL Query... : {final_query}")
-
-    session = SessionLocal()
+    statement_params = {'pattern': contains_pattern(processed_query), 'term': processed_query}
+
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        if page.statement in (None, 'overview'):
+            rows = rows_or_fallback((yield Fetch('overview', dict(statement_params, **page.params('overview')))), page)
+            if rows is not None:
+                return rows
+        # no such title: overviews mentioning the words instead
+        paging = page.params('keyword')
+        matches = keyword_matches(processed_query, paging['offset'] + paging['limit'])[paging['offset']:]
+        return (yield from rows_in_order('overviews_by_ids', matches, drop_id=True))
     except Exception as e:
         print(f"ERROR in searching documents: {e}")
-        return []
+        return ()
+
+# Function to search movies by a description of their plot ("movie where a dream is inside a dream").
+# the description is embedded locally and compared with the embedded overviews (see semantic_index.py) ;
+# the closest movies are then fetched from movies.movies and shown most similar first.
+def search_movies_by_plot(route, page):
+    params = yield from process_query(route)
+    if not params or not params['description']:
+        print("No plot description to search for.")
+        return ()
+    index = default_index()
+    if index is None:
+        return ()
+    paging = page.params('plot') # the ranking is in-process: page n is the slice of the top offset + limit
+    with tracer.span('semantic_index') as span:
+        ranked = index.search(params['description'], k=paging['offset'] + paging['limit'])[paging['offset']:]
+        matches = [(movie_id, score) for movie_id, score in ranked if score > 0]
+        span.set(matches=[(movie_id, round(score, 3)) for movie_id, score in matches])
+    if not matches:
+        return ()
+    statement_params = {'movie_ids': [movie_id for movie_id, _ in matches]}
 
-#Function search_top_movies: This function is designed to find the top 5 movies from a specific year based on user input.
-def search_top_movies(query):
-    processed_query = process_query(query)
-    if not processed_query:
+    try:
+        return (yield from rows_in_order('by_ids', statement_params['movie_ids'])) # back in similarity order
+    except Exception as e:
+        print(f"ERROR in searching movies by plot: {e}")
+        return ()
+
+#Function search_top_movies: This function is designed to find the top N (5 by default) movies from a specific year based on user input.
+def search_top_movies(route, page):
+    params = yield from process_query(route)
+    if not params:
         print("No processed query to search for.")
-        return []
-    #using regular expression we here tries to find the year like ex: 2000 or 2006 or 1992 etc to match and grouping them to featch
-    match = re.search(r'(\d{4})', processed_query)
-    if not match:
-        print("No valid year found in the processed query.")
-        return []
-
-    year = match.group(1)  # fetching group from 'match' to the variable 'year' here 
-    #seearching in movies table for retriving movie information of the top(order by tmdb_rating DESCending) 5(limit =5) movies where release year = fetched year 
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE release_year = {year}
-        ORDER BY tmdb_rating DESC
-        LIMIT 5
-    """
-    print(f"Executing SQL Query... : {final_query}")
+        return ()
+    # the router already captured the year (like 2000 or 2006 or 1992) and N of "top N movies" as integers
+    #seearching in movies table for retriving movie information of the top(order by tmdb_rating DESCending) N movies where release year = year
+    # N is the page size: 'more' shows the next N
+    statement_params = {'year': params['year'], **page.params('top_year', params['limit'])}
     
-    session = SessionLocal()
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('top_year', statement_params))
     except Exception as e:
         print(f"ERROR in searching documents: {e}")
-        return []
+        return ()
     
 # Function to search movies by actor or actress name
-def search_movies_by_actor(query):
-    actor_name = process_query(query)
-    if not actor_name:
+def search_movies_by_actor(route, page):
+    params = yield from process_query(route)
+    if not params or not params['name']:
         print("No actor/actress name to search for.")
-        return []
+        return ()
     # Strip extra quotes(if any) from the processed query
-    # Replace single quotes in the processed query with two single quotes
-    actor_name = actor_name.strip('"').replace("'", "''")
+    actor_name = params['name'].strip('"')
     
-    #The error we’re encountering is due to attempting to use the ILIKE operator with a PostgreSQL array (text[]), which isn't supported directly. 
-    # The ILIKE operator works with text columns, but your top_5_actors column is likely a text[] array, not a plain text field.
-    #To fix this, you need to modify the query to check each element of the array. In PostgreSQL, you can use the ANY operator to match values within arrays.
-    #instead of using this in query " top_5_actors ILIKE '%{actor_name}%'"...."  we will use " '%{actor_name}%' ILIKE ANY(top_5_actors)"
-    keyword_query = f"'{actor_name}' ILIKE ANY(top_5_actors)"
-    #The '%{actor_name}%' part was only useful for pattern matching in strings, but since top_5_actors is an array, using ILIKE ANY() already checks for any occurrence of the actor_name in the array.
-    # Thus, no wildcards are needed.
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE {keyword_query}
-        ORDER BY tmdb_rating DESC
-        LIMIT 7
-    """
-    print(f"Executing SQL Query... : {final_query}")
-
-    session = SessionLocal()
+    #top_5_actors is a text[] array and "$1 ILIKE ANY(top_5_actors)" had to scan every element of every row,
+    #so actors are looked up in the indexed movies.movie_actors table, which stores the names normalized (lowercase, single spaces)
+    #the same normalization is applied to the searched name, so the lookup stays case-insensitive like the ILIKE was
+    statement_params = {'actor_name': normalize_actor_name(actor_name), **page.params('actor')}
+
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('actor', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by actor/actress: {e}")
-        return []
+        return ()
 
-def search_movies_by_actor_and_date_range(query):
-    result = process_query(query)
-    if not result or len(result) < 3: # len(result) < 3 means process_query fn returned not all three values like actor's name, from_date and to_date 
-                                       #or one value among them is missing then we print this error
+def search_movies_by_actor_and_date_range(route, page):
+    params = yield from process_query(route)
+    if not params or not params['name']: # the router only picks this intent when the name, from-year and to-year are all present
         print("No valid actor/actress name or date range found.")
-        return [] # in this case fn will return nothing 
-    
-    actor_name, from_date, to_date = result # unpack the tuple values and save it to corresponding variables
-    actor_name = actor_name.strip('"').replace("'", "''")
+        return () # in this case fn will return nothing 
     
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE '{actor_name}' ILIKE ANY(top_5_actors) 
-        AND release_year BETWEEN {from_date} AND {to_date}
-        ORDER BY tmdb_rating DESC
-        LIMIT 10;
-    """
+    # typed (int) years captured by the router
+    actor_name = params['name'].strip('"')
+    statement_params = {'actor_name': normalize_actor_name(actor_name), 'from_year': params['from_year'], 'to_year': params['to_year'], **page.params('actor_range')}
     
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('actor_range', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by actor/actress and date range: {e}")
-        return []
+        return ()
 
 
-def search_movies_by_director(query):
-    director_name = process_query(query)
-    if not director_name:
+def search_movies_by_director(route, page):
+    params = yield from process_query(route)
+    if not params or not params['name']:
         print("No director name to search for.")
-        return []
+        return ()
     
-    director_name = director_name.strip('"').replace("'", "''")
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE director_name ILIKE '%{director_name}%'
-        ORDER BY tmdb_rating DESC
-        LIMIT 10;
-    """
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
+    director_name = params['name'].strip('"')
+    statement_params = {'pattern': contains_pattern(director_name), **page.params('director')}
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('director', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by director: {e}")
-        return []
+        return ()
 #This function will query the PostgreSQL database to find movies directed by the given director and within the specified date range:
-def search_movies_by_director_and_date_range(query):
-    result = process_query(query)
+def search_movies_by_director_and_date_range(route, page):
+    params = yield from process_query(route)
     
-    if not result or len(result) < 3:  # len(result) < 3 means process_query fn returned not all three values like director's name, from_date and to_date 
-                                       #or one value among them is missing then we print this error  
+    if not params or not params['name']:  # the router only picks this intent when the name, from-year and to-year are all present
         print("No valid director name or date range found.")
-        return []  # search function will return nothing 
-    
-    director_name, from_date, to_date = result # unpack the tuple values and save it to corresponding variables
-    director_name = director_name.strip('"').replace("'", "''")
+        return ()  # search function will return nothing 
     
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE director_name ILIKE '%{director_name}%'
-        AND release_year BETWEEN {from_date} AND {to_date}
-        ORDER BY tmdb_rating DESC
-        LIMIT 10;
-    """
+    # typed (int) years captured by the router
+    director_name = params['name'].strip('"')
+    statement_params = {'pattern': contains_pattern(director_name), 'from_year': params['from_year'], 'to_year': params['to_year'], **page.params('director_range')}
     
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('director_range', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by director and date range: {e}")
-        return []
+        return ()
 
 #This function will query the PostgreSQL database to find movies directed by the given director_name and with rating filter (ex: with ratings above/below 8):
-def searching_by_director_and_rating(query):
-    result = process_query(query)
+def searching_by_director_and_rating(route, page):
+    params = yield from process_query(route)
     
-    if not result or len(result) < 3:  # len(result) < 3 means process_query fn returned not all three values like director's name, rating operator and rating. 
-                                       #or one value among them is missing then we print this error  
+    if not params or not params['name']:  # the router only picks this intent when the name, rating operator and rating are all present
         print("No valid director name or rating found.")
-        return []  # search function will return nothing 
+        return ()  # search function will return nothing 
     
-    director_name, rating_operator, rating = result # unpack the tuple values and save it to corresponding variables
-    director_name = director_name.strip('"').replace("'", "''")
-    # Construct rating condition (above or below)
-    rating_condition = f"tmdb_rating {'>' if rating_operator == 'above' else '<'} {rating}"
-     # Construct the SQL query with rating conditions and director
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE director_name ILIKE '%{director_name}%'
-        AND {rating_condition}
-        ORDER BY tmdb_rating DESC
-        LIMIT 10;
-    """
+    director_name = params['name'].strip('"')
+    # Construct rating condition (above or below) as an open interval: above 8 -> (8, 11), below 8 -> (-1, 8)
+    rating_min, rating_max = rating_bounds(params['comparison'], params['rating'])
+    statement_params = {'pattern': contains_pattern(director_name), 'rating_min': rating_min, 'rating_max': rating_max, **page.params('director_rating')}
     
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('director_rating', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by director and date range: {e}")
-        return []
+        return ()
 
-def search_movies_by_genres(query):
-    genres = process_query(query) # storing corrected gnere_list in genres 
-    if not genres or not isinstance(genres, list):
+def search_movies_by_genres(route, page):
+    params = yield from process_query(route)
+    genre_ids = params['genre_ids'] if params else [] # storing resolved genre ids (TMDB ids, see genres.py) in genre_ids
+    if not genre_ids:
         print("No genre names to search for.")
-        return []
-    # making genre conditions:This part creates a list of SQL conditions for each genre in the genres list. where genres is a list of genre strings (e.g., ["adventure", "war", "drama"]).
-    #For each genre in this list, the expression creates a string condition:
-    #genre ILIKE '%adventure%'
-    #genre ILIKE '%war%'
-    #genre ILIKE '%drama%' 
-    genre_conditions = " AND ".join([f"genre ILIKE '%{genre}%'" for genre in genres]) #the join function combines them into a single string.
-          #" AND " is the separator used to join the conditions, meaning that the final string will look like this:genre ILIKE '%adventure%' AND genre ILIKE '%war%' AND genre ILIKE '%drama%'
-          #Example Scenario:
-          #Movie 1: "Action, Adventure"
-          #Movie 2: "War, Drama"
-          #Movie 3: "Action, War, Drama"
-          #If the user searches for genres like "action, war":
-
-         #With 'OR':
-         #Results: Movie 1 ("Action, Adventure"), Movie 2 ("War, Drama"), and Movie 3 ("Action, War, Drama") because each movie matches at least one of the genres.
-         #With 'AND':
-         #Results: Only Movie 3 ("Action, War, Drama") because it's the only movie that contains both "action" and "war" in the genre list.
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE {genre_conditions}
-        ORDER BY tmdb_rating DESC
-        LIMIT 20;
-    """
+        return ()
+    # genre condition: a movie must have ALL the requested genres, i.e. its genre_ids array must contain the requested ids.
+    # genre_ids @> ARRAY[28,10752] (action and war) is served by the GIN index on genre_ids, whereas the former chain of
+    # genre ILIKE '%action%' AND genre ILIKE '%war%' had to read and compare the genre text of every single row.
+    #Example Scenario:
+    #Movie 1: "Action, Adventure" -> {28,12}
+    #Movie 2: "War, Drama"        -> {10752,18}
+    #Movie 3: "Action, War, Drama"-> {28,10752,18}
+    #If the user searches for genres like "action, war": only Movie 3 contains both ids.
+    statement_params = {'genre_ids': genre_ids, **page.params('genres')}
     
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('genres', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by genres: {e}")
-        return []
+        return ()
 
-def searching_by_genre_rating(query):
-    result = process_query(query)
-    # Unpack genres, rating_operator, and rating from result
-    if not result or len(result) < 3:
-        # If process_query didn't return all three values (genres, rating_operator, rating)
+def searching_by_genre_rating(route, page):
+    params = yield from process_query(route)
+    if not params:
         print("No valid genres or rating information found.")
-        return []
+        return ()
 
-    genres, rating_operator, rating = result
-
-    # Check if genres is a valid list
-    if not genres or not isinstance(genres, list):
+    # Check if any genre was resolved
+    if not params['genre_ids']:
         print("No valid genre name found.")
-        return []
-    # Construct genre conditions
-    genre_conditions = " AND ".join([f"genre ILIKE '%{genre}%'" for genre in genres])
-    
-    # Construct rating condition (above or below)
-    rating_condition = f"tmdb_rating {'>' if rating_operator == 'above' else '<'} {rating}"
-    
-    # Final SQL query to search for movies
-    final_query = f"""
-        SELECT * FROM movies.movies
-        WHERE {genre_conditions}
-        AND {rating_condition}
-        ORDER BY tmdb_rating DESC
-        LIMIT 10;
-    """
-    
-    print(f"Executing SQL Query... : {final_query}")
-    session = SessionLocal()
+        return ()
+    # genre condition (array containment over the GIN indexed genre_ids) and rating condition (above or below)
+    rating_min, rating_max = rating_bounds(params['comparison'], params['rating'])
+    statement_params = {'genre_ids': params['genre_ids'], 'rating_min': rating_min, 'rating_max': rating_max, **page.params('genre_rating')}
     
     try:
-        results = session.execute(text(final_query)).fetchall()
-        print(f"Number of results found: {len(results)}")
-        return results
+        return (yield Fetch('genre_rating', statement_params))
     except Exception as e:
         print(f"ERROR in searching for movies by genres and rating: {e}")
-        return []
+        return ()
 #this function will Fetch the genres of the specified movie (like "Inception").
 # and then Search for other movies with similar genres from the movies table.
-def search_similar_movies_by_genre(query):
-    movie_name = process_query(query)
+def search_similar_movies_by_genre(route, page):
+    params = yield from process_query(route)
+    if not params or not params['title']:
+        print("No movie name to search similar movies for.")
+        return ()
     # Strip extra quotes(if any) from the processed query
-    movie_name = movie_name.strip('"')
-    #In SQL, single quotes are used to enclose string literals, and if your string contains an apostrophe (like in "Ocean's Eleven" movie),
-    # we need to escape it by doubling the single quote (''), not by replacing it with double quotes(").
-    # Replace single quotes in the processed query with two single quotes
-    movie_name = movie_name.replace("'", "''")
-    session = SessionLocal()
-    
-    # Step 1: Get the genres of the given movie
-   # Using a context manager for the session
-    with SessionLocal() as session:
-        # Step 1: Get the genres of the given movie
-        get_genres_query = f"""
-            SELECT genre
-            FROM movies.movies
-            WHERE movie_name ILIKE '%{movie_name}%'
-            LIMIT 1;
-        """
+    movie_name = params['title'].strip('"')
+    # one session for the whole search: the neighbors lookup, or the genres of the movie and then the similar movies
+
+    # Step 0: the precomputed neighbors of the movie (build_neighbors.py), one primary key lookup ;
+    # only a movie that has none yet (added after the last neighbors run) goes through the genre search below
+    if page.statement in (None, 'neighbors'):
         try:
-            result = session.execute(text(get_genres_query)).fetchone() #here we used fetchone() instead of fetchall()
-            if result is None:
-                    print(f"No genres found for movie: {movie_name}")
-                    return []
-        # Since the query is limited to one row (LIMIT 1), fetchone() will return that one row as a tuple (or None if no row is found). it Avoids unnecessary memory usage
+            neighbors = list((yield Fetch('neighbors', {'pattern': contains_pattern(movie_name), 'term': movie_name, **page.params('neighbors')})))
         except Exception as e:
-            print(f"ERROR in searching genres for movie {movie_name}: {e}") 
-            return []
-    
-        # Fetch the movie genres (as a comma-separated string)
-        movie_genres = result[0]
+            print(f"ERROR in looking up the neighbors of {movie_name}: {e}")
+            neighbors = []
+        if neighbors or not page.first: # the following pages of a neighbor list stay on the neighbor list
+            tracer.annotate(neighbors=len(neighbors))
+            return neighbors
 
-        # Step 2: Split the genres into a list
-        movie_genres_list = [genre.strip() for genre in movie_genres.split(',')]
+    # Step 1: Get the genre ids of the given movie (the closest title when several match)
+    try:
+        result = next((yield Fetch('similar_source', {'pattern': contains_pattern(movie_name), 'term': movie_name})), None) # one row at most (LIMIT 1)
+        if result is None:
+                print(f"No genres found for movie: {movie_name}")
+                return ()
+    except Exception as e:
+        print(f"ERROR in searching genres for movie {movie_name}: {e}") 
+        return ()
 
-        # Step 3: Build the SQL query to search for similar movies
-        genre_conditions = " AND ".join([f"genre ILIKE '%{genre}%'" for genre in movie_genres_list])
+    # Step 2: Fetch the movie's genre ids (a list of TMDB genre ids, e.g. [28, 878] for action + science fiction)
+    movie_genre_ids = result[0] or []
 
-        similar_movies_query = f"""
-            SELECT * 
-            FROM movies.movies 
-            WHERE {genre_conditions}
-            AND movie_name != '{movie_name}' --To ensure that this similarity-search fn excludes the movie itself from the results
-            ORDER BY tmdb_rating DESC
-            LIMIT 10;
-        """
+    # Step 3: search for similar movies: every movie whose genre_ids contain all of these,
+    # except the movie itself (movie_name <> $2)
+    statement_params = {'genre_ids': movie_genre_ids, 'movie_name': movie_name, **page.params('similar')}
 
-        print(f"Executing SQL Query... : {similar_movies_query}")
 
-        # Step 4: Execute the query and fetch results
-        try:
-            similar_movies_results = session.execute(text(similar_movies_query)).fetchall()#If we were expecting multiple rows then we would use fetchall() to retrieve them all.
-            print(f"Number of similar movies found: {len(similar_movies_results)}")
-            return similar_movies_results
-        except Exception as e:
-            print(f"ERROR in searching movies similar to {movie_name}: {e}")
-            return []
-#The Decimal issue occurs because SQLAlchemy uses Python's Decimal type for precise decimal arithmetic, which is why it is displaying Decimal('value').
-#To convert it to a float or string for display purposes, 
-#Resolving the problem: This function takes the results and formats any Decimal values to floats.
-#With this change, the Decimal values will be converted to floats, making the output cleaner and easier to read.
-def format_results(results):
-    formatted_results = []
-    for result in results:
-        formatted_result = []
-        for field in result:
-            if isinstance(field, Decimal): # if its has field specify with results 'decimal' 
-                formatted_result.append(float(field))  # then append it to the formatted results in float type 
-            else:
-                formatted_result.append(field) # else append it to the formatted results in as it's without float  type 
-        formatted_results.append(tuple(formatted_result)) # now append these formatted results as tuple in relatively global formatted _results  
-    return formatted_results 
+    # Step 4: Execute the query ; its rows are streamed to the caller
+    try:
+        return (yield Fetch('similar', statement_params))
+    except Exception as e:
+        print(f"ERROR in searching movies similar to {movie_name}: {e}")
+        return ()
+# Rendering: generators yielding the text of one result at a time, so main() prints each movie as soon as its row
+# arrives and a page of thousands of rows is never built up as one string (display_results used to grow one with +=
+# for every movie, copying everything before it each time). start numbers the results across pages.
+def render_movies(movies, start=1):
+    for i, movie in enumerate(movies, start):
+        if i == start:
+            yield "Movies Found :-\n\n"
+        yield (
+            f"{i}. {movie.movie_name} ({movie.release_year})\n\n"
+            f"Rating: {movie.tmdb_rating}\n"
+            f"Genre: {movie.genre}\n"
+            f"Director: {movie.director_name}\n"
+            f"Top Actors: {', '.join(movie.top_5_actors)}\n\n"
+        )
+
+def render_overviews(overviews, start=1):
+    for i, overview in enumerate(overviews, start):
+        if i == start:
+            yield "Movie Overviews :-\n\n"
+        yield f"{i}. {overview.movie_name}: \"{overview.overview}\"\n\n"
+
+# JSON Lines: one JSON object per result and per line (main.py --jsonl), for scripts reading the results
+def render_json_lines(rows):
+    for row in rows:
+        yield json.dumps(row._asdict(), ensure_ascii=False) + '\n'
 
 #This function formats the results into the neat and clean format.
 #It takes the list of movie details and movie overviews, and constructs a strings with the formatted results.
 def display_results(movies, overviews):
-    
-    movie_str = f"{len(movies)} Movies Found :-\n\n"
-    for i, movie in enumerate(movies, 1):
-        movie_str += (
-            f"{i}. {movie[1]} ({movie[4]})\n\n"
-            f"Rating: {movie[2]}\n"
-            f"Genre: {movie[3]}\n"
-            f"Director: {movie[5]}\n"
-            f"Top Actors: {', '.join(movie[6])}\n\n"
-        )
-
-    overview_str = "Movie Overviews :-\n\n"
-    for i, overview in enumerate(overviews, 1):
-        overview_str += f"{i}. {overview[0]}: \"{overview[1]}\"\n\n"
-    
-    
-    if overviews : # if overviews passed in fn 
-        if movies and  overviews: # along with overviews movies also passed then 
-            return movie_str + overview_str   # then display both  
-        return overview_str #else display overviews only
-    elif movies :# if movies passed in fn 
-        if movies and  overviews: # along with movies, overviews also passed then
-            return movie_str + overview_str   # then display both      
-        return movie_str  # else display movies only
-    else: # else , meaning nothing paased in this display function then 
-        return [] #return nothing 
-
-
-def main():
+    text = ''.join(render_movies(movies)) + ''.join(render_overviews(overviews))
+    return text or [] # nothing passed in this display function: return nothing
+
+
+# intent (see query_router.py) -> (search function, message printed when it finds nothing)
+SEARCH_HANDLERS = {
+    'overview': (search_overview, "No results found for overview."),
+    'top_year': (search_top_movies, "No results found for top movies."),
+    'similar': (search_similar_movies_by_genre, "No similar movies found"),
+    'plot': (search_movies_by_plot, "No movie found matching that plot."),
+    'actor_range': (search_movies_by_actor_and_date_range, "No results found for actor within the specified date range."),
+    'actor': (search_movies_by_actor, "No results found for actor/actress."),
+    'director_rating': (searching_by_director_and_rating, "No results found for the specified director and rating."),
+    'director_range': (search_movies_by_director_and_date_range, "No results found for director within the specified date range."),
+    'genre_rating': (searching_by_genre_rating, "No results found for the specified genres and rating."),
+    'genres': (search_movies_by_genres, "No results found for the specified genres."),
+    'director': (search_movies_by_director, "No results found for director."),
+    'title': (search_movies, "No results found."),
+}
+
+# runs one page of the route's search and yields its output piece by piece, as the rows come in
+# (text, or one JSON object per line with json_lines=True) ; afterwards page.next() is the following page
+def stream_answer(route, page, json_lines=False):
+    search, no_results_message = SEARCH_HANDLERS[route.intent]
+    rows = run_plan(search(route, page), page) # rows come typed and with float ratings straight from the statements: nothing to convert
+    # the plan runs up to its first row before the 'render' span opens, so rendering isn't timed with the search ;
+    # the rest of a streamed page is read while it's rendered
+    first = next(rows, None)
+    rows = chain((first,), rows) if first is not None else rows
+    with tracer.span('render') as span:
+        if json_lines:
+            yield from render_json_lines(rows)
+        elif route.intent == 'overview': # overviews are OverviewRows ; everything else is a MovieRow
+            yield from render_overviews(rows, page.offset + 1)
+        else:
+            yield from render_movies(rows, page.offset + 1)
+        span.set(rows=page.count)
+    tracer.annotate(rows=page.count)
+    if not page.count:
+        print(no_results_message)
+
+# routes the user's query once, runs the matching search and returns the formatted results of its first page
+def answer_query(user_query):
+    with tracer.query(user_query) as trace:
+        with tracer.span('route'):
+            route = route_query(user_query) # one pass: intent + typed parameters
+        trace.set(intent=route.intent)
+        return ''.join(stream_answer(route, Page())) or []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search the movies database in plain English')
+    parser.add_argument('--page-size', type=int, help="results per page (default: each search's own)")
+    parser.add_argument('--jsonl', action='store_true', help='print the results as JSON Lines')
+    args = parser.parse_args(argv)
+    warm_up() # opens the pooled connections (and prepares the statements) before the first query instead of during it
+    route = next_page = None
     while True:
-        user_query = input("Enter your query (or 'thanks, I am done here' to exit): ").strip()
+        user_query = input("Enter your query ('more' for the next page, 'thanks, I am done here' to exit): ").strip()
         if user_query.lower() == "thanks, i am done here":
+            print(format_pool_metrics())
+            print(result_cache.report())
+            if tracer.enabled:
+                print(tracer.prometheus(), end='')
             print("Thank you! Have a great day!")
             break
-
-        if "overview" in user_query.lower():
-            overview_results = search_overview(user_query)
-            if not overview_results:
-                print("No results found for overview.")
-            formatted_overview_results = format_results(overview_results)
-            display_str = display_results([], formatted_overview_results)
-            print(display_str)
-        elif "top 5 movies" in user_query.lower() and "from year" in user_query.lower():
-            top_movies_results = search_top_movies(user_query)
-            if not top_movies_results:
-                print("No results found for top movies.")
-            formatted_top_movies_results = format_results(top_movies_results)
-            display_str = display_results(formatted_top_movies_results, [])
-            print(display_str)
-        elif "movies like" in user_query.lower():
-            similar_movies_results = search_similar_movies_by_genre(user_query)
-            if not similar_movies_results:
-                print(f"No similar movies found")
-            formatted_similar_movies = format_results(similar_movies_results)
-            display_str = display_results(formatted_similar_movies, [])
-            print(display_str)
-        elif ("movies of actor" in user_query.lower() or "movies of actress" in user_query.lower()) and "from" in user_query.lower() and "to" in user_query.lower(): #check for the actor/actress and date rang
-            movies_by_actor_and_date_results = search_movies_by_actor_and_date_range(user_query)
-            if not movies_by_actor_and_date_results:
-                print("No results found for actor within the specified date range.")
-            formatted_movies_by_actor_and_date_results = format_results(movies_by_actor_and_date_results)
-            display_str = display_results(formatted_movies_by_actor_and_date_results, [])
-            print(display_str)
-        elif "movies of actor" in user_query.lower() or "movies of actress" in user_query.lower(): # <-- Added condition for actor/actress movies search
-            movies_by_actor_results = search_movies_by_actor(user_query)
-            if not movies_by_actor_results:
-                print("No results found for actor/actress.")
-            formatted_movies_by_actor_results = format_results(movies_by_actor_results)
-            display_str = display_results(formatted_movies_by_actor_results, [])
-            print(display_str)
-        elif ("movies of director" in user_query.lower()) and ("with ratings above" in user_query.lower() or "with ratings below" in user_query.lower()): # <-- Added condition for director search alongwith rating filter.
-            movies_by_director_and_rating_results = searching_by_director_and_rating(user_query) 
-            if not movies_by_director_and_rating_results:
-                print("No results found for the specified director and rating.")
-            formatted_movies_by_director_and_rating_results = format_results(movies_by_director_and_rating_results)
-            display_str = display_results(formatted_movies_by_director_and_rating_results,[])
-            print(display_str)
-        elif "movies of director" in user_query.lower() and "from" in user_query.lower() and "to" in user_query.lower():# <-- Added condition for director search alongwith date range
-            #condition for director and date range
-            movies_by_director_and_date_results = search_movies_by_director_and_date_range(user_query) 
-            if not movies_by_director_and_date_results:
-                print("No results found for director within the specified date range.")
-            formatted_movies_by_director_and_date_results = format_results(movies_by_director_and_date_results)
-            display_str = display_results(formatted_movies_by_director_and_date_results, [])
-            print(display_str) 
-        elif ("genres like" in user_query.lower() or "genre like" in user_query.lower()) and ("with ratings above" in user_query.lower() or "with ratings below" in user_query.lower()):                    
-            movies_by_genre_rating_results = searching_by_genre_rating(user_query)
-            if not movies_by_genre_rating_results:
-                print("No results found for the specified genres and rating.")
-            
-            formatted_movies_by_genre_rating_results = format_results(movies_by_genre_rating_results)
-            display_str = display_results(formatted_movies_by_genre_rating_results, [])
-            print(display_str)
-        elif "genres like" in user_query.lower() or  "genre like" in user_query.lower():
-            movies_by_genres_results = search_movies_by_genres(user_query)
-            if not movies_by_genres_results:
-                print("No results found for the specified genres.")
-            formatted_movies_by_genres_results = format_results(movies_by_genres_results)
-            display_str = display_results(formatted_movies_by_genres_results, [])
-            print(display_str)
-
-        elif "movies of director" in user_query.lower():  # <-- Added condition for director search
-            movies_by_director_results = search_movies_by_director(user_query)
-            if not movies_by_director_results:
-                print("No results found for director.")
-            formatted_movies_by_director_results = format_results(movies_by_director_results)
-            display_str = display_results(formatted_movies_by_director_results, [])
-            print(display_str)
-            
-        else:
-            results = search_movies(user_query)
-            if not results:
-                print("No results found.")
-            formatted_results = format_results(results)
-            #overview_query = f"Can you give me the overview of {formatted_results[0][1]}" if formatted_results else ""
-            #overview_results = search_overview(overview_query) if overview_query else []
-            #formatted_overview_results = format_results(overview_results)
-            display_str = display_results(formatted_results, [])
-            print(display_str)
+        more = user_query.lower() == 'more'
+        if more:
+            if next_page is None:
+                print("No more results.")
+                continue
+            page = next_page
+        with tracer.query(user_query) as trace: # one trace per query ('more' included), written once its page is shown
+            if not more:
+                with tracer.span('route'):
+                    route = route_query(user_query) # one pass: intent + typed parameters
+                page = Page(args.page_size)
+            trace.set(intent=route.intent, page=page.number)
+            for piece in stream_answer(route, page, args.jsonl):
+                print(piece, end='', flush=True)
+        next_page = page.next()
+        if next_page is not None and not args.jsonl:
+            print(f"Results {page.offset + 1}-{page.offset + page.count} ; 'more' for the next {page.size}")
                
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
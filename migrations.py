@@ -0,0 +1,117 @@
+import hashlib
+import os
+import re
+import sys
+
+from config import SessionLocal
+
+# Versioned schema migrations.
+# Every file migrations/NNNN_name.sql is one version ; `python migrations.py apply` runs the versions not applied yet
+# (each in its own transaction, in order) and records them in movies.schema_migrations together with a checksum,
+# so `python migrations.py check` can tell whether the database is behind the repo or a migration was edited afterwards.
+#
+#   python migrations.py            -> status: every version and whether it's applied
+#   python migrations.py apply      -> apply the pending versions
+#   python migrations.py check      -> exit code 1 when something is pending or an applied file changed
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+
+def available_migrations():
+    # [(version, name, sql, checksum)] sorted by version
+    migrations = []
+    for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(file_name)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, file_name), encoding='utf-8') as sql_file:
+            sql = sql_file.read()
+        migrations.append((int(match.group(1)), match.group(2), sql, hashlib.sha256(sql.encode('utf-8')).hexdigest()))
+    return migrations
+
+
+def _run_sql(session, sql):
+    # straight through the DBAPI cursor: the files hold several statements and may contain % (e.g. in comments),
+    # which the driver would otherwise take for parameter placeholders
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(sql)
+    finally:
+        cursor.close()
+
+
+def applied_migrations(session):
+    _run_sql(session, """
+        CREATE TABLE IF NOT EXISTS movies.schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    session.commit()
+    rows = session.connection().exec_driver_sql("SELECT version, checksum FROM movies.schema_migrations").fetchall()
+    return {version: checksum for version, checksum in rows}
+
+
+def status(session):
+    # [(version, name, state)] with state 'applied', 'pending' or 'changed' (applied, but the file was edited since)
+    applied = applied_migrations(session)
+    states = []
+    for version, name, _, checksum in available_migrations():
+        if version not in applied:
+            states.append((version, name, 'pending'))
+        elif applied[version].strip() != checksum:
+            states.append((version, name, 'changed'))
+        else:
+            states.append((version, name, 'applied'))
+    return states
+
+
+def apply(session):
+    applied = applied_migrations(session)
+    count = 0
+    for version, name, sql, checksum in available_migrations():
+        if version in applied:
+            continue
+        print(f"Applying migration {version:04d}_{name} ...")
+        try:
+            _run_sql(session, sql)
+            session.connection().exec_driver_sql(
+                "INSERT INTO movies.schema_migrations (version, name, checksum) VALUES (%(version)s, %(name)s, %(checksum)s)",
+                {'version': version, 'name': name, 'checksum': checksum},
+            )
+            session.commit()
+            count += 1
+        except Exception as e:
+            session.rollback()
+            print(f"ERROR in applying migration {version:04d}_{name}: {e}")
+            raise
+    return count
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'status'
+    session = SessionLocal()
+    try:
+        if command == 'apply':
+            count = apply(session)
+            print(f"{count} migration(s) applied.")
+            return 0
+        states = status(session)
+        for version, name, state in states:
+            print(f"{version:04d}_{name:<30} {state}")
+        if command == 'check':
+            behind = [state for _, _, state in states if state != 'applied']
+            if behind:
+                print(f"Database schema is not up to date: {len(behind)} migration(s) pending or changed.")
+                return 1
+            print("Database schema is up to date.")
+        return 0
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,21 @@
+-- Closed-vocabulary genres: TMDB's genre ids stored as SMALLINT[] next to the display string in "genre".
+-- genre filters become "genre_ids @> ARRAY[28, 35]::smallint[]" (contains all of these genres), which the GIN index serves,
+-- instead of a chain of "genre ILIKE '%action%' AND genre ILIKE '%comedy%'" that has to scan every row.
+ALTER TABLE movies.movies ADD COLUMN IF NOT EXISTS genre_ids SMALLINT[] NOT NULL DEFAULT '{}';
+
+-- backfilling rows inserted before this column existed, from their comma separated genre names (same table as genres.py)
+UPDATE movies.movies m
+SET genre_ids = ARRAY(
+    SELECT g.id
+    FROM (VALUES
+        (28, 'Action'), (12, 'Adventure'), (16, 'Animation'), (35, 'Comedy'), (80, 'Crime'),
+        (99, 'Documentary'), (18, 'Drama'), (10751, 'Family'), (14, 'Fantasy'), (36, 'History'),
+        (27, 'Horror'), (10402, 'Music'), (9648, 'Mystery'), (10749, 'Romance'), (878, 'Science Fiction'),
+        (10770, 'TV Movie'), (53, 'Thriller'), (10752, 'War'), (37, 'Western')
+    ) AS g(id, name)
+    WHERE g.name = ANY(string_to_array(m.genre, ', '))
+    ORDER BY g.id
+)::smallint[]
+WHERE m.genre_ids = '{}' AND m.genre IS NOT NULL AND m.genre <> '';
+
+CREATE INDEX IF NOT EXISTS movies_genre_ids_gin ON movies.movies USING GIN (genre_ids);
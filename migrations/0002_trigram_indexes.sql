@@ -0,0 +1,10 @@
+-- Substring search on titles and director names.
+-- search_movies, search_overview and every director search filter with ILIKE '%term%', which a B-tree can't serve,
+-- so each of them was a sequential scan growing with every page populate_movies.py adds.
+-- pg_trgm GIN indexes serve ILIKE '%term%' directly (case-insensitively, so no separate lower() index is needed
+-- for these searches) and provide similarity() to rank the matches by closeness (an exact title scores 1.0, so it comes first).
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS movies_movie_name_trgm ON movies.movies USING GIN (movie_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS movies_director_name_trgm ON movies.movies USING GIN (director_name gin_trgm_ops);
+
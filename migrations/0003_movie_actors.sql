@@ -0,0 +1,15 @@
+-- Normalized actor index.
+-- "'tom hanks' ILIKE ANY(top_5_actors)" has to unnest and compare every array element of every row, and no index helps.
+-- movie_actors holds one row per (movie, billed actor) with the actor's name normalized the same way as
+-- movie_actors.normalize_actor_name() (lowercase, single spaces), so an actor search is an indexed equality lookup.
+-- top_5_actors stays on movies.movies for display.
+CREATE TABLE IF NOT EXISTS movies.movie_actors (
+    movie_id INT NOT NULL REFERENCES movies.movies(id) ON DELETE CASCADE,
+    actor_name_normalized VARCHAR(255) NOT NULL,
+    billing_order SMALLINT NOT NULL, -- 1 for the top billed actor ... 5
+    PRIMARY KEY (movie_id, billing_order)
+);
+
+CREATE INDEX IF NOT EXISTS movie_actors_name ON movies.movie_actors (actor_name_normalized, movie_id);
+
+-- rows that already exist are filled by: python backfill_movie_actors.py
@@ -0,0 +1,14 @@
+-- Precomputed "movies like X".
+-- search_similar_movies_by_genre looked up the movie's genres and then scanned for every movie containing them, on every
+-- request, although the answer only changes when the catalog does. build_neighbors.py computes the top similar movies of
+-- every movie offline (genre overlap, director, shared cast and overview similarity) and stores them here, best first,
+-- so "movies like X" is one lookup on the primary key.
+CREATE TABLE IF NOT EXISTS movies.movie_neighbors (
+    movie_id INT NOT NULL REFERENCES movies.movies(id) ON DELETE CASCADE,
+    rank SMALLINT NOT NULL, -- 1 = most similar
+    neighbor_id INT NOT NULL REFERENCES movies.movies(id) ON DELETE CASCADE,
+    score REAL NOT NULL,
+    PRIMARY KEY (movie_id, rank)
+);
+
+-- filled by: python build_neighbors.py (everything) / python build_neighbors.py --incremental (movies added since)
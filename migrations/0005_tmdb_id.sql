@@ -0,0 +1,11 @@
+-- Natural key of a movie: its TMDB id.
+-- The ingest used to find out whether a movie was already stored with a SELECT on (movie_name, release_year) per movie,
+-- which also merged different movies sharing a title and a year. With tmdb_id unique the bulk writer (bulk_writer.py)
+-- upserts whole batches with INSERT ... ON CONFLICT (tmdb_id) DO UPDATE, so re-running a page updates instead of duplicating.
+ALTER TABLE movies.movies ADD COLUMN IF NOT EXISTS tmdb_id INT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS movies_tmdb_id ON movies.movies (tmdb_id);
+
+-- rows stored before this migration have no tmdb_id ; the bulk writer claims them by (movie_name, release_year) the
+-- first time it meets their movie again, and this partial index (empty once every old row is claimed) serves that lookup
+CREATE INDEX IF NOT EXISTS movies_without_tmdb_id ON movies.movies (movie_name, release_year) WHERE tmdb_id IS NULL;
@@ -0,0 +1,17 @@
+-- Progress of the TMDB crawl, one row per discover page of a date range.
+-- The populate scripts were restarted by editing start_page by hand, and a failure anywhere in a 100-page batch rolled
+-- the whole batch back. Now every page is written and checkpointed in one transaction, and --resume only fetches the
+-- pages of a range that aren't 'done' yet (the missing ones and the 'failed' ones).
+-- A crawl without a date range uses '-infinity' / 'infinity' as its bounds.
+CREATE TABLE IF NOT EXISTS movies.ingest_checkpoints (
+    range_start DATE NOT NULL,
+    range_end DATE NOT NULL,
+    page INT NOT NULL,
+    status VARCHAR(16) NOT NULL CHECK (status IN ('done', 'failed')),
+    movies INT NOT NULL DEFAULT 0, -- movies written from the page
+    attempts INT NOT NULL DEFAULT 1,
+    error TEXT, -- why the last attempt failed
+    started_at TIMESTAMPTZ NOT NULL,
+    finished_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (range_start, range_end, page)
+);
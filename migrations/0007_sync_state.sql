@@ -0,0 +1,8 @@
+-- High-water marks of the incremental sync (sync.py).
+-- TMDB's /movie/changes lists the movies changed in a time window ; sync.py updates the stored ones and then moves the
+-- mark forward, so the next run only reads the changes since the last one instead of re-crawling every discover page.
+CREATE TABLE IF NOT EXISTS movies.sync_state (
+    name VARCHAR(64) PRIMARY KEY, -- 'movie_changes'
+    high_water TIMESTAMPTZ NOT NULL, -- every change before it is applied
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
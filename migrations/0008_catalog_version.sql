@@ -0,0 +1,10 @@
+-- Version of the catalog, for the result cache of the searches (result_cache.py).
+-- Every transaction that changes what a search can return (bulk_writer.py for the ingest and the sync, build_neighbors.py,
+-- backfill_movie_actors.py) adds one to it ; a search process that sees a new version drops its cached results.
+-- One row, updated in the writer's own transaction: a reader never sees the new version before the rows it stands for.
+CREATE TABLE IF NOT EXISTS movies.catalog_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), -- at most one row
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO movies.catalog_version (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,12 @@
+-- Which neighbor lists are stale.
+-- build_neighbors.py --incremental used to compute only the movies without any row in movie_neighbors, so a movie whose
+-- genres, director, cast or overview changed (sync.py, a re-crawl, the actor backfill) kept the list of its old version.
+-- Every writer of a movie's content adds one to its revision, in the same transaction (bulk_writer.py,
+-- backfill_movie_actors.py) ; build_neighbors.py records the revision its features were read at. A movie whose list was
+-- computed from another revision than the current one (or never) is stale.
+ALTER TABLE movies.movies ADD COLUMN IF NOT EXISTS revision INT NOT NULL DEFAULT 0;
+ALTER TABLE movies.movies ADD COLUMN IF NOT EXISTS neighbors_revision INT; -- NULL = no list computed yet
+
+-- the lists stored before this migration are taken as current (that's all the former --incremental knew about them)
+UPDATE movies.movies m SET neighbors_revision = m.revision
+WHERE m.neighbors_revision IS NULL AND EXISTS (SELECT 1 FROM movies.movie_neighbors n WHERE n.movie_id = m.id);
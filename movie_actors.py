@@ -0,0 +1,27 @@
+import re
+
+# Helpers for movies.movie_actors (see migrations/0003_movie_actors.sql), the normalized (movie_id, actor, billing order)
+# table the actor searches join against instead of scanning top_5_actors with ILIKE ANY.
+# Shared by the ingest scripts, the backfill job and the search side, so all of them normalize names the same way.
+
+
+def normalize_actor_name(name):
+    # "  Tom   HANKS " -> "tom hanks" ; the SQL twin in backfill_movie_actors.py must stay equivalent
+    return re.sub(r'\s+', ' ', name.strip()).lower()
+
+
+def replace_movie_actors(cur, actors_by_movie, page_size=1000):
+    # {movie_id: actor names} -> the billed actors of those movies are exactly these ; billing_order follows the list
+    # (one DELETE and one multi-row INSERT, however many movies)
+    from psycopg2.extras import execute_values
+    if not actors_by_movie:
+        return
+    rows = [
+        (movie_id, normalize_actor_name(actor_name), billing_order)
+        for movie_id, actor_names in actors_by_movie.items()
+        for billing_order, actor_name in enumerate(actor_names, 1)
+        if actor_name and actor_name.strip()
+    ]
+    cur.execute("DELETE FROM movies.movie_actors WHERE movie_id = ANY(%s)", (list(actors_by_movie),))
+    if rows:
+        execute_values(cur, "INSERT INTO movies.movie_actors (movie_id, actor_name_normalized, billing_order) VALUES %s", rows, page_size=page_size)
@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from heapq import nlargest
+from operator import itemgetter
+
+from sqlalchemy.sql import text
+
+from result_cache import read_catalog_version
+from tracing import tracer
+
+# Local correction engine for movie titles, director names and actor/actress names.
+# Every valid answer the LLM could give us already exists in movies.movies, so we load those names once and answer
+#   - exact lookups (case/spacing insensitive),
+#   - prefix completion ("incep" -> "Inception") through a sorted list + bisect, and
+#   - edit-distance correction ("christpher nolan" -> "Christopher Nolan") through a trigram index that picks a few
+#     candidates which are then ranked by a bounded Levenshtein distance,
+# each with a confidence score between 0 and 1. main.py only falls back to the complete_correct* LLM prompts when the
+# local confidence stays below NAME_CORRECTION_THRESHOLD (default 0.8).
+
+CONFIDENCE_THRESHOLD = float(os.getenv('NAME_CORRECTION_THRESHOLD', 0.8))
+MIN_PREFIX_LENGTH = 3  # "th" is a prefix of thousands of titles ; completing from less than 3 characters is guessing
+MAX_PREFIX_SCAN = 200  # for very common prefixes we only look at the first 200 names of the sorted range
+MAX_CANDIDATES = 5  # how many trigram candidates get the (expensive) exact edit distance
+MAX_EDIT_DISTANCE = 3
+STOP_TRIGRAM_SHARE = 0.05  # trigrams shared by more than 5% of the names (like " th") tell us nothing and are skipped
+
+# SQL used to build the dictionaries ; the weight of a name is how many movies it appears in,
+# so with two equally close candidates the more prolific one wins
+NAME_QUERIES = {
+    'movie': "SELECT movie_name, COUNT(*) FROM movies.movies WHERE movie_name IS NOT NULL GROUP BY movie_name",
+    'director': "SELECT director_name, COUNT(*) FROM movies.movies WHERE director_name IS NOT NULL AND director_name <> 'Unknown' GROUP BY director_name",
+    'actor': "SELECT actor_name, COUNT(*) FROM movies.movies, unnest(top_5_actors) AS actor_name WHERE actor_name IS NOT NULL GROUP BY actor_name",
+}
+
+
+def normalize_name(name):
+    name = name.strip().strip('"\'').lower()
+    name = re.sub(r'[^\w\s]', ' ', name)  # "spider-man" and "spider man" should look the same
+    return re.sub(r'\s+', ' ', name).strip()
+
+
+def trigrams(normalized):
+    padded = f"  {normalized} "  # padding (like pg_trgm does) so the first letters weigh as much as the middle ones
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, max_distance):
+    # classic Levenshtein with two rows, giving up as soon as every cell of a row is above max_distance
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class NameIndex:
+    def __init__(self, names_with_weights):
+        # names_with_weights: iterable of (original_name, weight)
+        self.names = []  # original spelling (what we hand to the SQL search)
+        self.normalized = []  # normalized spelling, same position as in self.names
+        self.weights = []
+        self.exact = {}  # normalized name -> position
+        best_weight = {}
+        for name, weight in names_with_weights:
+            key = normalize_name(name)
+            if not key:
+                continue
+            if key in self.exact:
+                # two spellings normalizing to the same key: keep the more frequent one
+                position = self.exact[key]
+                self.weights[position] += weight
+                if weight > best_weight[key]:
+                    self.names[position] = name
+                    best_weight[key] = weight
+                continue
+            self.exact[key] = len(self.names)
+            best_weight[key] = weight
+            self.names.append(name)
+            self.normalized.append(key)
+            self.weights.append(weight)
+
+        self.sorted_keys = sorted(self.exact)  # for prefix completion via bisect
+
+        self.trigram_index = defaultdict(list)  # trigram -> positions of the names containing it
+        for position, key in enumerate(self.normalized):
+            for gram in trigrams(key):
+                self.trigram_index[gram].append(position)
+        self.stop_limit = max(50, int(len(self.names) * STOP_TRIGRAM_SHARE))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefix_match(self, key):
+        if len(key) < MIN_PREFIX_LENGTH:
+            return None, 0.0
+        start = bisect_left(self.sorted_keys, key)
+        best = None
+        for candidate in self.sorted_keys[start:start + MAX_PREFIX_SCAN]:
+            if not candidate.startswith(key):
+                break
+            position = self.exact[candidate]
+            if best is None or self.weights[position] > self.weights[best]:
+                best = position
+        if best is None:
+            return None, 0.0
+        # the more of the name the user already typed, the surer we are: "incep" -> 0.82, "inceptio" -> 0.96
+        return best, 0.6 + 0.4 * len(key) / len(self.normalized[best])
+
+    def _fuzzy_match(self, key):
+        counts = Counter()
+        for gram in trigrams(key):
+            postings = self.trigram_index.get(gram)
+            if postings and len(postings) <= self.stop_limit:
+                counts.update(postings)  # Counter.update on a list counts in C, much faster than a python loop
+        if not counts:
+            return None, 0.0
+        # only the few names sharing the most trigrams (and of similar length) get the exact edit distance
+        candidates = [position for position, _ in nlargest(MAX_CANDIDATES * 4, counts.items(), key=itemgetter(1))]
+        best, best_distance = None, MAX_EDIT_DISTANCE + 1
+        checked = 0
+        for position in candidates:
+            if checked >= MAX_CANDIDATES:
+                break
+            candidate = self.normalized[position]
+            if abs(len(candidate) - len(key)) > MAX_EDIT_DISTANCE:
+                continue
+            checked += 1
+            distance = edit_distance(key, candidate, MAX_EDIT_DISTANCE)
+            if distance < best_distance or (distance == best_distance and best is not None and self.weights[position] > self.weights[best]):
+                best, best_distance = position, distance
+        if best is None or best_distance > MAX_EDIT_DISTANCE:
+            return None, 0.0
+        return best, 1.0 - best_distance / max(len(key), len(self.normalized[best]))
+
+    def correct(self, raw_name):
+        # returns (corrected_name, confidence) ; (None, 0.0) when nothing plausible is known
+        key = normalize_name(raw_name)
+        if not key or not self.names:
+            return None, 0.0
+        position = self.exact.get(key)
+        if position is not None:
+            return self.names[position], 1.0
+        prefix_position, prefix_confidence = self._prefix_match(key)
+        fuzzy_position, fuzzy_confidence = self._fuzzy_match(key)
+        if prefix_confidence >= fuzzy_confidence and prefix_position is not None:
+            return self.names[prefix_position], prefix_confidence
+        if fuzzy_position is not None:
+            return self.names[fuzzy_position], fuzzy_confidence
+        return None, 0.0
+
+
+class NameCorrector:
+    # holds one NameIndex per kind ('movie', 'director', 'actor') ; the dictionaries are loaded lazily from the
+    # database the first time a kind is needed, so a search that never corrects a director never loads directors ;
+    # they are snapshots of the catalog, replaced by reloaded() when movies.catalog_version moves (main.refresh_snapshots)
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self.indexes = {}
+        self.versions = {}  # kind -> catalog version its names were read at
+        self._lock = threading.Lock()
+
+    def load(self, kind, names_with_weights):
+        self.indexes[kind] = NameIndex(names_with_weights)
+        return self.indexes[kind]
+
+    def index(self, kind):
+        if kind in self.indexes:
+            return self.indexes[kind]
+        with self._lock:
+            if kind not in self.indexes:
+                started = time.perf_counter()
+                names = []
+                if self.session_factory is not None:
+                    session = self.session_factory()
+                    try:
+                        version = read_catalog_version(session)  # read first: a write after it makes the snapshot newer, never older
+                        names = session.execute(text(NAME_QUERIES[kind])).fetchall()
+                        self.versions[kind] = version
+                    except Exception as e:
+                        # LLM fallback keeps working ; the empty index isn't kept, the next correction tries again
+                        print(f"ERROR in loading {kind} names for local correction: {e}")
+                        return NameIndex([])
+                    finally:
+                        session.close()
+                self.load(kind, names)
+                print(f"Loaded {len(self.indexes[kind])} {kind} names for local correction in {time.perf_counter() - started:.2f}s")
+        return self.indexes[kind]
+
+    def correct(self, kind, raw_name):
+        return self.index(kind).correct(raw_name)
+
+    def stale(self, version):
+        # whether a loaded dictionary was read at another catalog version
+        return any(kind_version != version for kind_version in self.versions.values())
+
+    def reloaded(self):
+        # a new corrector with the kinds loaded here read again ; this one keeps answering until the caller swaps them
+        fresh = NameCorrector(self.session_factory)
+        for kind in list(self.versions):
+            fresh.index(kind)
+        return fresh
+
+
+def local_correction(corrector, kind, raw_name, threshold=CONFIDENCE_THRESHOLD):
+    # the corrected name when the local engine is confident enough, otherwise None (-> caller asks the LLM)
+    corrected, confidence = corrector.correct(kind, raw_name)
+    if corrected is not None and confidence >= threshold:
+        tracer.annotate(corrected_name=corrected, corrected_locally=True, confidence=round(confidence, 2))
+        return corrected
+    return None
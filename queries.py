@@ -0,0 +1,350 @@
+import base64
+import binascii
+import json
+import re
+from collections import namedtuple
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text
+
+# Query layer of the search intents.
+# Every intent is ONE fixed statement with bind variables ($1, $2, ...) instead of an f-string with the user's text
+# pasted in: no more quote escaping / injection surface, and because the text of the statement never changes, Postgres
+# can parse and plan it once. Each statement is PREPAREd the first time it runs on a pooled connection (the set of
+# statements already prepared is kept in connection.info, which follows the DBAPI connection through the pool) and
+# every later call is a plain EXECUTE name(...) that reuses the prepared plan.
+#
+# Statement: name (of the prepared statement), arg_types (Postgres types of $1..$n), sql, args (param names for $1..$n),
+# row (type of its rows, see below ; None: plain rows)
+Statement = namedtuple('Statement', ['name', 'arg_types', 'sql', 'args', 'row'], defaults=(None,))
+
+# Row types of the searches. The rows used to come back as whatever the driver made of SELECT'ed columns (a Decimal
+# for every rating), then main.format_results walked every field of every row to turn the Decimals into floats and
+# rebuilt each tuple, and the display read movie[1], movie[6] by position. Now the statements select exactly the
+# columns shown, the rating arrives as a float8 (cast by Postgres, so the driver builds a float directly), and every row
+# is built straight into a namedtuple (no per-instance __dict__, fields by name) by its type's _make.
+MovieRow = namedtuple('MovieRow', ['id', 'movie_name', 'tmdb_rating', 'genre', 'release_year', 'director_name', 'top_5_actors'])
+OverviewRow = namedtuple('OverviewRow', ['movie_name', 'overview'])
+
+# explicit column list rather than SELECT *: a prepared SELECT * breaks ("cached plan must not change result type")
+# as soon as a column is added to movies.movies, and MovieRow follows this column order ; id is the keyset of the pages
+MOVIE_COLUMNS = "id, movie_name, tmdb_rating::float8 AS tmdb_rating, genre, release_year, director_name, top_5_actors"
+BY_RATING = "ORDER BY tmdb_rating DESC NULLS LAST, id"  # unrated movies last ; id makes ties deterministic
+BY_SIMILARITY = "ORDER BY similarity(movie_name, $2) DESC, id"  # pg_trgm closeness of the title to the searched term
+# IN rather than a join: an actor credited twice in a movie's top 5 (two roles) must not return the movie twice
+ACTOR_MOVIE_IDS = "(SELECT movie_id FROM movies.movie_actors WHERE actor_name_normalized = $1)"
+
+# keyset of the rating-ordered statements (see Page below): only the rows after the (rating, id) of the last row shown,
+# in BY_RATING order ; unrated movies count as -1, below any rating, which is where NULLS LAST puts them
+RATING_KEY = "COALESCE(tmdb_rating, -1)"
+
+
+def after_key(rating, movie_id):
+    # keyset condition on the bind variables $rating, $movie_id
+    return f"({RATING_KEY} < ${rating} OR ({RATING_KEY} = ${rating} AND id > ${movie_id}))"
+
+
+STATEMENTS = {
+    # title matches (served by the pg_trgm GIN index, see migrations/0002) come back closest first
+    'title': Statement(
+        'search_title', ('text', 'text', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE movie_name ILIKE $1 {BY_SIMILARITY} LIMIT $3 OFFSET $4",
+        ('pattern', 'term', 'limit', 'offset'), MovieRow),
+    'overview': Statement(
+        'search_overview', ('text', 'text', 'int', 'int'),
+        "SELECT m.movie_name, o.overview FROM movies.movies m JOIN movies.movie_overviews o ON m.id = o.movie_id "
+        "WHERE m.movie_name ILIKE $1 ORDER BY similarity(m.movie_name, $2) DESC, m.id LIMIT $3 OFFSET $4",
+        ('pattern', 'term', 'limit', 'offset'), OverviewRow),
+    'top_year': Statement(
+        'search_top_year', ('int', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE release_year = $1 AND {after_key(2, 3)} {BY_RATING} LIMIT $4",
+        ('year', 'after_rating', 'after_id', 'limit'), MovieRow),
+    # actors go through the movie_actors index (see migrations/0003) ; $1 is movie_actors.normalize_actor_name() of the name
+    'actor': Statement(
+        'search_actor', ('text', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE id IN {ACTOR_MOVIE_IDS} AND {after_key(2, 3)} {BY_RATING} LIMIT $4",
+        ('actor_name', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'actor_range': Statement(
+        'search_actor_range', ('text', 'int', 'int', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE id IN {ACTOR_MOVIE_IDS} AND release_year BETWEEN $2 AND $3 AND {after_key(4, 5)} {BY_RATING} LIMIT $6",
+        ('actor_name', 'from_year', 'to_year', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'director': Statement(
+        'search_director', ('text', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE director_name ILIKE $1 AND {after_key(2, 3)} {BY_RATING} LIMIT $4",
+        ('pattern', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'director_range': Statement(
+        'search_director_range', ('text', 'int', 'int', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE director_name ILIKE $1 AND release_year BETWEEN $2 AND $3 AND {after_key(4, 5)} {BY_RATING} LIMIT $6",
+        ('pattern', 'from_year', 'to_year', 'after_rating', 'after_id', 'limit'), MovieRow),
+    # "above 8" / "below 8" are both an open rating interval, so one statement serves both: (8, 11) or (-1, 8)
+    'director_rating': Statement(
+        'search_director_rating', ('text', 'numeric', 'numeric', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE director_name ILIKE $1 AND tmdb_rating > $2 AND tmdb_rating < $3 AND {after_key(4, 5)} {BY_RATING} LIMIT $6",
+        ('pattern', 'rating_min', 'rating_max', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'genres': Statement(
+        'search_genres', ('smallint[]', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE genre_ids @> $1 AND {after_key(2, 3)} {BY_RATING} LIMIT $4",
+        ('genre_ids', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'genre_rating': Statement(
+        'search_genre_rating', ('smallint[]', 'numeric', 'numeric', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE genre_ids @> $1 AND tmdb_rating > $2 AND tmdb_rating < $3 AND {after_key(4, 5)} {BY_RATING} LIMIT $6",
+        ('genre_ids', 'rating_min', 'rating_max', 'after_rating', 'after_id', 'limit'), MovieRow),
+    'similar_source': Statement(
+        'search_similar_source', ('text', 'text'),
+        f"SELECT genre_ids FROM movies.movies WHERE movie_name ILIKE $1 {BY_SIMILARITY} LIMIT 1",
+        ('pattern', 'term')),
+    # rows (or overviews) of the movies found by the plot / keyword searches (semantic_index.py, fulltext_index.py), in any order
+    'by_ids': Statement(
+        'search_by_ids', ('int[]',),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE id = ANY($1)",
+        ('movie_ids',), MovieRow),
+    'overviews_by_ids': Statement(
+        'search_overviews_by_ids', ('int[]',),
+        "SELECT m.id, m.movie_name, o.overview FROM movies.movies m JOIN movies.movie_overviews o ON m.id = o.movie_id WHERE m.id = ANY($1)",
+        ('movie_ids',)),
+    # "movies like X" from the precomputed neighbors (see migrations/0004, build_neighbors.py): the closest title's
+    # neighbor list, best first, in one round trip served by the primary key of movie_neighbors (ranks run 1, 2, 3, ...
+    # so the rank is the keyset of its pages)
+    'neighbors': Statement(
+        'search_neighbors', ('text', 'text', 'int', 'int'),
+        f"SELECT {', '.join('m.' + column for column in MOVIE_COLUMNS.split(', '))} FROM movies.movie_neighbors n "
+        "JOIN movies.movies m ON m.id = n.neighbor_id "
+        "WHERE n.movie_id = (SELECT id FROM movies.movies WHERE movie_name ILIKE $1 ORDER BY similarity(movie_name, $2) DESC, id LIMIT 1) "
+        "AND n.rank > $3 ORDER BY n.rank LIMIT $4",
+        ('pattern', 'term', 'after_rank', 'limit'), MovieRow),
+    'similar': Statement(
+        'search_similar', ('smallint[]', 'text', 'numeric', 'int', 'int'),
+        f"SELECT {MOVIE_COLUMNS} FROM movies.movies WHERE genre_ids @> $1 AND movie_name <> $2 AND {after_key(3, 4)} {BY_RATING} LIMIT $5",
+        ('genre_ids', 'movie_name', 'after_rating', 'after_id', 'limit'), MovieRow),
+}
+KEYSET_STATEMENTS = frozenset(name for name, statement in STATEMENTS.items() if 'after_id' in statement.args)
+
+# Pagination.
+# Every search shows one page at a time and the next page starts where the last one ended, without OFFSET for the
+# rating-ordered statements: they continue after the (tmdb_rating, id) of the last row shown (keyset), so page 50 costs
+# what page 1 costs and a movie added meanwhile doesn't shift rows between pages. The similarity-ranked searches (title,
+# overview: a few ILIKE matches ranked against the searched term, no stored sort key) and the ranked id lists of the
+# plot / keyword searches continue at an offset instead ; the neighbors continue after a rank.
+# Default page sizes are the LIMITs the statements used to hard-code ; 'keyword' and 'plot' are the in-process
+# rankings of fulltext_index.py / semantic_index.py.
+PAGE_SIZES = {
+    'title': 10, 'overview': 7, 'top_year': 5, 'actor': 7, 'actor_range': 10, 'director': 10, 'director_range': 10,
+    'director_rating': 10, 'genres': 20, 'genre_rating': 10, 'neighbors': 10, 'similar': 10, 'keyword': 10, 'plot': 7,
+}
+FIRST_RATING = 11  # above any rating: the first page starts at the top
+NULL_RATING = -1  # RATING_KEY of an unrated movie
+
+# pages of more than STREAM_MIN_ROWS rows are read through a server-side cursor, STREAM_BATCH_SIZE rows per round trip
+STREAM_MIN_ROWS = 200
+STREAM_BATCH_SIZE = 100
+
+
+class Page:
+    # one page of a search: the statement that answers it, where it starts (keyset / offset) and its size ;
+    # rows() counts the rows going through it, and next() is the page after the last of them
+    __slots__ = ('size', 'statement', 'after_rating', 'after_id', 'offset', 'number', 'count', 'last')
+
+    def __init__(self, size=None, statement=None, after_rating=FIRST_RATING, after_id=0, offset=0, number=1):
+        self.size = size  # None: the statement's PAGE_SIZES entry
+        self.statement = statement  # None: not run yet (the search picks its statement)
+        self.after_rating = after_rating
+        self.after_id = after_id
+        self.offset = offset  # rows shown on the previous pages
+        self.number = number
+        self.count = 0
+        self.last = None
+
+    @property
+    def first(self):
+        return self.number == 1
+
+    def params(self, statement, default_size=None):
+        # paging bind variables of statement for this page ; the page remembers the statement for next()
+        self.statement = statement
+        if self.size is None:
+            self.size = default_size or PAGE_SIZES[statement]
+        if statement in KEYSET_STATEMENTS:
+            return {'after_rating': self.after_rating, 'after_id': self.after_id, 'limit': self.size}
+        if statement == 'neighbors':
+            return {'after_rank': self.offset, 'limit': self.size}
+        return {'offset': self.offset, 'limit': self.size}
+
+    def rows(self, rows):
+        # passes rows through (lazily), counting them
+        for row in rows:
+            self.count += 1
+            self.last = row
+            yield row
+
+    def next(self):
+        # the page after this one (once its rows went through rows()), or None when this one wasn't full
+        if self.statement is None or self.count < self.size:
+            return None
+        after_rating, after_id = self.after_rating, self.after_id
+        if self.statement in KEYSET_STATEMENTS:
+            after_rating = NULL_RATING if self.last.tmdb_rating is None else self.last.tmdb_rating
+            after_id = self.last.id
+        return Page(self.size, self.statement, after_rating, after_id, self.offset + self.count, self.number + 1)
+
+    def token(self):
+        # the page as an opaque cursor (URL-safe base64 of JSON), for clients that can't keep the Page (service.py)
+        state = [self.size, self.statement, self.after_rating, self.after_id, self.offset, self.number]
+        return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode().rstrip('=')
+
+    @classmethod
+    def from_token(cls, token):
+        # Page of a token() ; ValueError for anything that isn't one
+        try:
+            size, statement, after_rating, after_id, offset, number = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+            raise ValueError(f"invalid page token: {e}")
+        if statement not in PAGE_SIZES or not all(isinstance(value, (int, float)) for value in (size, after_rating, after_id, offset, number)):
+            raise ValueError("invalid page token")
+        return cls(int(size), statement, after_rating, int(after_id), int(offset), int(number))
+
+
+# prepares: statements PREPAREd (once per pooled connection) ; plan_cache_hits: EXECUTEs that reused a prepared statement
+statement_stats = {'prepares': 0, 'plan_cache_hits': 0, 're_prepares': 0}
+
+UNDEFINED_PREPARED_STATEMENT = '26000'  # SQLSTATE raised when a connection lost its prepared statements (e.g. DISCARD ALL)
+
+
+def contains_pattern(value):
+    # ILIKE pattern matching value anywhere ; % and _ typed by the user are matched literally
+    return '%' + like_literal(value) + '%'
+
+
+def like_literal(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def rating_bounds(comparison, rating):
+    # 'above' 8 -> (8, 11) ; 'below' 8 -> (-1, 8) (tmdb_rating is DECIMAL(3, 2) between 0 and 10)
+    return (rating, 11) if comparison == 'above' else (-1, rating)
+
+
+def _prepare(connection, statement):
+    arg_types = ', '.join(statement.arg_types)
+    connection.exec_driver_sql(f"PREPARE {statement.name} ({arg_types}) AS {statement.sql}")
+    connection.info.setdefault('prepared_statements', set()).add(statement.name)
+    statement_stats['prepares'] += 1
+
+
+def execute_statement(session, intent, params):
+    # runs the statement of the intent with params (dict holding at least the statement's args) ; returns the Result
+    statement = STATEMENTS[intent]
+    connection = session.connection()
+    if statement.name in connection.info.get('prepared_statements', ()):
+        statement_stats['plan_cache_hits'] += 1
+    else:
+        _prepare(connection, statement)
+    placeholders = ', '.join(f':{arg}' for arg in statement.args)
+    execute = text(f"EXECUTE {statement.name} ({placeholders})")
+    values = {arg: params[arg] for arg in statement.args}
+    try:
+        return session.execute(execute, values)
+    except DBAPIError as e:
+        if getattr(e.orig, 'pgcode', None) != UNDEFINED_PREPARED_STATEMENT:
+            raise
+        # the pooled connection forgot the statement (DISCARD ALL, DEALLOCATE): it comes off THAT connection's
+        # bookkeeping ; the rollback may hand back another pooled connection, prepared according to its own
+        connection.info.get('prepared_statements', set()).discard(statement.name)
+        session.rollback()
+        connection = session.connection()
+        if statement.name not in connection.info.get('prepared_statements', ()):
+            _prepare(connection, statement)
+        statement_stats['re_prepares'] += 1
+        return session.execute(execute, values)
+
+
+BIND_VARIABLE = re.compile(r'\$(\d+)')
+
+
+def stream_statement(session, intent, params, batch_size=STREAM_BATCH_SIZE):
+    # yields the rows of the intent's statement from a server-side cursor (stream_results: a psycopg2 named cursor),
+    # batch_size rows per round trip, so a large page is never held in memory at once and its first rows can be shown
+    # before the last ones are read. A cursor can't be DECLAREd over an EXECUTE: the statement's own text runs with the
+    # same bind variables instead, planned on every call, which only pays off for pages above STREAM_MIN_ROWS
+    statement = STATEMENTS[intent]
+
+    def bind(match):
+        position = int(match.group(1)) - 1
+        return f"CAST(:{statement.args[position]} AS {statement.arg_types[position]})"
+    values = {arg: params[arg] for arg in statement.args}
+    result = session.execute(text(BIND_VARIABLE.sub(bind, statement.sql)), values,
+                             execution_options={'stream_results': True, 'max_row_buffer': batch_size})
+    for rows in result.partitions(batch_size):
+        yield from typed_rows(intent, rows)
+
+
+def typed_rows(intent, rows):
+    # rows of the intent's statement as its row type (MovieRow, OverviewRow) ; plain rows for the others
+    row_type = STATEMENTS[intent].row
+    return map(row_type._make, rows) if row_type is not None else rows
+
+
+def plan_cache_hit_ratio():
+    executions = statement_stats['prepares'] + statement_stats['plan_cache_hits']
+    return statement_stats['plan_cache_hits'] / executions if executions else 0.0
+
+
+if __name__ == "__main__":
+    # python queries.py [rows] [rounds]  -> per-row cost of turning result rows into display text, before / after the
+    # row types (a movies.movies row each):
+    #   before: DECIMAL ratings from the driver, format_results' isinstance pass over every field rebuilding each tuple,
+    #           fields read by position
+    #   after:  float8 ratings, MovieRow._make, fields read by name
+    # and, when the database is reachable, the driver's side: fetching the same rows with a numeric vs a float8 rating
+    import gc
+    import sys
+    import time
+    from decimal import Decimal
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    actors = ['Actor 1', 'Actor 2', 'Actor 3', 'Actor 4', 'Actor 5']
+    decimal_rows = [(i, f'Movie {i}', Decimal(i % 1000) / 100, 'Action, Drama', 1950 + i % 70, f'Director {i % 500}', actors) for i in range(count)]
+    float_rows = [(row[0], row[1], float(row[2]), *row[3:]) for row in decimal_rows]
+
+    def format_results(results):
+        return [tuple(float(field) if isinstance(field, Decimal) else field for field in result) for result in results]
+
+    def render_by_position(movies):
+        return ''.join(f"{movie[1]} ({movie[4]}) {movie[2]} {movie[3]} {movie[5]} {', '.join(movie[6])}\n" for movie in movies)
+
+    def render_by_name(movies):
+        return ''.join(f"{movie.movie_name} ({movie.release_year}) {movie.tmdb_rating} {movie.genre} {movie.director_name} "
+                       f"{', '.join(movie.top_5_actors)}\n" for movie in movies)
+
+    def per_row(function, rows):
+        best = float('inf')
+        gc.disable()  # a collection landing in one of the runs would swamp the difference
+        try:
+            for _ in range(rounds):
+                started = time.perf_counter()
+                function(rows)
+                best = min(best, time.perf_counter() - started)
+        finally:
+            gc.enable()
+        return best / len(rows) * 1e9
+
+    convert_before = per_row(format_results, decimal_rows)
+    convert_after = per_row(lambda rows: list(map(MovieRow._make, rows)), float_rows)
+    total_before = per_row(lambda rows: render_by_position(format_results(rows)), decimal_rows)
+    total_after = per_row(lambda rows: render_by_name(map(MovieRow._make, rows)), float_rows)
+    print(f"{count} rows, best of {rounds}")
+    print(f"convert          before {convert_before:7.0f} ns/row   after {convert_after:7.0f} ns/row   ({convert_before / convert_after:.1f}x)")
+    print(f"convert + render before {total_before:7.0f} ns/row   after {total_after:7.0f} ns/row   ({total_before / total_after:.1f}x)")
+
+    try:
+        from config import SessionLocal
+        session = SessionLocal()
+        numeric_sql = text("SELECT id, movie_name, tmdb_rating, genre, release_year, director_name, top_5_actors FROM movies.movies")
+        float_sql = text(f"SELECT {MOVIE_COLUMNS} FROM movies.movies")
+        fetched = len(session.execute(numeric_sql).fetchall())
+        fetch_before = per_row(lambda _: format_results(session.execute(numeric_sql).fetchall()), range(fetched))
+        fetch_after = per_row(lambda _: list(typed_rows('by_ids', session.execute(float_sql))), range(fetched))
+        session.close()
+        print(f"fetch + convert  before {fetch_before:7.0f} ns/row   after {fetch_after:7.0f} ns/row   ({fetch_before / fetch_after:.1f}x, {fetched} rows of movies.movies)")
+    except Exception as e:
+        print(f"(no database, fetch not measured: {str(e).splitlines()[0]})")
@@ -0,0 +1,125 @@
+import re
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from genres import split_genres
+
+# Single-pass intent router.
+# main() used to lowercase the query ~20 times for chains of `in` checks to pick a search_* function, which then called
+# process_query, which lowercased again and tried up to 11 regexes one after the other. The two layers could disagree
+# (main picking the director search while process_query matched something else, or referring to patterns that didn't exist).
+# Now every intent pattern is compiled ONCE into a single alternation ; one match classifies the query and captures its
+# parameters, which are converted to their types (int years, Decimal ratings, genre lists) before the search runs.
+# (the search_* functions of main.py receive the Route and only correct the names it carries)
+
+# Route: the intent name, its typed parameters (dict) and the original query text
+Route = namedtuple('Route', ['intent', 'params', 'query'])
+
+# (intent, pattern) in priority order: when several intents could match, the first one listed wins,
+# e.g. "movies of director X with ratings above 8" is director_rating, not director.
+INTENT_PATTERNS = [
+    ('overview', r'overviews?(?: of)? (?P<title>.+?)(?: movie)?[\s?.!]*$'),
+    ('top_year', r'top (?P<limit>\d+) movies (?:from |of |in )?(?:(?:the )?year )?(?P<year>\d{4})'),
+    ('similar', r'movies like (?P<title>.+?)[\s?.!]*$'),
+    ('plot', r'(?:movies?|films?) (?:where|in which|about) (?P<description>.+?)[\s?.!]*$'),  # plot description -> semantic search
+    ('actor_range', r'movies of (?:actor|actress) (?P<name>.+?) from (?P<from_year>\d{4}) to (?P<to_year>\d{4})'),
+    ('actor', r'movies of (?:actor|actress) (?P<name>.+?)[\s?.!]*$'),
+    ('director_rating', r'movies of director (?P<name>.+?) with ratings? (?P<comparison>above|below) (?P<rating>\d+(?:\.\d+)?)'),
+    ('director_range', r'movies of director (?P<name>.+?) from (?P<from_year>\d{4}) to (?P<to_year>\d{4})'),
+    ('genre_rating', r'genres? like (?P<genres>.+?) with ratings? (?P<comparison>above|below) (?P<rating>\d+(?:\.\d+)?)'),
+    ('genres', r'genres? like (?P<genres>.+?)[\s?.!]*$'),
+    ('director', r'movies of director (?P<name>.+?)[\s?.!]*$'),
+]
+FALLBACK_INTENT = 'title'  # anything else is a free-text title search (keyword extracted by the LLM)
+
+MAX_TOP_N = 50  # "top 1000 movies from year 2019" is still answered with at most 50 rows
+
+
+def _compile(intent_patterns):
+    # every alternative gets its own leading .*? so that alternatives are tried in priority order from the start of the
+    # query (rather than "whichever matches leftmost"), and its groups are prefixed with the intent name because group
+    # names must be unique in one pattern: (?P<director_rating>.*?movies of director (?P<director_rating__name>.+?) ...)
+    alternatives = []
+    for intent, pattern in intent_patterns:
+        pattern = re.sub(r'\(\?P<(\w+)>', lambda m: f'(?P<{intent}__{m.group(1)}>', pattern)
+        alternatives.append(f'(?P<{intent}>.*?{pattern})')
+    return re.compile('^(?:' + '|'.join(alternatives) + ')', re.IGNORECASE | re.DOTALL)
+
+
+ROUTER_PATTERN = _compile(INTENT_PATTERNS)
+_GROUPS_BY_INTENT = {intent: [name for name in ROUTER_PATTERN.groupindex if name.startswith(intent + '__')] for intent, _ in INTENT_PATTERNS}
+
+
+def _typed(name, value):
+    if name in ('year', 'from_year', 'to_year'):
+        return int(value)
+    if name == 'limit':
+        return max(1, min(int(value), MAX_TOP_N))
+    if name == 'rating':
+        return Decimal(value)  # e.g. 8 or 6.47 ; Decimal like the DECIMAL(3, 2) tmdb_rating column
+    if name == 'comparison':
+        return value.lower()
+    if name == 'genres':
+        return split_genres(value)  # "action, comedy and thriller" -> ['action', 'comedy', 'thriller']
+    return value.strip().strip('"\'').strip()
+
+
+def route_query(query):
+    # classifies the query in one pass over one compiled pattern ; returns a Route
+    query = query.strip()
+    match = ROUTER_PATTERN.match(query)
+    if match is None:
+        return Route(FALLBACK_INTENT, {'text': query}, query)
+    intent = match.lastgroup  # the intent's wrapper group is the outermost, so it's the last group to close
+    params = {}
+    for group in _GROUPS_BY_INTENT[intent]:
+        params[group.split('__', 1)[1]] = _typed(group.split('__', 1)[1], match.group(group))
+    return Route(intent, params, query)
+
+
+def route_from_params(intent, params):
+    # Route of a query given as an intent and its raw (string) parameters, e.g. the query string of
+    # GET /search/director_rating?name=nolan&comparison=above&rating=8 (service.py) ; the parameters are typed like
+    # route_query types them. Raises ValueError for an unknown intent, a missing parameter or a malformed value.
+    if intent == FALLBACK_INTENT:
+        names = ['text']
+    elif intent in _GROUPS_BY_INTENT:
+        names = [group.split('__', 1)[1] for group in _GROUPS_BY_INTENT[intent]]
+    else:
+        raise ValueError(f"unknown intent: {intent}")
+    missing = [name for name in names if not params.get(name)]
+    if missing:
+        raise ValueError(f"missing parameter(s) for {intent}: {', '.join(missing)}")
+    try:
+        typed = {name: _typed(name, params[name]) for name in names}
+    except (ArithmeticError, ValueError) as e: # int('x') or Decimal('x')
+        raise ValueError(f"malformed parameter for {intent}: {e}")
+    if typed.get('comparison', 'above') not in ('above', 'below'):
+        raise ValueError(f"comparison must be 'above' or 'below', not {params['comparison']!r}")
+    return Route(intent, typed, ' '.join(str(params[name]) for name in names))
+
+if __name__ == "__main__":
+    # python query_router.py "movies of director nolan from 2000 to 2010" ...  -> routes + per-query routing cost
+    import sys
+    samples = sys.argv[1:] or [
+        "overview of inception movie",
+        "top 5 movies from year 2019",
+        "movies like interstellar",
+        "movie where a dream is inside a dream",
+        "movies of actor tom hanks from 1990 to 2000",
+        "movies of actress meryl streep",
+        "movies of director christopher nolan with ratings above 8",
+        "movies of director christopher nolan from 2000 to 2010",
+        "genres like action, comedy and thriller with rating below 6.5",
+        "genres like action, comedy and thriller",
+        "movies of director christopher nolan",
+        "the godfather",
+    ]
+    rounds = 10000
+    for sample in samples:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            route = route_query(sample)
+        elapsed = (time.perf_counter() - started) / rounds
+        print(f"{elapsed * 1e6:7.2f} us  {route.intent:<16} {route.params}")
@@ -0,0 +1,176 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.sql import text
+
+# Result cache of the searches (main.py, service.py).
+# "top 5 movies from year 2019" or "movies of director christopher nolan" asked again ran the same statement again, and
+# the same LLM correction before it (answered by correction_cache.py, but still a lookup per name). Their results only
+# change when the ingest writes new rows, so the searches keep them in memory:
+#   - the corrected parameters of a route, keyed by intent + raw parameters (normalized): a repeated query skips the
+#     name correction, LLM included
+#   - the rows of a statement page, keyed by the statement + its bind variables (canonical, after correction): two
+#     queries that correct to the same name share one entry, and a hit doesn't touch Postgres
+# Entries are evicted least recently used first, once their (approximate) size passes RESULT_CACHE_MAX_BYTES.
+# Invalidation: every transaction that changes the catalog adds one to movies.catalog_version
+# (migrations/0008_catalog_version.sql, bump_catalog_version() below) ; the searches read it at most once every
+# RESULT_CACHE_CHECK_INTERVAL seconds and drop everything when it moved. Without that table nothing is cached.
+# The version is read even with the cache off: the in-process snapshots of the catalog (main.refresh_snapshots) follow it
+# too, so refresh() / observe() tell the drivers whether it moved.
+#
+# Configuration through environment variables:
+#   RESULT_CACHE_DISABLED=1         -> no result cache
+#   RESULT_CACHE_MAX_BYTES          -> memory cap of the entries (default: 64 MB)
+#   RESULT_CACHE_CHECK_INTERVAL     -> seconds between two reads of the catalog version (default: 2)
+
+CATALOG_VERSION = "SELECT version FROM movies.catalog_version"
+BUMP_CATALOG_VERSION = "UPDATE movies.catalog_version SET version = version + 1, updated_at = now()"
+
+
+def read_catalog_version(session):
+    # the version an in-process snapshot of the catalog is read at (catalog_engine.py, fulltext_index.py), with its
+    # session ; None without the movies.catalog_version table (the snapshot is then never refreshed)
+    try:
+        return session.execute(text(CATALOG_VERSION)).scalar()
+    except Exception:
+        session.rollback()
+        return None
+
+
+def bump_catalog_version(cursor):
+    # part of the caller's transaction (a psycopg2 cursor) ; the new version becomes visible with the rows it stands for
+    cursor.execute(BUMP_CATALOG_VERSION)
+
+
+def canonical(value, fold=False):
+    # hashable form of parameters: dicts as sorted items, lists as tuples ; fold=True also normalizes strings like the
+    # correction cache does ("  Christopher   NOLAN " and "christopher nolan" are one entry), for what the user typed
+    if isinstance(value, dict):
+        return tuple(sorted((name, canonical(item, fold)) for name, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(item, fold) for item in value)
+    if fold and isinstance(value, str):
+        return ' '.join(value.split()).lower()
+    return value
+
+
+def approximate_size(value):
+    # bytes held by value and what it contains (rows: namedtuples of str, int, float, lists of str)
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(approximate_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(approximate_size(name) + approximate_size(item) for name, item in value.items())
+    return size
+
+
+class ResultCache:
+    def __init__(self, session_factory=None, max_bytes=64 * 1024 * 1024, check_interval=2.0, enabled=True):
+        self.session_factory = session_factory
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self.version = None  # catalog version the entries belong to ; None: unknown, nothing is cached
+        self._checked_at = 0.0
+        self._entries = OrderedDict()  # key -> (value, size) ; most recently used entries at the end
+        self._bytes = 0
+        self._lock = threading.Lock()  # the command line's LLM threads and the service's loop thread share it
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+
+    def due(self):
+        # whether the catalog version should be read again
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def observe(self, version):
+        # the catalog version just read ; a new one drops every entry. Returns whether it moved
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if version == self.version:
+                return False
+            if self._entries:
+                self.stats['invalidations'] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.version = version
+            return True
+
+    def version_error(self, e):
+        # printed when the version can't be read, but not again every check_interval while it stays unreadable
+        if self.version is not None or not self._checked_at:
+            print(f"ERROR in reading the catalog version, results aren't cached: {e}")
+
+    def refresh(self):
+        # reads the catalog version through session_factory when it's due (the service reads it with asyncpg instead) ;
+        # returns whether it moved
+        if not self.due() or self.session_factory is None:
+            return False
+        session = self.session_factory()
+        try:
+            version = session.execute(text(CATALOG_VERSION)).scalar()
+        except Exception as e:
+            self.version_error(e)
+            version = None
+        finally:
+            session.close()
+        return self.observe(version)
+
+    def get(self, key):
+        if not self.enabled or self.version is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, version):
+        # version: self.version when the value was computed ; a value computed before an invalidation isn't stored
+        if not self.enabled or version is None:
+            return
+        size = approximate_size(key) + approximate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self.stats['stores'] += 1
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)  # dropping the least recently used entry
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def hit_ratio(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def report(self):
+        with self._lock:
+            entries, used = len(self._entries), self._bytes
+        return (f"Result cache: {entries} entries, {used / 1024:.0f} KiB of {self.max_bytes / 1024:.0f} KiB, catalog version {self.version} ; "
+                f"{self.stats['hits']} hits, {self.stats['misses']} misses ({self.hit_ratio():.0%}), "
+                f"{self.stats['evictions']} evicted, {self.stats['invalidations']} invalidations")
+
+
+def cache_from_env(session_factory=None):
+    return ResultCache(
+        session_factory,
+        max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        check_interval=float(os.getenv('RESULT_CACHE_CHECK_INTERVAL', 2)),
+        enabled=os.getenv('RESULT_CACHE_DISABLED', '0').lower() not in ('1', 'true', 'yes'),
+    )
@@ -0,0 +1,350 @@
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import zlib
+from functools import lru_cache
+
+from sqlalchemy.sql import text
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency: without NumPy the plot search just reports that it's unavailable
+    np = None
+
+# Local semantic search over movies.movie_overviews.
+# search_overview only matches titles, so "movie where a dream is inside a dream" found nothing. This module embeds every
+# overview offline into a float32 matrix stored as .npy files (memory-mapped when searched, so the index costs page cache,
+# not Python heap) and answers a plot description with the top k overviews by cosine similarity, either
+#   - exactly (brute force: one matrix-vector product over all overviews), or
+#   - through an IVF index: k-means centroids partition the vectors, the vectors are stored list by list, and a query
+#     only scans the SEMANTIC_NPROBE lists whose centroids are closest to it.
+# The embedder is pluggable and runs locally (no network round trip per query):
+#   hashing                -> (default) signed feature hashing of stemmed words and word pairs, idf weighted ; no dependency
+#   sentence-transformers  -> a local sentence-transformers model (SEMANTIC_MODEL, default all-MiniLM-L6-v2) when installed
+#
+#   python semantic_index.py build [embedder]   -> (re)builds the index from the database into SEMANTIC_INDEX_PATH
+# A build writes a new version directory next to the live one and then swaps the CURRENT file that names the live
+# version (os.replace, atomic): a running search keeps its index until default_index() sees the new one and opens it.
+#   python semantic_index.py eval [queries]     -> recall@k of IVF against exact search, and latency of both
+#   python semantic_index.py "dream inside a dream"
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'semantic')
+INDEX_PATH = os.getenv('SEMANTIC_INDEX_PATH', DEFAULT_INDEX_PATH)
+CURRENT_FILE = 'CURRENT'  # in INDEX_PATH: the name of the live version directory
+EMBEDDER = os.getenv('SEMANTIC_EMBEDDER', 'hashing')
+NPROBE = int(os.getenv('SEMANTIC_NPROBE', 8))  # IVF lists scanned per query ; 0 -> always exact search
+HASHING_DIMENSION = 512
+EMBED_BATCH = 1000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 50000  # centroids are trained on at most this many vectors
+
+OVERVIEWS_QUERY = "SELECT movie_id, overview FROM movies.movie_overviews WHERE overview IS NOT NULL AND overview <> '' ORDER BY movie_id"
+
+STOP_WORDS = frozenset("""
+a about after again against all also an and any are as at be because been before being between both but by can could
+did do does doing down during each few for from further had has have having he her here hers herself him himself his how
+i if in into is it its itself just me more most my myself no nor not now of off on once only or other our ours out over own
+same she should so some such than that the their theirs them themselves then there these they this those through to too
+under until up very was we were what when where which while who whom why will with would you your yours movie film story
+""".split())
+WORD = re.compile(r'[a-z0-9]+')
+
+
+def stem(word):
+    # crude suffix stripping, enough for "dreams" / "dreaming" / "dreamed" to share one feature
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def content_words(value):
+    return [stem(word) for word in WORD.findall(value.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+
+@lru_cache(maxsize=200000)
+def _bucket(feature, dimension):
+    # stable across processes (unlike hash()) ; the top bit picks the sign, so colliding features tend to cancel out
+    hashed = zlib.crc32(feature.encode('utf-8'))
+    return hashed % dimension, (1.0 if hashed & 0x80000000 else -1.0)
+
+
+class HashingEmbedder:
+    name = 'hashing'
+
+    def __init__(self, dimension=HASHING_DIMENSION):
+        self.dimension = dimension
+        self.idf = np.ones(dimension, dtype=np.float32)
+
+    def _features(self, value):
+        words = content_words(value)
+        return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+    def _counts(self, texts):
+        counts = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, value in enumerate(texts):
+            for feature in self._features(value or ''):
+                bucket, sign = _bucket(feature, self.dimension)
+                counts[row, bucket] += sign
+        return counts
+
+    def fit(self, texts):
+        # idf per bucket: buckets every overview hits ("young", "life") weigh less than rare ones ("dream", "heist")
+        document_frequency = np.zeros(self.dimension, dtype=np.float64)
+        for start in range(0, len(texts), EMBED_BATCH):
+            document_frequency += (self._counts(texts[start:start + EMBED_BATCH]) != 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+    def embed(self, texts):
+        vectors = self._counts(texts) * self.idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def save(self, path):
+        np.save(os.path.join(path, 'idf.npy'), self.idf)
+
+    def load(self, path):
+        self.idf = np.load(os.path.join(path, 'idf.npy'))
+
+    def settings(self):
+        return {'dimension': self.dimension}
+
+
+class SentenceTransformerEmbedder:
+    name = 'sentence-transformers'
+
+    def __init__(self, model=None):
+        from sentence_transformers import SentenceTransformer  # optional dependency, only imported when selected
+        self.model_name = model or os.getenv('SEMANTIC_MODEL', 'all-MiniLM-L6-v2')
+        self.model = SentenceTransformer(self.model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def fit(self, texts):
+        pass
+
+    def embed(self, texts):
+        return self.model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def save(self, path):
+        pass
+
+    def load(self, path):
+        pass
+
+    def settings(self):
+        return {'model': self.model_name}
+
+
+EMBEDDERS = {embedder.name: embedder for embedder in (HashingEmbedder, SentenceTransformerEmbedder)}
+
+
+def _nearest_centroids(vectors, centroids, chunk=8192):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        assignment[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return assignment
+
+
+def train_ivf(vectors, nlist, seed=0):
+    # spherical k-means on (a sample of) the unit vectors ; returns the centroids and the list of every vector
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]  # reseed lists that lost all their vectors
+        norms[empty] = 1
+        centroids = sums / norms
+    return centroids.astype(np.float32), _nearest_centroids(vectors, centroids)
+
+
+def build_index(session, path=INDEX_PATH, embedder_name=EMBEDDER, nlist=None):
+    started = time.perf_counter()
+    rows = session.execute(text(OVERVIEWS_QUERY)).fetchall()
+    if not rows:
+        raise ValueError("movies.movie_overviews holds no overview to index")
+    movie_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    texts = [row[1] for row in rows]
+
+    embedder = EMBEDDERS[embedder_name]()
+    embedder.fit(texts)
+    vectors = np.vstack([embedder.embed(texts[start:start + EMBED_BATCH]) for start in range(0, len(texts), EMBED_BATCH)])
+    print(f"Embedded {len(texts)} overviews with {embedder.name} ({embedder.dimension} dimensions) in {time.perf_counter() - started:.1f}s")
+
+    # about 4 * sqrt(n) lists: 1,000 overviews -> 126 lists of ~8, 100,000 -> 1,264 lists of ~80
+    nlist = max(1, min(nlist or int(4 * len(vectors) ** 0.5), len(vectors)))
+    centroids, assignment = train_ivf(vectors, nlist)
+    order = np.argsort(assignment, kind='stable')  # vectors stored list by list: every IVF list is one contiguous slice
+    offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+
+    # written next to the live index and swapped in at the end, so a running search never sees half an index (nor none)
+    version = f"v{time.time_ns()}"
+    building = os.path.join(path, version)
+    os.makedirs(building)
+    np.save(os.path.join(building, 'vectors.npy'), vectors[order])
+    np.save(os.path.join(building, 'movie_ids.npy'), movie_ids[order])
+    np.save(os.path.join(building, 'centroids.npy'), centroids)
+    np.save(os.path.join(building, 'offsets.npy'), offsets)
+    embedder.save(building)
+    with open(os.path.join(building, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+        json.dump({'embedder': embedder.name, 'settings': embedder.settings(), 'count': len(vectors), 'nlist': nlist, 'built_at': time.time()}, meta_file)
+    previous = os.path.basename(live_index_path(path))
+    with open(os.path.join(path, CURRENT_FILE + '.swap'), 'w', encoding='utf-8') as current_file:
+        current_file.write(version)
+    os.replace(os.path.join(path, CURRENT_FILE + '.swap'), os.path.join(path, CURRENT_FILE))
+    remove_old_versions(path, keep=(version, previous))
+    print(f"Built semantic index of {len(vectors)} overviews ({nlist} IVF lists) in {path} in {time.perf_counter() - started:.1f}s")
+
+
+def live_index_path(path=INDEX_PATH):
+    # directory of the live index: the version CURRENT names, or path itself for an index built before versions
+    try:
+        with open(os.path.join(path, CURRENT_FILE), encoding='utf-8') as current_file:
+            return os.path.join(path, current_file.read().strip())
+    except FileNotFoundError:
+        return path
+
+
+def index_stamp(directory):
+    # (directory, mtime of its meta.json): changes with every build ; None without an index there
+    try:
+        return directory, os.stat(os.path.join(directory, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None
+
+
+def remove_old_versions(path, keep):
+    # the versions before the previous one (a process may still be opening that one) and the files of an index built
+    # before versions ; on POSIX a process that memory-mapped a removed file keeps reading it
+    for name in os.listdir(path):
+        if name in keep or name == CURRENT_FILE:
+            continue
+        target = os.path.join(path, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        else:
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+
+
+class SemanticIndex:
+    def __init__(self, path=INDEX_PATH):
+        path = live_index_path(path)
+        self.stamp = index_stamp(path)
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as meta_file:
+            self.meta = json.load(meta_file)
+        self.embedder = EMBEDDERS[self.meta['embedder']](**self.meta['settings'])
+        self.embedder.load(path)
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.movie_ids = np.load(os.path.join(path, 'movie_ids.npy'))
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def search(self, description, k=10, nprobe=NPROBE):
+        # [(movie_id, cosine similarity)] of the k overviews closest to the description, best first
+        return self.search_vector(self.embedder.embed([description])[0], k, nprobe)
+
+    def search_vector(self, query, k=10, nprobe=NPROBE):
+        if not nprobe or nprobe >= len(self.centroids):
+            positions = None
+            scores = self.vectors @ query  # exact: every overview
+        else:
+            lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            slices = [(self.offsets[i], self.offsets[i + 1]) for i in lists]
+            positions = np.concatenate([np.arange(start, end) for start, end in slices])
+            scores = np.concatenate([self.vectors[start:end] @ query for start, end in slices])
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        found = top if positions is None else positions[top]
+        return [(int(self.movie_ids[position]), float(scores[i])) for position, i in zip(found, top)]
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def default_index():
+    # the live index at SEMANTIC_INDEX_PATH, opened again when a build swapped in another one (its meta.json changed) ;
+    # None when NumPy or the index files are missing
+    global _default_index
+    if np is None:
+        print("Plot search needs NumPy (pip install numpy)")
+        return None
+    stamp = index_stamp(live_index_path(INDEX_PATH))
+    if _default_index is not None and (stamp is None or _default_index.stamp == stamp):
+        return _default_index  # the one opened is still the live one (or nothing newer can be opened)
+    with _default_index_lock:
+        if _default_index is None or _default_index.stamp != stamp:
+            if stamp is None:
+                print(f"No semantic index in {INDEX_PATH} ; build it with: python semantic_index.py build")
+                return None
+            try:
+                _default_index = SemanticIndex(INDEX_PATH)
+            except Exception as e:
+                print(f"ERROR in opening the semantic index: {e}")  # the index opened before, if any, keeps answering
+    return _default_index
+
+
+def evaluate(session, index, queries=200, k=10, nprobe=NPROBE, seed=0):
+    # queries are made from real overviews: a random half of their content words, shuffled (a vague plot description).
+    # recall@k: share of the exact top k that IVF also returns ; hit rate: how often the source movie is in the top k
+    rng = np.random.default_rng(seed)
+    rows = session.execute(text(OVERVIEWS_QUERY)).fetchall()
+    picked = rng.choice(len(rows), min(queries, len(rows)), replace=False)
+    exact_times, ivf_times, recalls, exact_hits, ivf_hits = [], [], [], 0, 0
+    for i in picked:
+        movie_id, overview = rows[i]
+        words = content_words(overview)
+        if not words:
+            continue
+        description = ' '.join(rng.permutation(words)[:max(1, len(words) // 2)])
+        query = index.embedder.embed([description])[0]
+        started = time.perf_counter()
+        exact = [found for found, _ in index.search_vector(query, k, nprobe=0)]
+        exact_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        approximate = [found for found, _ in index.search_vector(query, k, nprobe)]
+        ivf_times.append(time.perf_counter() - started)
+        recalls.append(len(set(exact) & set(approximate)) / max(1, len(exact)))
+        exact_hits += movie_id in exact
+        ivf_hits += movie_id in approximate
+    count = len(recalls)
+    print(f"{count} queries over {len(index)} overviews, k={k}, nprobe={nprobe} of {len(index.centroids)} lists")
+    for label, times in (('exact', exact_times), ('ivf', ivf_times)):
+        p50, p95 = np.percentile(times, [50, 95]) * 1e3
+        print(f"{label:<6} p50 {p50:7.3f} ms   p95 {p95:7.3f} ms")
+    print(f"IVF recall@{k}: {np.mean(recalls):.3f}")
+    print(f"source movie in top {k}: exact {exact_hits / count:.3f}   ivf {ivf_hits / count:.3f}")
+
+
+if __name__ == "__main__":
+    from config import SessionLocal
+    command = sys.argv[1] if len(sys.argv) > 1 else 'eval'
+    session = SessionLocal()
+    try:
+        if command == 'build':
+            build_index(session, embedder_name=sys.argv[2] if len(sys.argv) > 2 else EMBEDDER)
+        elif command == 'eval':
+            evaluate(session, SemanticIndex(INDEX_PATH), queries=int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+        else:
+            index = SemanticIndex(INDEX_PATH)
+            for movie_id, score in index.search(' '.join(sys.argv[1:])):
+                print(f"{score:.3f}  movie {movie_id}")
+    finally:
+        session.close()
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+from functools import partial
+
+import asyncpg
+from aiohttp import web
+from openai import AsyncOpenAI
+
+import main
+from db import MAX_OVERFLOW, POOL_SIZE, POOL_TIMEOUT, engine
+from llm_client import AsyncLLMClient
+from queries import STATEMENTS, Page, typed_rows
+from result_cache import CATALOG_VERSION
+from semantic_index import default_index
+from query_router import route_from_params, route_query
+from tracing import tracer
+
+# HTTP search service: the searches of main.py behind an aiohttp server, one event loop serving many queries at once.
+# A search is a plan (main.run_plan): it yields the statements and the LLM calls it needs, and this driver awaits them:
+#   - statements run on an asyncpg pool (asyncpg prepares each statement once per connection and reuses it) ; the pool
+#     is sized like the SQLAlchemy one (DB_POOL_SIZE + DB_MAX_OVERFLOW) and a query waits at most DB_POOL_TIMEOUT for
+#     a connection, so the pool is the limit towards Postgres
+#   - LLM calls go through AsyncLLMClient (openai.AsyncOpenAI, same correction cache and prompts as the command line),
+#     at most LLM_MAX_CONCURRENCY in flight across every query being served
+# A query waiting on Postgres or on the LLM no longer holds a thread: the others keep running meanwhile. Local work
+# (name correction, genre vocabulary, the keyword and plot indexes, SEARCH_ENGINE=memory) runs in a thread of the
+# default executor, never on the loop: a plan step between two requests, or an in-memory catalog lookup. Its indexes
+# are loaded at startup so no request pays for them. Repeated queries are answered from the result
+# cache of main.py (result_cache.py) without the LLM or Postgres.
+# With TRACING=1 every request is traced like a query of the command line (tracing.py: spans of its routing, search,
+# statements and LLM calls, one JSON line per request) and GET /metrics serves the Prometheus metrics.
+#
+#   python service.py [--port 8080]
+#   GET /search?q=movies of director nolan with ratings above 8
+#   GET /search/director_rating?name=nolan&comparison=above&rating=8
+#   optional on both: page_size=N (at most MAX_PAGE_SIZE) and cursor=<the "next" of the previous response>
+# Response: {"intent", "params", "results": [one object per MovieRow / OverviewRow], "next": cursor or null}
+#   GET /metrics -> Prometheus text format (empty while tracing is off)
+
+DEFAULT_PORT = 8080
+MAX_PAGE_SIZE = 100
+NAME_KINDS = ('movie', 'actor', 'director')
+
+
+def asyncpg_dsn(url):
+    # the SQLAlchemy URL of db.engine (postgresql+psycopg2://...) as a plain libpq URL for asyncpg
+    return url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+def json_default(value):
+    if isinstance(value, Decimal):  # a rating typed by the user (query_router) ; the rows already carry floats
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+json_response = partial(web.json_response, dumps=partial(json.dumps, default=json_default, ensure_ascii=False))
+
+
+def bind_value(arg_type, value):
+    # asyncpg binds a float to numeric by its exact binary value (9.74 -> 9.7400000000000002131...), which would break
+    # the keyset of the next page (the row rated 9.74 would come again) ; the float of a row goes in as the decimal it shows
+    if arg_type == 'numeric' and isinstance(value, float):
+        return Decimal(repr(value))
+    return value
+
+
+async def fetch(pool, intent, params):
+    # rows of the intent's statement: from the in-memory catalog when it answers, otherwise from Postgres
+    rows = await asyncio.to_thread(main.catalog.execute, intent, params) if main.catalog is not None else None
+    if rows is not None:
+        return iter(rows)
+    statement = STATEMENTS[intent]
+    args = [bind_value(arg_type, params[arg]) for arg_type, arg in zip(statement.arg_types, statement.args)]
+    async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+        records = await conn.fetch(statement.sql, *args)
+    return iter(list(typed_rows(intent, records)))
+
+
+async def refresh_result_cache(pool):
+    # main.result_cache.refresh() without blocking the loop: the catalog version is read on the asyncpg pool, and the
+    # snapshots are rebuilt in a thread (main.refresh_snapshots) while the other requests go on
+    if not main.result_cache.due():
+        return
+    try:
+        async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+            version = await conn.fetchval(CATALOG_VERSION)
+    except Exception as e:
+        main.result_cache.version_error(e)
+        version = None
+    if main.result_cache.observe(version):
+        await asyncio.to_thread(main.refresh_snapshots, version)
+
+
+def plan_step(plan, answer, error):
+    # the plan's local work up to its next request: (False, request), or (True, its rows) once it returned ; a
+    # StopIteration can't cross asyncio.to_thread
+    try:
+        return False, plan.send(answer) if error is None else plan.throw(error)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+async def run_plan_async(plan, pool, llm):
+    # asynchronous driver of a plan (see main.run_plan) ; returns the rows of its page as a list
+    await refresh_result_cache(pool)
+    version = main.cacheable_version()
+    answer, error = None, None
+    with tracer.span('search'):
+        context = contextvars.copy_context()  # the plan's own, from one step (and thread) to the next
+        while True:
+            done, request = await asyncio.to_thread(context.run, plan_step, plan, answer, error)
+            tracer.follow(context)
+            if done:
+                return list(request or ())
+            answer, error = None, None
+            try:
+                if isinstance(request, main.Fetch):
+                    with tracer.span('sql', statement=request.intent, params=request.params):
+                        key, rows = main.cached_rows(request)
+                        if rows is None:
+                            rows = main.remember_rows(key, await fetch(pool, request.intent, request.params), version)
+                    answer = iter(rows)
+                else:
+                    with tracer.span('llm', method=request.method, kind=main.llm_kind(request)):
+                        answer = await getattr(llm, request.method)(*request.args)
+            except Exception as e:  # thrown back into the plan, whose own try/except handles it
+                error = e
+
+
+def request_page(request):
+    # Page of the request: the cursor of a previous response, or the first page of page_size rows
+    cursor = request.query.get('cursor')
+    if cursor:
+        page = Page.from_token(cursor)
+    else:
+        size = request.query.get('page_size')
+        page = Page(int(size) if size else None)
+    if page.size is not None and not 1 <= page.size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+    return page
+
+
+async def answer(request, route):
+    try:
+        page = request_page(request)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    tracer.annotate(intent=route.intent, page=page.number)
+    search = main.SEARCH_HANDLERS[route.intent][0]
+    rows = await run_plan_async(search(route, page), request.app['pool'], request.app['llm'])
+    with tracer.span('render') as span:
+        rows = list(page.rows(rows))
+        next_page = page.next()
+        response = json_response({
+            'intent': route.intent,
+            'params': route.params,
+            'results': [row._asdict() for row in rows],
+            'next': next_page.token() if next_page is not None else None,
+        })
+        span.set(rows=len(rows))
+    tracer.annotate(rows=len(rows))
+    return response
+
+
+async def search(request):
+    # GET /search?q=... : free text, routed like the command line
+    query = request.query.get('q', '').strip()
+    if not query:
+        return json_response({'error': "missing query parameter 'q'"}, status=400)
+    with tracer.query(query):
+        with tracer.span('route'):
+            route = route_query(query)
+        return await answer(request, route)
+
+
+async def search_intent(request):
+    # GET /search/{intent}?... : an intent and its parameters, no routing
+    with tracer.query(request.path_qs):
+        try:
+            route = route_from_params(request.match_info['intent'], request.query)
+        except ValueError as e:
+            tracer.annotate(error=str(e))
+            return json_response({'error': str(e)}, status=400)
+        return await answer(request, route)
+
+
+async def metrics(request):
+    # GET /metrics: the Prometheus metrics of the traced requests
+    return web.Response(text=tracer.prometheus(), content_type='text/plain')
+
+
+def warm_indexes():
+    # loads what the searches build on first use, so the first requests don't wait for it
+    started = time.perf_counter()
+    for kind in NAME_KINDS:
+        main.name_corrector.index(kind)
+    main.keyword_index.ensure_loaded()
+    default_index()  # opens the plot index and its embedder (None without an index: plot searches fall back)
+    if main.catalog is not None:
+        main.catalog.ensure_loaded()
+    print(f"Indexes warmed up in {time.perf_counter() - started:.2f}s")
+
+
+async def on_startup(app):
+    app['pool'] = await asyncpg.create_pool(asyncpg_dsn(engine.url), min_size=POOL_SIZE, max_size=POOL_SIZE + MAX_OVERFLOW)
+    app['llm'] = AsyncLLMClient(AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY')), main.LLM_MODEL, main.PROMPT_VERSION)
+    await asyncio.to_thread(warm_indexes)
+
+
+async def on_cleanup(app):
+    await app['pool'].close()
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/search', search)
+    app.router.add_get('/search/{intent}', search_intent)
+    app.router.add_get('/metrics', metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the movie searches over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    web.run_app(create_app(), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,158 @@
+import argparse
+import datetime
+import sys
+import time
+
+from bulk_writer import BulkWriter, movie_record
+from ingest import connect
+from tmdb_client import TMDBClient, cache_from_env, director_name, top_actors
+from tmdb_fetcher import TMDB_API_KEY, TMDBFetcher, is_gone
+
+# Incremental sync from TMDB's changes feed.
+# Keeping ratings and credits current used to mean re-crawling every discover page. Instead:
+#   1. /movie/changes lists the ids of the movies changed since the high-water mark (movies.sync_state, see
+#      migrations/0007_sync_state.sql), in windows of at most CHANGES_WINDOW_DAYS days (TMDB's limit)
+#   2. only the ids already in movies.movies are kept (new movies come in with the crawl, ingest.py)
+#   3. their details and credits are fetched again (one request each, revalidated against the response cache) and
+#      written with the bulk writer: movies.movies, movies.movie_overviews and movies.movie_actors ; a movie TMDB
+#      answers with a 404 / 410 (deleted or delisted, the changes feed lists those too) is deleted from the catalog
+#   4. the mark moves to the end of the window once every movie of the window is written or deleted (if some movie
+#      can't be fetched, e.g. TMDB keeps failing or the API key is refused, it stays put and the next run reads the
+#      window again)
+# A run after a day's changes is a few hundred requests instead of a full crawl. TMDB_BASE_URL can point it at a local
+# tmdb_replay_server.py to run it against recorded responses.
+#
+#   python sync.py                     -> changes since the high-water mark (the last day on the first run)
+#   python sync.py --since 2024-05-01  -> changes since a date (the mark still moves forward)
+
+SYNC_NAME = 'movie_changes'
+CHANGES_WINDOW_DAYS = 14
+BATCH_SIZE = 200  # changed movies written per transaction
+FIRST_SYNC = datetime.timedelta(days=1)
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def read_high_water(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT high_water FROM movies.sync_state WHERE name = %s", (SYNC_NAME,))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def write_high_water(conn, high_water):
+    # part of the caller's transaction
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO movies.sync_state (name, high_water) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = now()
+        """, (SYNC_NAME, high_water))
+
+
+def changed_ids(client, start, end):
+    # ids of the movies changed between start and end (every page of /movie/changes)
+    ids = []
+    page, total_pages = 1, 1
+    while page <= total_pages:
+        data = client.get_json('/movie/changes', {
+            'start_date': start.date().isoformat(), 'end_date': end.date().isoformat(), 'page': page,
+        }, revalidate=True)
+        ids.extend(change['id'] for change in data.get('results', []) if not change.get('adult'))
+        total_pages = data.get('total_pages', 1)
+        page += 1
+    return ids
+
+
+def stored_ids(conn, tmdb_ids):
+    with conn.cursor() as cur:
+        cur.execute("SELECT tmdb_id FROM movies.movies WHERE tmdb_id = ANY(%s)", (list(tmdb_ids),))
+        stored = [tmdb_id for tmdb_id, in cur.fetchall()]
+    conn.commit()
+    return stored
+
+
+def details_record(client, details):
+    # MovieRecord from /movie/{id}?append_to_response=credits (same fields as a discover result, genres as objects)
+    movie = {
+        'id': details['id'],
+        'title': details.get('title', ''),
+        'vote_average': details.get('vote_average'),
+        'release_date': details.get('release_date'),
+        'genre_ids': [genre['id'] for genre in details.get('genres', [])],
+        'overview': details.get('overview', ''),
+    }
+    credits = details.get('credits', {})
+    return movie_record(movie, client.genre_names(movie['genre_ids']), director_name(credits), top_actors(credits))
+
+
+def sync(conn, client, writer, since=None, until=None):
+    # applies the changes between the high-water mark (or since) and until ; returns (changed, updated, deleted, failed)
+    until = until or utc_now()
+    start = since or read_high_water(conn) or until - FIRST_SYNC
+    changed = updated = deleted = failed = 0
+    while start < until:
+        end = min(start + datetime.timedelta(days=CHANGES_WINDOW_DAYS), until)
+        ids = list(dict.fromkeys(changed_ids(client, start, end)))
+        targets = stored_ids(conn, ids)
+        changed += len(ids)
+        print(f"{start:%Y-%m-%d %H:%M} .. {end:%Y-%m-%d %H:%M}: {len(ids)} changed movies, {len(targets)} in the catalog")
+
+        def fetch(tmdb_id):
+            # (details, gone): gone when TMDB no longer has the movie ; (None, False) for a failure worth retrying
+            try:
+                return client.movie_details(tmdb_id, revalidate=True), False
+            except Exception as e:
+                if is_gone(e):
+                    return None, True
+                print(f"Failed to fetch movie {tmdb_id}: {e}")
+                return None, False
+        window_failed = 0
+        for batch_start in range(0, len(targets), BATCH_SIZE):
+            batch = targets[batch_start:batch_start + BATCH_SIZE]
+            results = list(client.map(fetch, batch))
+            details = [movie for movie, _ in results if movie is not None]
+            gone = [tmdb_id for tmdb_id, (_, movie_gone) in zip(batch, results) if movie_gone]
+            window_failed += len(batch) - len(details) - len(gone)
+            writer.write([details_record(client, movie) for movie in details])
+            updated += len(details)
+            deleted += writer.delete(gone)
+        failed += window_failed
+        if window_failed:
+            # the mark stays before this window: the next run reads it again (rewriting a movie is harmless)
+            print(f"{window_failed} movie(s) could not be fetched, the high-water mark stays at {start:%Y-%m-%d %H:%M}")
+            break
+        write_high_water(conn, end)
+        conn.commit()
+        start = end
+    return changed, updated, deleted, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply TMDB's movie changes to the stored movies")
+    parser.add_argument('--since', type=datetime.date.fromisoformat, help='read the changes since this date instead of the high-water mark')
+    args = parser.parse_args(argv)
+    since = datetime.datetime.combine(args.since, datetime.time(), datetime.timezone.utc) if args.since else None
+
+    client = TMDBClient(TMDBFetcher(TMDB_API_KEY), cache_from_env())
+    conn = connect()
+    writer = BulkWriter(conn)
+    started = time.perf_counter()
+    try:
+        changed, updated, deleted, failed = sync(conn, client, writer, since)
+    except Exception as e:
+        conn.rollback()
+        print(f"ERROR in syncing movie changes: {e}")
+        return 1
+    finally:
+        conn.close()
+    print(f"Synced in {time.perf_counter() - started:.1f}s: {changed} changed movies, {updated} updated, {deleted} deleted, {failed} failed")
+    print(client.report())
+    print(writer.report())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,16 @@
 import os
-import requests
+
+from ingest import range_size
+from tmdb_client import TMDBClient
 
 #print("TMDB API Key:", os.getenv('TMDB_API_KEY'))
 #print("Database Password:", os.getenv('DB_PASSWORD'))
 
-TMDB_API_KEY = os.getenv('TMDB_API_KEY')
-
-def get_total_pages():
-    url = 'https://api.themoviedb.org/3/discover/movie'
-    params = {
-        'api_key': TMDB_API_KEY,
-        'sort_by': 'popularity.desc',
-        'page': 1  # Start with the first page
-    }
-    
-    response = requests.get(url, params=params)
-    data = response.json()
-    
-    total_pages = data['total_pages']
+# page count of a discover query (the crawl itself sizes its date ranges with ingest.range_size)
+def get_total_pages(start_date=None, end_date=None):
+    total_pages, total_results = range_size(TMDBClient(), start_date, end_date)
     return total_pages
 
 # Example usage
 total_pages = get_total_pages()
-print(f"Total number of pages: {total_pages}")
\ No newline at end of file
+print(f"Total number of pages: {total_pages}")
@@ -0,0 +1,250 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+from tmdb_fetcher import TMDBFetcher
+
+# TMDB client of the ingest scripts, on top of tmdb_fetcher (rate limit, retries, concurrency).
+# The populate scripts made four requests per movie: the whole genre list (again, for every movie) and the same
+# /movie/{id}/credits twice (director, then actors). Here a movie is one request and nothing is fetched twice:
+#   - movie_details() asks for /movie/{id}?append_to_response=credits: details and credits in one response
+#   - static resources (the genre list) are memoized for the life of the process
+#   - single flight: threads asking for the same URL at the same time share one request instead of sending one each
+#   - an optional on-disk response cache (SQLite, like correction_cache.py): a response younger than TMDB_CACHE_MAX_AGE
+#     is served without any request, an older one is revalidated with If-None-Match / If-Modified-Since and reused
+#     on a 304, so a re-run (or a restart after a crash) doesn't download what it already has
+#
+# Configuration through environment variables:
+#   TMDB_CACHE_DISABLED=1   -> no disk cache (memoization and single flight still apply)
+#   TMDB_CACHE_PATH         -> SQLite file (default: .cache/tmdb.sqlite3 next to this file)
+#   TMDB_CACHE_MAX_AGE      -> seconds a cached response is used without revalidation (default: 1 day)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'tmdb.sqlite3')
+TOP_ACTORS = 5
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age=24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connection(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            """)
+            self._db.commit()
+        return self._db
+
+    def get(self, url):
+        # (etag, last_modified, body, stored_at) or None
+        with self._lock:
+            try:
+                return self._connection().execute(
+                    "SELECT etag, last_modified, body, stored_at FROM responses WHERE url = ?", (url,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"ERROR in reading TMDB cache: {e}")  # a broken cache file must never stop the ingest
+                return None
+
+    def put(self, url, etag, last_modified, body):
+        with self._lock:
+            try:
+                db = self._connection()
+                db.execute("INSERT OR REPLACE INTO responses (url, etag, last_modified, body, stored_at) VALUES (?, ?, ?, ?, ?)",
+                           (url, etag, last_modified, body, time.time()))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"ERROR in writing TMDB cache: {e}")
+
+    def touch(self, url):
+        # a 304 said the cached body is still current: it's fresh again for max_age
+        with self._lock:
+            try:
+                db = self._connection()
+                db.execute("UPDATE responses SET stored_at = ? WHERE url = ?", (time.time(), url))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"ERROR in writing TMDB cache: {e}")
+
+    def flush(self):
+        with self._lock:
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM responses")
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"ERROR in flushing TMDB cache: {e}")
+
+
+def cache_from_env():
+    if os.getenv('TMDB_CACHE_DISABLED', '0').lower() in ('1', 'true', 'yes'):
+        return None
+    return ResponseCache(
+        path=os.getenv('TMDB_CACHE_PATH', DEFAULT_CACHE_PATH),
+        max_age=float(os.getenv('TMDB_CACHE_MAX_AGE', 24 * 3600)),
+    )
+
+
+class _Flight:
+    # one request in progress ; the threads asking for the same URL wait on it
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TMDBClient:
+    def __init__(self, fetcher=None, cache=None):
+        self.fetcher = fetcher or TMDBFetcher()
+        self.cache = cache
+        self._memo = {}  # url -> json of the static resources
+        self._flights = {}  # url -> _Flight of the requests in progress
+        self._lock = threading.Lock()
+        self.stats = {'lookups': 0, 'memo_hits': 0, 'deduplicated': 0, 'cache_hits': 0, 'revalidated': 0, 'downloads': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get_json(self, path, params=None, static=False, revalidate=False):
+        # json of GET path?params ; static=True memoizes it for the life of the process, revalidate=True asks TMDB even
+        # when the cached copy is fresh (a conditional request: a 304 still costs no download)
+        params = dict(params or {})
+        url = path + ('?' + urlencode(sorted(params.items())) if params else '')
+        with self._lock:
+            self.stats['lookups'] += 1
+            if url in self._memo:
+                self.stats['memo_hits'] += 1
+                return self._memo[url]
+            flight = self._flights.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._flights[url] = _Flight()
+            else:
+                self.stats['deduplicated'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._fetch(path, params, url, revalidate)
+            if static:
+                with self._lock:
+                    self._memo[url] = flight.result
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[url]
+            flight.done.set()
+
+    def _fetch(self, path, params, url, revalidate=False):
+        cached = self.cache.get(url) if self.cache is not None else None
+        headers = {}
+        if cached is not None:
+            etag, last_modified, body, stored_at = cached
+            if not revalidate and time.time() - stored_at <= self.cache.max_age:
+                self._count('cache_hits')
+                return json.loads(body)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response = self.fetcher.get(path, params, headers=headers or None)
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(url)
+            self._count('revalidated')
+            return json.loads(cached[2])
+        self._count('downloads')
+        if self.cache is not None:
+            self.cache.put(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.text)
+        return response.json()
+
+    def genres(self):
+        # {genre id: genre name}, fetched once per process
+        data = self.get_json('/genre/movie/list', {'language': 'en-US'}, static=True)
+        return {genre['id']: genre['name'] for genre in data.get('genres', [])}
+
+    def genre_names(self, genre_ids):
+        # names of genre_ids, in the order of TMDB's genre list (what the populate scripts always stored)
+        return [name for genre_id, name in self.genres().items() if genre_id in genre_ids]
+
+    def movie_details(self, movie_id, revalidate=False):
+        # details and credits of a movie in one request ; revalidate=True for a movie known to have changed
+        return self.get_json(f'/movie/{movie_id}', {'append_to_response': 'credits'}, revalidate=revalidate)
+
+    def discover_page(self, page, params=None):
+        data = self.get_json('/discover/movie', dict(params or {}, page=page))
+        self.fetcher.count('pages')
+        return data
+
+    def fetch_pages(self, pages, params=None):
+        # yields (page, movies of the page) in page order, pages fetched concurrently ; a page that keeps failing yields
+        # None, so the caller can record it as failed rather than as empty
+        def fetch(page):
+            try:
+                return page, self.discover_page(page, params)['results']
+            except Exception as e:
+                print(f"ERROR in fetching page {page}: {e}")
+                return page, None
+        return self.fetcher.map(fetch, pages)
+
+    def map(self, function, items):
+        return self.fetcher.map(function, items)
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return (f"{self.fetcher.report()} | {stats['lookups']} lookups: {stats['memo_hits']} memoized, "
+                f"{stats['deduplicated']} deduplicated, {stats['cache_hits']} cached, {stats['revalidated']} revalidated (304), "
+                f"{stats['downloads']} downloaded")
+
+
+def director_name(credits):
+    # director of a movie from its credits ('Unknown' when TMDB lists none)
+    for member in (credits or {}).get('crew', []):
+        if member['job'] == 'Director':
+            return member['name']
+    return 'Unknown'
+
+
+def top_actors(credits, count=TOP_ACTORS):
+    # names of the first billed actors ; a plain list, which psycopg2 adapts to a PostgreSQL array
+    return [actor['name'] for actor in (credits or {}).get('cast', [])[:count]]
+
+
+if __name__ == "__main__":
+    # python tmdb_client.py --flush   -> empty the response cache
+    # python tmdb_client.py [pages]   -> fetches the first discover pages and the details of their movies, twice, to
+    #                                    show what the memo, single flight and the disk cache save
+    import sys
+    cache = cache_from_env()
+    if '--flush' in sys.argv:
+        if cache is not None:
+            cache.flush()
+            print(f"TMDB cache flushed: {cache.path}")
+    else:
+        client = TMDBClient(cache=cache)
+        pages = range(1, (int(sys.argv[1]) if len(sys.argv) > 1 else 5) + 1)
+        for _ in range(2):
+            movies = [movie for _, results in client.fetch_pages(pages, {'sort_by': 'popularity.desc'}) for movie in results or []]
+            list(client.map(lambda movie: (client.genre_names(movie.get('genre_ids', [])), client.movie_details(movie['id'])), movies))
+            print(client.report())
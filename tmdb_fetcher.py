@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Concurrent, rate limited TMDB fetcher for the ingest scripts.
+# The populate scripts fetched one page at a time, slept blindly on a 429 and then paused a fixed 60 s after every
+# 100 pages, so a crawl took hours at a fraction of what TMDB allows. Here:
+#   - every request takes a token from a token bucket refilled at TMDB_RATE_LIMIT requests/second (bursts up to
+#     TMDB_BURST), shared by all the threads of the process, so the crawl runs at the allowed rate and no faster
+#   - a 429 pauses the whole bucket for its Retry-After (everyone would get the same answer), plus a little jitter so the
+#     threads don't all come back in the same millisecond
+#   - connection errors and 5xx (but a 501) are retried with exponential backoff and full jitter ; any other 4xx and a
+#     501 raise at once
+#     (requests.HTTPError), and is_gone() tells a 404 / 410 (the resource was deleted) from the rest
+#   - requests go through one pooled requests.Session (keep-alive: no TLS handshake per page)
+#   - fetch_pages() fans the discover pages out over TMDB_CONCURRENCY threads
+# stats / report() give pages/sec and the share of requests answered with a 429.
+
+TMDB_API_KEY = os.getenv('TMDB_API_KEY')
+TMDB_BASE_URL = os.getenv('TMDB_BASE_URL', 'https://api.themoviedb.org/3')  # e.g. a local tmdb_replay_server.py
+TMDB_RATE_LIMIT = float(os.getenv('TMDB_RATE_LIMIT', 40))  # requests per second
+TMDB_BURST = int(os.getenv('TMDB_BURST', 20))
+TMDB_CONCURRENCY = int(os.getenv('TMDB_CONCURRENCY', 8))
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5  # seconds ; attempt n waits up to BACKOFF_BASE * 2**n
+BACKOFF_CAP = 30
+REQUEST_TIMEOUT = 30
+GONE_STATUSES = (404, 410)  # TMDB's answer for a movie that was deleted or delisted
+PERMANENT_SERVER_ERRORS = (501,)  # 5xx not worth retrying (tmdb_replay_server.py: a request that wasn't recorded)
+
+
+class TokenBucket:
+    def __init__(self, rate=TMDB_RATE_LIMIT, capacity=TMDB_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # blocks until a request may be sent ; returns the seconds spent waiting
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        # nobody sends anything for `seconds` (a 429 tells us the quota is spent for everyone)
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class SharedTokenBucket(TokenBucket):
+    # the same bucket with its state in shared memory, for worker processes (ingest.py) that share one rate budget:
+    # create it in the parent and hand it to the workers ; time.monotonic() is the same clock in every process
+    def __init__(self, rate=TMDB_RATE_LIMIT, capacity=TMDB_BURST, context=multiprocessing):
+        self.rate = rate
+        self.capacity = capacity
+        self._state = context.Array('d', [float(capacity), time.monotonic(), 0.0])  # tokens, updated, paused_until
+        self._lock = self._state.get_lock()
+
+    tokens = property(lambda self: self._state[0], lambda self, value: self._state.__setitem__(0, value))
+    updated = property(lambda self: self._state[1], lambda self, value: self._state.__setitem__(1, value))
+    paused_until = property(lambda self: self._state[2], lambda self, value: self._state.__setitem__(2, value))
+
+
+def retry_after_seconds(response, default):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def is_gone(error):
+    # whether a failed request was answered with GONE_STATUSES: asking again won't help, the resource doesn't exist
+    # (any more) ; a 401, a 403 or a request that ran out of attempts is not gone
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in GONE_STATUSES
+
+
+class TMDBFetcher:
+    def __init__(self, api_key=TMDB_API_KEY, bucket=None, concurrency=TMDB_CONCURRENCY, base_url=TMDB_BASE_URL):
+        self.api_key = api_key
+        self.bucket = bucket or TokenBucket()
+        self.concurrency = concurrency
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, concurrency))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.stats = {'requests': 0, 'pages': 0, 'responses_429': 0, 'retries': 0, 'failures': 0, 'rate_wait_seconds': 0.0}
+        self.started = time.monotonic()
+        self._stats_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def get(self, path, params=None, headers=None):
+        # GET base_url + path ; returns the response (2xx or 304), raises once MAX_ATTEMPTS are used up or on a 4xx
+        url = self.base_url + path
+        query = dict(params or {})
+        query['api_key'] = self.api_key
+        for attempt in range(MAX_ATTEMPTS):
+            self.count('rate_wait_seconds', self.bucket.acquire())
+            self.count('requests')
+            try:
+                response = self.session.get(url, params=query, headers=headers, timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                delay = backoff_delay(attempt)
+                print(f"TMDB request {path} failed ({e}), retrying in {delay:.1f}s")
+                self.count('retries')
+                time.sleep(delay)
+                continue
+            if response.status_code == 429:
+                delay = retry_after_seconds(response, backoff_delay(attempt)) + random.uniform(0, 0.5)
+                print(f"Rate limit exceeded, every request waits {delay:.1f} seconds")
+                self.count('responses_429')
+                self.count('retries')
+                self.bucket.pause(delay)
+                continue
+            if response.status_code >= 500 and response.status_code not in PERMANENT_SERVER_ERRORS:
+                delay = backoff_delay(attempt)
+                self.count('retries')
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response
+        self.count('failures')
+        raise RuntimeError(f"TMDB request {path} failed after {MAX_ATTEMPTS} attempts")
+
+    def get_json(self, path, params=None):
+        return self.get(path, params).json()
+
+    def discover_page(self, page, params=None):
+        # one /discover/movie page (dict with results, total_pages, total_results)
+        data = self.get_json('/discover/movie', dict(params or {}, page=page))
+        self.count('pages')
+        return data
+
+    def _pool(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='tmdb')
+        return self._executor
+
+    def map(self, function, items):
+        # function(item) for every item on the fetcher's threads ; results in the order of items
+        return self._pool().map(function, items)
+
+    def fetch_pages(self, pages, params=None):
+        # yields (page, movies of the page) in page order ; a page that keeps failing yields an empty list
+        def fetch(page):
+            try:
+                return page, self.discover_page(page, params)['results']
+            except Exception as e:
+                print(f"ERROR in fetching page {page}: {e}")
+                return page, []
+        return self.map(fetch, pages)
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self._stats_lock:
+            stats = dict(self.stats)
+        rate_429 = stats['responses_429'] / stats['requests'] if stats['requests'] else 0.0
+        return (f"{stats['pages']} pages in {elapsed:.0f}s ({stats['pages'] / elapsed:.2f} pages/s), "
+                f"{stats['requests']} requests ({stats['requests'] / elapsed:.1f}/s), "
+                f"429s: {stats['responses_429']} ({rate_429:.1%}), retries: {stats['retries']}, failures: {stats['failures']}")
+
+
+if __name__ == "__main__":
+    # python tmdb_fetcher.py [pages]  -> fetches the first discover pages concurrently and prints the throughput
+    import sys
+    fetcher = TMDBFetcher()
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    movies = sum(len(results) for _, results in fetcher.fetch_pages(range(1, pages + 1), {'sort_by': 'popularity.desc'}))
+    print(f"{movies} movies")
+    print(fetcher.report())
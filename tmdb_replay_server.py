@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from tmdb_fetcher import GONE_STATUSES
+
+# Local stand-in for the TMDB API, to run the ingest and the sync (sync.py) against recorded responses: no API key,
+# no quota, the same answers every time.
+#   record: a proxy to TMDB that appends every response it forwards to a JSON Lines file
+#   replay: serves the responses of such a file ; a request that wasn't recorded gets a 501, never a 404: the sync
+#           deletes the movies TMDB answers with a 404 / 410 (is_gone), and a partial recording must not delete any
+#           (a recorded 404 / 410 is served as recorded)
+# Requests are matched on path + query string without api_key (parameters sorted), and replay answers a matching
+# If-None-Match with a 304 like TMDB does, so the client's response cache can be exercised too.
+#
+#   python tmdb_replay_server.py record recordings.jsonl [--port 8766]   (TMDB_API_KEY set)
+#   python tmdb_replay_server.py replay recordings.jsonl [--port 8766]
+#   TMDB_BASE_URL=http://127.0.0.1:8766/3 python sync.py
+
+UPSTREAM = 'https://api.themoviedb.org'
+DEFAULT_PORT = 8766
+NOT_RECORDED_STATUS = 501  # a failure for the client (not retried, not gone)
+
+
+def request_key(path):
+    # ('/3/movie/changes', 'end_date=...&page=1&start_date=...') ; api_key is left out of recordings and keys
+    parts = urlsplit(path)
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name != 'api_key')
+    return parts.path, urlencode(query)
+
+
+def load_recordings(path):
+    recordings = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as recording_file:
+            for line in recording_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    recordings[(entry['path'], entry['query'])] = entry  # a later recording of the same request wins
+    return recordings
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    server_version = 'TMDBReplay/1.0'
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the ingest's own output
+
+    def do_GET(self):
+        key = request_key(self.path)
+        if self.server.mode == 'record':
+            entry = self.server.record(key)
+        else:
+            entry = self.server.recordings.get(key)
+        if entry is None:
+            self._send(NOT_RECORDED_STATUS, {}, json.dumps({'status_code': 34, 'status_message': f'not recorded: {key[0]}?{key[1]}'}))
+            return
+        etag = entry.get('headers', {}).get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            self._send(304, {'ETag': etag}, None)
+            return
+        self._send(entry['status'], entry.get('headers', {}), json.dumps(entry['body']))
+
+    def _send(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is None:
+            self.end_headers()
+            return
+        data = body.encode('utf-8')
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mode, recordings_path, upstream=UPSTREAM, api_key=None):
+        super().__init__(address, ReplayHandler)
+        self.mode = mode
+        self.recordings_path = recordings_path
+        self.recordings = load_recordings(recordings_path)
+        self.upstream = upstream.rstrip('/')
+        self.api_key = api_key
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        # forwards the request to TMDB and appends the response to the recordings ; 429s and errors (other than a 404 / 410)
+        # aren't recorded
+        path, query = key
+        params = parse_qsl(query, keep_blank_values=True) + [('api_key', self.api_key)]
+        response = self.session.get(self.upstream + path, params=params, timeout=30)
+        headers = {name: response.headers[name] for name in ('ETag', 'Last-Modified', 'Retry-After') if name in response.headers}
+        entry = {'path': path, 'query': query, 'status': response.status_code, 'headers': headers, 'body': response.json() if response.content else {}}
+        if response.status_code < 400 or response.status_code in GONE_STATUSES:
+            with self._lock:
+                self.recordings[key] = entry
+                with open(self.recordings_path, 'a', encoding='utf-8') as recording_file:
+                    recording_file.write(json.dumps(entry) + '\n')
+        return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record or replay TMDB API responses')
+    parser.add_argument('mode', choices=('record', 'replay'))
+    parser.add_argument('recordings', help='JSON Lines file of recorded responses')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--upstream', default=UPSTREAM, help='API to record from')
+    args = parser.parse_args(argv)
+
+    server = ReplayServer(('127.0.0.1', args.port), args.mode, args.recordings, args.upstream, os.getenv('TMDB_API_KEY'))
+    print(f"{args.mode.capitalize()}ing TMDB on http://127.0.0.1:{args.port}/3 ({len(server.recordings)} recorded responses)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
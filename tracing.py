@@ -0,0 +1,239 @@
+import contextvars
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+# Per-stage tracing of the searches (main.py, service.py), in place of the print() diagnostics they used to write.
+# A query is a trace ; its stages are spans, nested like the calls they time:
+#   query -> route, search (-> process_query (-> llm ...), sql ...), render
+# A span records its duration and attributes: the statement and its rows, the LLM call and its tokens, the corrected
+# names... When the query ends, its trace is written as ONE JSON line (TRACE_LOG, stderr by default) and added to
+# the metrics, which prometheus() exports in Prometheus' text format (GET /metrics of service.py, or at the end of main()).
+# The current span lives in a context variable: threads of the LLM pool get it through contextvars.copy_context(),
+# and every request of service.py has its own (the steps of its plan run in a thread, in a context of their own that
+# the request follows).
+#
+# Configuration through environment variables:
+#   TRACING=1      -> record traces and metrics ; otherwise every call below returns at once (a shared no-op span)
+#   TRACE_LOG      -> file the JSON line of every query is appended to (default: stderr)
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+METRIC_PREFIX = 'movie_search'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _NoopSpan:
+    # what every call returns while tracing is off (or outside of a query): nothing is recorded
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ('tracer', 'trace', 'name', 'parent', 'attributes', 'started', 'seconds')
+
+    def __init__(self, tracer, trace, name, parent, attributes):
+        self.tracer = tracer
+        self.trace = trace  # the query's root span (itself for the root)
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.started = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.seconds = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        _current_span.set(self.parent)  # not a token reset: a plan (generator) may close the span from another context
+        if self.trace is self:
+            self.tracer.finish(self)
+        else:
+            self.trace.attributes['_spans'].append(self)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Metrics:
+    # Prometheus histograms and counters of the traces ; updated under a lock (LLM threads, service requests)
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.histograms = {}  # (metric, label name, label value) -> [count per bucket..., +Inf count, sum]
+        self.counters = {}  # (metric, label name, label value) -> value
+
+    def observe(self, metric, label, value, seconds):
+        key = (metric, label, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+    def count(self, metric, label, value, amount=1):
+        key = (metric, label, value)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def prometheus(self):
+        # the text exposition format (version 0.0.4)
+        with self._lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for metric in sorted({key[0] for key in histograms}):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} histogram")
+            for (name, label, value), histogram in sorted(item for item in histograms.items() if item[0][0] == metric):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f'{METRIC_PREFIX}_{name}_bucket{{{label}="{value}",le="{bound}"}} {count}')
+                lines.append(f'{METRIC_PREFIX}_{name}_bucket{{{label}="{value}",le="+Inf"}} {histogram[len(self.buckets)]}')
+                lines.append(f'{METRIC_PREFIX}_{name}_sum{{{label}="{value}"}} {histogram[-1]:.6f}')
+                lines.append(f'{METRIC_PREFIX}_{name}_count{{{label}="{value}"}} {histogram[len(self.buckets)]}')
+        for metric in sorted({key[0] for key in counters}):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} counter")
+            for (name, label, value), count in sorted(item for item in counters.items() if item[0][0] == metric):
+                lines.append(f'{METRIC_PREFIX}_{name}{{{label}="{value}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    def __init__(self, enabled=False, log_path=None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.metrics = Metrics()
+        self._lock = threading.Lock()  # the LLM threads of one query add their tokens to the same span
+        self._log_lock = threading.Lock()
+
+    def query(self, text, **attributes):
+        # the root span of one query ; its JSON line is written when it ends
+        if not self.enabled:
+            return NOOP_SPAN
+        attributes['query'] = text
+        attributes['_spans'] = []
+        root = Span(self, None, 'query', _current_span.get(), attributes)
+        root.trace = root
+        return root
+
+    def span(self, name, **attributes):
+        # a stage of the current query ; a no-op outside of a query
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, parent.trace, name, parent, attributes)
+
+    def annotate(self, **attributes):
+        # attributes of the current span (e.g. the name a correction ended up with)
+        if self.enabled:
+            span = _current_span.get()
+            if span is not None:
+                span.attributes.update(attributes)
+
+    def follow(self, context):
+        # the current span of context (contextvars.Context) becomes the current one here: service.py runs the steps of
+        # a plan in a thread, in a context of its own, and its statements and LLM calls belong under the plan's spans
+        if self.enabled:
+            _current_span.set(context.get(_current_span))
+
+    def tokens(self, usage):
+        # token usage of an LLM response (its `usage`, when the API returns one) on the current span and the metrics
+        if not self.enabled or usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        span = _current_span.get()
+        if span is not None:
+            with self._lock:
+                for name, amount in (('prompt_tokens', prompt_tokens), ('completion_tokens', completion_tokens)):
+                    span.attributes[name] = span.attributes.get(name, 0) + amount
+        self.metrics.count('llm_tokens_total', 'type', 'prompt', prompt_tokens)
+        self.metrics.count('llm_tokens_total', 'type', 'completion', completion_tokens)
+
+    def finish(self, root):
+        spans = root.attributes.pop('_spans')
+        intent = root.attributes.get('intent', 'unknown')
+        self.metrics.observe('query_seconds', 'intent', intent, root.seconds)
+        self.metrics.count('queries_total', 'intent', intent)
+        self.metrics.count('rows_total', 'intent', intent, root.attributes.get('rows', 0))
+        for span in spans:
+            self.metrics.observe('stage_seconds', 'stage', span.name, span.seconds)
+            if span.name == 'llm':
+                self.metrics.count('llm_calls_total', 'method', span.attributes.get('method'))
+        record = {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            **root.attributes,
+            'ms': round(root.seconds * 1e3, 3),
+            'spans': [
+                {'name': span.name, 'parent': span.parent.name, 'start_ms': round((span.started - root.started) * 1e3, 3), 'ms': round(span.seconds * 1e3, 3), **span.attributes}
+                for span in sorted(spans, key=lambda span: span.started)
+            ],
+        }
+        self.write(json.dumps(record, default=str, ensure_ascii=False))
+
+    def write(self, line):
+        with self._log_lock:
+            try:
+                if self.log_path:
+                    with open(self.log_path, 'a', encoding='utf-8') as log_file:
+                        log_file.write(line + '\n')
+                else:
+                    sys.stderr.write(line + '\n')
+            except OSError as e:
+                print(f"ERROR in writing trace: {e}")  # tracing must never break searching
+
+    def prometheus(self):
+        return self.metrics.prometheus()
+
+
+def tracer_from_env():
+    return Tracer(
+        enabled=os.getenv('TRACING', '0').lower() in ('1', 'true', 'yes'),
+        log_path=os.getenv('TRACE_LOG'),
+    )
+
+
+# shared instance used by main.py, llm_client.py and service.py
+tracer = tracer_from_env()
+
+
+if __name__ == "__main__":
+    # python tracing.py [rounds]  -> cost of a query with three spans, tracing off and on
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for enabled in (False, True):
+        bench = Tracer(enabled, log_path=os.devnull)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            with bench.query('top 5 movies from year 2019', intent='top_year'):
+                with bench.span('route'):
+                    pass
+                with bench.span('sql', statement='top_year') as span:
+                    span.set(rows=5)
+                bench.annotate(rows=5)
+        elapsed = (time.perf_counter() - started) / rounds
+        print(f"tracing {'on ' if enabled else 'off'}: {elapsed * 1e6:7.2f} us per query (3 spans)")